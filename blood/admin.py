@@ -1,9 +1,34 @@
+import json
+import os
+
+from django.conf import settings
 from django.contrib import admin
+from django.core.exceptions import PermissionDenied
+from django.http import FileResponse, Http404
+from django.shortcuts import get_object_or_404
+from django.urls import path, reverse
+from django.utils.html import format_html, format_html_join
 
-from blood import models
+from blood import models, search
 
 admin.site.register(models.Donation)
-admin.site.register(models.Patient)
+
+
+class PatientAdmin(admin.ModelAdmin):
+    list_display = ["id", "first_name", "last_name", "blood_type", "phone_number"]
+    # shows the search box, get_search_results answers from the search index instead
+    search_fields = ["id", "first_name", "last_name", "phone_number"]
+
+    def get_search_results(self, request, queryset, search_term):
+        matching = search.filter_matching(queryset, search_term)
+
+        if matching is None:
+            return super().get_search_results(request, queryset, search_term)
+
+        return matching, False
+
+
+admin.site.register(models.Patient, PatientAdmin)
 
 
 class PercentageAdmin(admin.TabularInline):
@@ -18,3 +43,58 @@ admin.site.register(models.PopulationBloodTypeDistribution, PopulationAdmin)
 
 admin.site.register(models.MCIRequest)
 admin.site.register(models.SingleRequest)
+
+
+class RequestProfileAdmin(admin.ModelAdmin):
+    list_display = ["created", "method", "path", "status", "duration_ms", "queries", "query_ms",
+                    "user", "download"]
+    list_filter = ["view_name", "method"]
+    readonly_fields = ["created", "user", "method", "path", "view_name", "status", "duration_ms",
+                       "queries", "query_ms", "download", "queries_by_time"]
+    exclude = ["sql", "profile_file"]
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def get_urls(self):
+        return [
+            path("<int:profile_id>/download/",
+                 self.admin_site.admin_view(self.download_view),
+                 name="blood_requestprofile_download")
+        ] + super().get_urls()
+
+    def download_view(self, request, profile_id: int):
+        if not request.user.is_superuser:
+            raise PermissionDenied()
+
+        profile = get_object_or_404(models.RequestProfile, id=profile_id)
+        filename = os.path.join(settings.BLOOD_PROFILE_DIR, os.path.basename(profile.profile_file))
+
+        if not os.path.isfile(filename):
+            raise Http404("The profile file is gone")
+
+        return FileResponse(open(filename, "rb"), as_attachment=True,
+                            filename=profile.profile_file)
+
+    @admin.display(description="profile")
+    def download(self, obj):
+        return format_html(
+            '<a href="{}">{}</a>',
+            reverse("admin:blood_requestprofile_download", args=[obj.id]),
+            obj.profile_file
+        )
+
+    @admin.display(description="queries, slowest first")
+    def queries_by_time(self, obj):
+        queries = sorted(json.loads(obj.sql), key=lambda query: -query["ms"])
+
+        return format_html_join(
+            "\n", "<p><b>{:.2f} ms</b> <code>{}</code> {}</p>",
+            ((query["ms"], query["sql"], query["params"] or "") for query in queries)
+        )
+
+
+admin.site.register(models.RequestProfile, RequestProfileAdmin)
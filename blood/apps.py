@@ -1,5 +1,16 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+
+
+def _enable_wal(sender, connection, **kwargs):
+    # readers don't block the allocation writer's commit, and it doesn't block them
+    if connection.vendor == "sqlite":
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA journal_mode=WAL")
 
 
 class BloodConfig(AppConfig):
     name = 'blood'
+
+    def ready(self):
+        connection_created.connect(_enable_wal)
@@ -0,0 +1,133 @@
+"""
+Moves donations that can no longer be allocated, expired or fully issued, together with their
+issues out of blood_donation and blood_issue into blood_donation_archive and
+blood_issue_archive. The live tables, and the ledger, then only hold the working set of days
+the allocation queries scan; blood_donation_history and blood_issue_history union both for
+history and reporting.
+"""
+from datetime import datetime, timedelta
+from typing import NamedTuple
+
+from django.db import connection, transaction
+
+from blood.blood_types import MAX_BLOOD_AGE_DAYS
+from blood.fill_request import lock_inventory
+
+_CREATE_BATCH = """
+CREATE TEMP TABLE IF NOT EXISTS blood_archive_batch (donation_id INTEGER PRIMARY KEY)
+"""
+
+# expired rows come from the partial expiry index, fully issued ones from a ledger scan
+_SELECT_EXPIRED = """
+INSERT INTO blood_archive_batch (donation_id)
+SELECT donation_id FROM blood_remaining_units
+WHERE units > 0 AND expires_at <= %s
+LIMIT %s
+"""
+
+_SELECT_ISSUED = """
+INSERT OR IGNORE INTO blood_archive_batch (donation_id)
+SELECT donation_id FROM blood_remaining_units
+WHERE units <= 0 AND donation_date <= %s
+LIMIT %s
+"""
+
+_COPY_DONATIONS = """
+INSERT INTO blood_donation_archive
+    (id, donor_id, units, donation_date, high_priority_at, expires_at, archived_at)
+SELECT bd.id, bd.donor_id, bd.units, bd.donation_date, bd.high_priority_at, bd.expires_at, %s
+FROM blood_archive_batch ab JOIN blood_donation bd ON bd.id = ab.donation_id
+"""
+
+_COPY_ISSUES = """
+INSERT INTO blood_issue_archive (id, request_id, donation_id, request_blood_type, units)
+SELECT bi.id, bi.request_id, bi.donation_id, bi.request_blood_type, bi.units
+FROM blood_archive_batch ab JOIN blood_issue bi ON bi.donation_id = ab.donation_id
+"""
+
+# The ledger rows go first, the issue delete trigger then has no units to give back. Their
+# delete triggers still take the units off the stock totals and bump the inventory epoch.
+_DELETE = [
+    "DELETE FROM blood_remaining_units "
+    "WHERE donation_id IN (SELECT donation_id FROM blood_archive_batch)",
+    "DELETE FROM blood_issue WHERE donation_id IN (SELECT donation_id FROM blood_archive_batch)",
+    "DELETE FROM blood_donation WHERE id IN (SELECT donation_id FROM blood_archive_batch)",
+]
+
+
+class ArchiveBatch(NamedTuple):
+    donations: int
+    issues: int
+
+
+def _datetime(value: datetime) -> str:
+    return connection.ops.adapt_datetimefield_value(value)
+
+
+def _issued_before(now: datetime, issued_before: datetime, expired_only: bool) -> datetime:
+    # donated before this, a fully issued donation has expired as well
+    return min(issued_before, now - timedelta(days=MAX_BLOOD_AGE_DAYS)) if expired_only \
+        else issued_before
+
+
+def count_candidates(now: datetime, issued_before: datetime,
+                     expired_only: bool = False) -> ArchiveBatch:
+    """
+    The donations, and their issues, archive_batch would move in total.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT COUNT(*), COALESCE(SUM("
+            "    (SELECT COUNT(*) FROM blood_issue bi WHERE bi.donation_id = rm.donation_id)"
+            "), 0) "
+            "FROM blood_remaining_units rm "
+            "WHERE (rm.units > 0 AND rm.expires_at <= %s) "
+            "    OR (rm.units <= 0 AND rm.donation_date <= %s)",
+            [_datetime(now), _datetime(_issued_before(now, issued_before, expired_only))]
+        )
+        return ArchiveBatch(*cursor.fetchone())
+
+
+@transaction.atomic
+def archive_batch(now: datetime, issued_before: datetime, batch_size: int,
+                  expired_only: bool = False) -> ArchiveBatch:
+    """
+    Archive up to batch_size donations expired by now and fully issued donations donated before
+    issued_before, only expired ones as well if expired_only. A fully issued donation only gets
+    units back when one of its issues is corrected, issued_before leaves time for that. Returns
+    what was archived, nothing once no donation qualifies.
+    """
+    lock_inventory()
+
+    with connection.cursor() as cursor:
+        cursor.execute(_CREATE_BATCH)
+        cursor.execute("DELETE FROM blood_archive_batch")
+
+        cursor.execute(_SELECT_EXPIRED, [_datetime(now), batch_size])
+        selected = cursor.rowcount
+
+        if selected < batch_size:
+            cursor.execute(_SELECT_ISSUED, [
+                _datetime(_issued_before(now, issued_before, expired_only)),
+                batch_size - selected
+            ])
+            selected += cursor.rowcount
+
+        if selected == 0:
+            return ArchiveBatch(0, 0)
+
+        cursor.execute(
+            "SELECT COUNT(*) FROM blood_archive_batch ab "
+            "JOIN blood_issue bi ON bi.donation_id = ab.donation_id"
+        )
+        issues = cursor.fetchone()[0]
+
+        cursor.execute(_COPY_DONATIONS, [_datetime(now)])
+        cursor.execute(_COPY_ISSUES)
+
+        for statement in _DELETE:
+            cursor.execute(statement)
+
+        cursor.execute("DELETE FROM blood_archive_batch")
+
+    return ArchiveBatch(selected, issues)
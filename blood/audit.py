@@ -0,0 +1,150 @@
+from collections import defaultdict
+import json
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+import reversion
+
+from blood.models import AllocationAudit, Donation, Issue, IssueRequest, Patient, Reject, \
+    RejectType
+
+VERSION_AUDIT = "versions"
+COMPACT_AUDIT = "compact"
+
+
+def _compact() -> bool:
+    return settings.BLOOD_AUDIT_MODE == COMPACT_AUDIT
+
+
+def record_issues(planned: List[Tuple[IssueRequest, List[Tuple[int, str, int]]]]):
+    """
+    Add the issues just bulk inserted for each request to the active revision.
+    """
+    if not reversion.is_active():
+        return
+
+    if not _compact():
+        for issue in Issue.objects.filter(request__in=[request for request, _ in planned]):
+            reversion.add_to_revision(issue)
+        return
+
+    issue_type = ContentType.objects.get_for_model(Issue)
+    for request, issues in planned:
+        # the audit is exported next to its request's version, and reversion saves no revision
+        # (nor its meta) without any version
+        reversion.add_to_revision(request)
+        reversion.add_meta(
+            AllocationAudit,
+            owner_type=ContentType.objects.get_for_model(request.__class__),
+            owner_id=str(request.pk),
+            record_type=issue_type,
+            serialized_data=json.dumps([
+                {"donation": donation_id, "request_blood_type": request_blood_type, "units": units}
+                for donation_id, request_blood_type, units in issues
+            ])
+        )
+
+
+def record_rejects(rejects: List[Reject], missing: List[List[Tuple[str, int]]]):
+    """
+    Add bulk inserted rejects and their reject types to the active revision.
+    """
+    if not reversion.is_active():
+        return
+
+    # the reject itself is always versioned, compact audits hang off its version
+    for reject in rejects:
+        reversion.add_to_revision(reject)
+
+    if not _compact():
+        for reject_type in RejectType.objects.filter(reject__in=rejects):
+            reversion.add_to_revision(reject_type)
+        return
+
+    owner_type = ContentType.objects.get_for_model(Reject)
+    reject_type_type = ContentType.objects.get_for_model(RejectType)
+    for reject, missing_units in zip(rejects, missing):
+        reversion.add_meta(
+            AllocationAudit,
+            owner_type=owner_type,
+            owner_id=str(reject.pk),
+            record_type=reject_type_type,
+            serialized_data=json.dumps([
+                {"blood_type": blood_type, "units": units} for blood_type, units in missing_units
+            ])
+        )
+
+
+def record_donations(donors: Dict[str, Patient], changed: List[Patient], donations: int):
+    """
+    Add the patients created or changed by a bulk import, and the donations it just bulk
+    inserted, to the active revision. The donations are the newest rows, the import holds the
+    write lock.
+    """
+    if not reversion.is_active():
+        return
+
+    inserted = Donation.objects.order_by("-id")[:donations]
+
+    if not _compact():
+        for patient in changed:
+            reversion.add_to_revision(patient)
+        # the version's object_repr is the donor's blood type
+        for donation in inserted.select_related("donor"):
+            reversion.add_to_revision(donation)
+        return
+
+    by_donor: Dict[str, List[Dict]] = defaultdict(list)
+    rows = list(inserted.values_list("id", "donor_id", "units", "donation_date"))
+    for donation_id, donor_id, units, donation_date in reversed(rows):
+        by_donor[donor_id].append(
+            {"id": donation_id, "units": units, "donation_date": donation_date.isoformat()}
+        )
+
+    owner_type = ContentType.objects.get_for_model(Patient)
+    donation_type = ContentType.objects.get_for_model(Donation)
+    for donor_id, records in by_donor.items():
+        reversion.add_to_revision(donors[donor_id])
+        reversion.add_meta(
+            AllocationAudit,
+            owner_type=owner_type,
+            owner_id=donor_id,
+            record_type=donation_type,
+            serialized_data=json.dumps(records)
+        )
+
+
+def with_allocation_audits(versions: Iterable, chunk_size: int) -> Iterator[Tuple[object, List]]:
+    """
+    Pair every Version with the compact allocation audits its object owns in the same revision,
+    looked up once per chunk of versions.
+    """
+    chunk = []
+
+    for version in versions:
+        chunk.append(version)
+
+        if len(chunk) == chunk_size:
+            yield from _attach(chunk)
+            chunk = []
+
+    yield from _attach(chunk)
+
+
+def _attach(chunk: List) -> Iterator[Tuple[object, List]]:
+    if not chunk:
+        return
+
+    audits: Dict[Tuple[int, int, str], List[AllocationAudit]] = defaultdict(list)
+    for audit in AllocationAudit.objects \
+            .filter(revision_id__in={version.revision_id for version in chunk}) \
+            .select_related("record_type") \
+            .order_by("id"):
+        audits[(audit.revision_id, audit.owner_type_id, audit.owner_id)].append(audit)
+
+    for version in chunk:
+        yield version, audits.get(
+            (version.revision_id, version.content_type_id, version.object_id),
+            []
+        )
@@ -44,3 +44,11 @@ def _can_receive():
 CAN_RECEIVE = _can_receive()
 
 POPULATION_BLOOD_TYPE_DISTRIBUTION = "pop"
+
+GREEDY_ALLOCATION = "greedy"
+OPTIMAL_ALLOCATION = "optimal"
+
+ALLOCATION_CHOICES = [
+    (GREEDY_ALLOCATION, "Greedy, blood type by blood type"),
+    (OPTIMAL_ALLOCATION, "Optimal, whole request at once")
+]
@@ -0,0 +1,154 @@
+from concurrent.futures import Future
+import queue
+import threading
+from typing import Any, Callable, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import connection, transaction
+import reversion
+
+from blood.fill_request import lock_inventory
+
+Job = Tuple[Callable[..., Any], tuple, Any, Future]
+
+_STOP = None
+
+
+class AllocationDispatcher:
+    """
+    Serializes allocations through a single writer thread.
+
+    Request threads queue their allocation and wait on a future. The writer takes everything
+    queued so far, up to batch_size, and runs it in one transaction that holds the write lock
+    from the start, each allocation in its own revision and savepoint so a failure only rolls
+    back that allocation. Results are handed back once the batch is committed.
+
+    There is one writer per process, writers of different processes are serialized by the
+    write lock taken at the start of each batch.
+    """
+
+    def __init__(self, batch_size: int):
+        self._batch_size = batch_size
+        self._queue: "queue.Queue[Optional[Job]]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def submit(self, allocate: Callable[..., Any], *args, user=None) -> Future:
+        future = Future()
+
+        with self._lock:
+            if self._thread is None:
+                # started lazily, so the thread is created in the worker after a fork
+                self._thread = threading.Thread(
+                    target=self._run,
+                    name="allocation-writer",
+                    daemon=True
+                )
+                self._thread.start()
+
+            self._queue.put((allocate, args, user, future))
+
+        return future
+
+    def shutdown(self):
+        """
+        Stop the writer once everything queued before this call was processed.
+        """
+        with self._lock:
+            if self._thread is None:
+                return
+
+            self._queue.put(_STOP)
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        try:
+            while True:
+                batch = [self._queue.get()]
+
+                while batch[-1] is not _STOP and len(batch) < self._batch_size:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+
+                stop = batch[-1] is _STOP
+                if stop:
+                    batch.pop()
+
+                if batch:
+                    self._process(batch)
+
+                if stop:
+                    return
+        finally:
+            connection.close()
+
+    def _process(self, batch: List[Job]):
+        results = []
+
+        try:
+            with transaction.atomic():
+                lock_inventory()
+
+                for allocate, args, user, future in batch:
+                    try:
+                        with reversion.create_revision():
+                            if user is not None and user.is_authenticated:
+                                reversion.set_user(user)
+
+                            results.append((future, allocate(*args), None))
+                    except Exception as error:  # pylint: disable=broad-except
+                        # delivered to the waiting request, the rest of the batch goes on
+                        results.append((future, None, error))
+        except Exception as error:  # pylint: disable=broad-except
+            connection.close()
+
+            for *_, future in batch:
+                future.set_exception(error)
+
+            return
+
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+
+_dispatcher: Optional[AllocationDispatcher] = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher() -> Optional[AllocationDispatcher]:
+    """
+    The process wide dispatcher, or None unless BLOOD_ALLOCATION_DISPATCHER is enabled.
+    """
+    global _dispatcher
+
+    if not settings.BLOOD_ALLOCATION_DISPATCHER:
+        return None
+
+    if _dispatcher is None:
+        with _dispatcher_lock:
+            if _dispatcher is None:
+                _dispatcher = AllocationDispatcher(settings.BLOOD_ALLOCATION_BATCH_SIZE)
+
+    return _dispatcher
+
+
+def dispatch(allocate: Callable[..., Any], *args, user=None) -> Any:
+    """
+    Run allocate(*args) on the writer thread and wait for its result, or in the calling thread
+    when the dispatcher is disabled.
+
+    allocate has to do all of the writes, rejects included: the request thread may still hold a
+    read snapshot from before the allocation, and SQLite won't let it write from there.
+    """
+    dispatcher = get_dispatcher()
+
+    if dispatcher is None:
+        return allocate(*args)
+
+    return dispatcher.submit(allocate, *args, user=user).result()
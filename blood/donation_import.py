@@ -0,0 +1,222 @@
+"""
+Bulk import of the donations collected at a blood drive, from CSV (with a header row) or NDJSON
+with the columns of ROW_FIELDS. Rows are read and written a chunk at a time, each chunk in its
+own transaction and revision, so the import runs in constant memory and rows that fail
+validation are reported without stopping the others.
+"""
+import csv
+import json
+from itertools import islice
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, TextIO, \
+    Tuple, Union
+
+from django.db import connection, transaction
+import reversion
+
+from blood import audit
+from blood.fill_request import lock_inventory
+from blood.forms import ImportedDonation
+from blood.models import Donation, Patient
+
+CSV = "csv"
+NDJSON = "ndjson"
+
+ROW_FIELDS = ("id_number", "first_name", "last_name", "birthday", "blood_type", "smokes",
+              "phone_number", "units", "donation_date")
+PATIENT_FIELDS = ["first_name", "last_name", "birthday", "blood_type", "smokes", "phone_number"]
+
+CHUNK_SIZE = 1000
+
+# CSV has no booleans, and the checkbox widget takes any other non empty string as checked
+_FALSE = {"", "0", "f", "false", "n", "no"}
+
+
+class RowError(NamedTuple):
+    line: int
+    id_number: str
+    field: str
+    message: str
+
+
+class ImportResult:
+    def __init__(self):
+        self.rows = 0
+        self.donations = 0
+        self.patients_created = 0
+        self.patients_updated = 0
+        self.rejected = 0
+
+
+Row = Tuple[int, Union[Dict, RowError]]
+
+
+def detect_format(filename: str) -> str:
+    return NDJSON if filename.lower().endswith((".ndjson", ".jsonl", ".json")) else CSV
+
+
+def read_csv(stream: TextIO) -> Iterator[Row]:
+    reader = csv.DictReader(stream)
+
+    for row in reader:
+        row = {key: (value or "").strip() for key, value in row.items() if key}
+
+        if "smokes" in row:
+            row["smokes"] = row["smokes"].lower() not in _FALSE
+
+        yield reader.line_num, row
+
+
+def read_ndjson(stream: TextIO) -> Iterator[Row]:
+    for line, text in enumerate(stream, start=1):
+        if not text.strip():
+            continue
+
+        try:
+            row = json.loads(text)
+        except ValueError as e:
+            yield line, RowError(line, "", "__all__", f"Invalid JSON: {e}")
+            continue
+
+        if not isinstance(row, dict):
+            yield line, RowError(line, "", "__all__", "Expected a JSON object")
+            continue
+
+        # the form expects the id number as text, like the other id fields
+        if isinstance(row.get("id_number"), int):
+            row["id_number"] = str(row["id_number"]).zfill(10)
+
+        yield line, row
+
+
+def read_rows(stream: TextIO, format: str) -> Iterator[Row]:
+    return read_ndjson(stream) if format == NDJSON else read_csv(stream)
+
+
+def import_donations(rows: Iterable[Row], on_error: Callable[[RowError], None],
+                     chunk_size: int = CHUNK_SIZE, user=None, comment: str = "") -> ImportResult:
+    """
+    Validate rows with the donation form, create or update their donors and insert their
+    donations with the time they were collected. Rows repeating a donation already in the
+    database (same donor and donation date) are rejected, so a drive can be imported again
+    after fixing its failed rows.
+    """
+    result = ImportResult()
+    rows = iter(rows)
+    form = ImportedDonation()
+
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return result
+
+        valid = []
+        for line, row in chunk:
+            result.rows += 1
+
+            if isinstance(row, RowError):
+                result.rejected += 1
+                on_error(row)
+                continue
+
+            if form.validate(row):
+                valid.append((line, form.cleaned_data))
+            else:
+                result.rejected += 1
+                for field, messages in form.errors.items():
+                    for message in messages:
+                        on_error(RowError(line, str(row.get("id_number", "")), field, message))
+
+        if valid:
+            with transaction.atomic(), reversion.create_revision():
+                if user is not None:
+                    reversion.set_user(user)
+                reversion.set_comment(comment)
+
+                _import_chunk(valid, on_error, result)
+
+
+def _import_chunk(valid: List[Tuple[int, Dict]], on_error: Callable[[RowError], None],
+                  result: ImportResult):
+    # the write lock first, audit.record_donations reads the inserted donations back by id
+    lock_inventory()
+
+    ids = {data["id_number"] for _, data in valid}
+    donors: Dict[str, Patient] = Patient.objects.in_bulk(list(ids))
+    existing = set(Donation.objects.filter(
+        donor_id__in=ids,
+        donation_date__in={data["donation_date"] for _, data in valid}
+    ).values_list("donor_id", "donation_date"))
+
+    created: Dict[str, Patient] = {}
+    changed: Dict[str, Patient] = {}
+    donations = []
+
+    for line, data in valid:
+        key = (data["id_number"], data["donation_date"])
+
+        if key in existing:
+            result.rejected += 1
+            on_error(RowError(line, data["id_number"], "donation_date",
+                              "Donation already imported"))
+            continue
+
+        existing.add(key)
+        patient = donors.get(data["id_number"])
+
+        if patient is None:
+            patient = donors[data["id_number"]] = created[data["id_number"]] = \
+                Patient(id=data["id_number"])
+
+        # later rows of the same donor win, as if entered one by one
+        if patient.apply(**{field: data[field] for field in PATIENT_FIELDS}) and \
+                patient.id not in created:
+            changed[patient.id] = patient
+
+        donations.append(Donation(donor_id=patient.id, units=data["units"],
+                                  donation_date=data["donation_date"]))
+
+    Patient.objects.bulk_create(created.values())
+    update_patients(list(changed.values()))
+    Donation.objects.bulk_create(donations)
+
+    audit.record_donations(donors, list(created.values()) + list(changed.values()),
+                           len(donations))
+
+    result.donations += len(donations)
+    result.patients_created += len(created)
+    result.patients_updated += len(changed)
+
+
+def update_patients(patients: List[Patient]):
+    """
+    Save the details of many patients, one prepared UPDATE per row: bulk_update's CASE per
+    column grows with the batch.
+    """
+    quote = connection.ops.quote_name
+    fields = [Patient._meta.get_field(name) for name in PATIENT_FIELDS]
+    sql = f"UPDATE {quote(Patient._meta.db_table)} SET " + \
+          ", ".join(f"{quote(field.column)} = %s" for field in fields) + \
+          f" WHERE {quote(Patient._meta.pk.column)} = %s"
+
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, [
+            [field.get_db_prep_save(getattr(patient, field.attname), connection)
+             for field in fields] + [patient.pk]
+            for patient in patients
+        ])
+
+
+def write_report(stream: TextIO) -> Callable[[RowError], None]:
+    """
+    An on_error writing the errors to stream as CSV, as they come.
+    """
+    writer = csv.writer(stream)
+    writer.writerow(RowError._fields)
+
+    return writer.writerow
+
+
+def import_file(stream: TextIO, format: Optional[str], filename: str,
+                on_error: Callable[[RowError], None], **kwargs) -> ImportResult:
+    return import_donations(read_rows(stream, format or detect_format(filename)), on_error,
+                            **kwargs)
@@ -1,12 +1,28 @@
-from typing import List, Tuple, Type
+from datetime import datetime, timedelta
+import hashlib
+import json
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple, Type, \
+    Union
 
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
-from django.db import transaction
+from django.db import models, transaction
+from django.db.models import BooleanField, ExpressionWrapper, F, Q
+from django.utils import timezone
 
-from blood.blood_types import CAN_RECEIVE
-from blood.models import BloodTypeDistribution, Issue, IssueRequest, MCIRequest, \
-    OutstandingDonations, OutstandingDonationsMCI, Patient, \
-    Reject, RejectType, SingleRequest
+from blood import audit, inventory, metrics
+from blood.blood_types import CAN_DONATE, CAN_RECEIVE, GREEDY_ALLOCATION, OPTIMAL_ALLOCATION
+from blood.min_cost_flow import MinCostFlow
+from blood.models import BloodTypeDistribution, Hold, InventoryVersion, Issue, IssueRequest, \
+    MCIBatch, MCIRequest, OutstandingDonations, OutstandingDonationsMCI, Patient, Reject, \
+    RejectType, RemainingUnits, Reservation, SingleRequest
+
+Candidate = Tuple[int, str, int, bool]
+
+# Outcomes of an order in an MCI batch
+FILLED = "fill"
+PARTIAL = "partial"
+REJECTED = "reject"
 
 
 class CanNotFulfill(Exception):
@@ -14,99 +30,765 @@ class CanNotFulfill(Exception):
         self.missing_units = missing_units
 
     @transaction.atomic
-    def save_reject(self, request_type: Type[IssueRequest]):
-        reject = Reject(
-            request_type=ContentType.objects.get_for_model(request_type)
-        )
-        reject.save()
+    def save_reject(self, request_type: Type[IssueRequest], idempotency_key: Optional[str] = None):
+        return _save_rejects(request_type, [self.missing_units], [idempotency_key])[0]
+
+
+class BatchConflict(Exception):
+    """
+    An MCI batch sent with the idempotency key of a different batch.
+    """
+
 
-        for blood_type, units in self.missing_units:
-            RejectType(
-                reject=reject,
-                blood_type=blood_type,
-                units=units
-            ).save()
+def lock_inventory():
+    """
+    Take the database write lock before reading the outstanding units. SQLite transactions start
+    deferred, after this no-op update every read in the transaction happens under the write
+    lock, so two connections can't plan with the same remaining units.
+    """
+    InventoryVersion.objects.filter(id=1).update(version=F("version"))
 
-        return reject
+
+def replay(idempotency_key: Optional[str]) -> Optional[Union[IssueRequest, Reject]]:
+    """
+    The request (as its leaf class) or reject an earlier submission with this key created.
+    """
+    if idempotency_key is None:
+        return None
+
+    request = IssueRequest.objects.filter(idempotency_key=idempotency_key).first()
+    if request is not None:
+        return request.content_type.get_object_for_this_type(id=request.id)
+
+    return Reject.objects.filter(idempotency_key=idempotency_key).first()
 
 
 @transaction.atomic
-def create_and_fill_single_request(patient: Patient, units: int) -> SingleRequest:
-    request = SingleRequest(patient=patient, units=units)
+def create_and_fill_single_request(patient: Patient, units: int,
+                                   idempotency_key: Optional[str] = None,
+                                   reservation_id: Optional[int] = None,
+                                   user=None) -> SingleRequest:
+    lock_inventory()
+    release_expired_holds()
+
+    request = SingleRequest(patient=patient, units=units, idempotency_key=idempotency_key)
 
     request.save()
 
-    # try to fulfil the request
-    fill_single_request(request)
+    # issue the units held for it, or try to fulfil the request
+    held = _take_reservation(reservation_id, user, [(patient.blood_type, units)],
+                             patient=patient, units=units)
+    if held is not None:
+        _issue(request, held)
+    else:
+        fill_single_request(request)
 
     return request
 
 
 @transaction.atomic
-def create_and_fill_mci_request(distribution: BloodTypeDistribution, units: int) -> MCIRequest:
-    request = MCIRequest(distribution=distribution, units=units)
+def create_and_fill_mci_request(
+        distribution: BloodTypeDistribution,
+        units: int,
+        allocation: str = GREEDY_ALLOCATION,
+        idempotency_key: Optional[str] = None,
+        reservation_id: Optional[int] = None,
+        user=None
+) -> MCIRequest:
+    lock_inventory()
+    release_expired_holds()
+
+    request = MCIRequest(distribution=distribution, units=units, allocation=allocation,
+                         idempotency_key=idempotency_key)
 
     request.save()
 
-    fill_mci_request(request)
+    held = _take_reservation(reservation_id, user, distribution.blood_types(units),
+                             distribution=distribution, units=units, allocation=allocation)
+    if held is not None:
+        _issue(request, held)
+    else:
+        fill_mci_request(request)
     return request
 
 
-def fill_single_request(single_request: SingleRequest):
-    units_left = single_request.units
-    donations = []
+def _replayed(idempotency_key: Optional[str]) -> Optional[Union[IssueRequest, Reject]]:
+    if idempotency_key is None:
+        return None
+
+    # Under the write lock a duplicate sent concurrently either committed or hasn't started,
+    # the unique index only backs this up
+    lock_inventory()
+    return replay(idempotency_key)
 
-    while units_left > 0:
-        if not donations:
-            donations = list(OutstandingDonations.objects.filter(
-                blood_type__in=CAN_RECEIVE[single_request.patient.blood_type]
-            )[0:10])
 
-            if not donations:
-                raise CanNotFulfill([(single_request.patient.blood_type, units_left)])
+@transaction.atomic
+def fill_or_reject_single_request(patient: Patient, units: int,
+                                  idempotency_key: Optional[str] = None,
+                                  reservation_id: Optional[int] = None,
+                                  user=None) \
+        -> Union[SingleRequest, Reject]:
+    previous = _replayed(idempotency_key)
+    if previous is not None:
+        return previous
+
+    try:
+        return create_and_fill_single_request(patient, units, idempotency_key, reservation_id,
+                                              user)
+    except CanNotFulfill as cnf:
+        return cnf.save_reject(SingleRequest, idempotency_key)
+
 
-        donation = donations.pop()
+@transaction.atomic
+def fill_or_reject_mci_request(
+        distribution: BloodTypeDistribution,
+        units: int,
+        allocation: str = GREEDY_ALLOCATION,
+        idempotency_key: Optional[str] = None,
+        reservation_id: Optional[int] = None,
+        user=None
+) -> Union[MCIRequest, Reject]:
+    previous = _replayed(idempotency_key)
+    if previous is not None:
+        return previous
+
+    try:
+        return create_and_fill_mci_request(distribution, units, allocation, idempotency_key,
+                                           reservation_id, user)
+    except CanNotFulfill as cnf:
+        return cnf.save_reject(MCIRequest, idempotency_key)
+
+
+def candidate_query(view: Type[models.Model], blood_types: Iterable[str],
+                    order_by: Sequence[str] = (),
+                    limit: Optional[int] = None) -> models.QuerySet:
+    """
+    Query (donation_id, blood_type, units, expiring) of every outstanding donation of the given
+    types, in the order the allocation should consume them. Expiring donations are past
+    HIGH_PRIORITY_DAYS; the flag is computed in SQL to avoid parsing every date.
+    """
+    query = view.objects.filter(blood_type__in=set(blood_types)).annotate(
+        expiring=ExpressionWrapper(
+            Q(high_priority_at__lte=timezone.now()),
+            output_field=BooleanField()
+        )
+    )
 
-        issue_units = min(donation.units, units_left)
+    if order_by:
+        query = query.order_by(*order_by)
 
-        Issue(
-            request=single_request,
-            donation_id=donation.donation_id,
-            request_blood_type=single_request.patient.blood_type,
-            units=issue_units
-        ).save()
+    if limit is not None:
+        query = query[0:limit]
 
-        units_left -= issue_units
+    return query.values_list("donation_id", "blood_type", "units", "expiring")
 
 
-def fill_mci_request(request: MCIRequest):
+def _candidates(view: Type[models.Model], blood_types: Iterable[str],
+                order_by: Sequence[str] = (),
+                limit: Optional[int] = None) -> List[Candidate]:
+    return list(candidate_query(view, blood_types, order_by, limit))
+
+
+def _plan(
+        needs: Iterable[Tuple[str, int]],
+        candidates: List[Candidate]
+) -> Tuple[List[Tuple[int, str, int]], List[Tuple[str, int]]]:
+    """
+    Greedily assign candidates to each (blood_type, units) need in turn.
+
+    Returns the planned issues as (donation_id, request_blood_type, units) and the units that
+    could not be covered as (blood_type, units).
+    """
+    remaining = {donation_id: units for donation_id, _, units, _ in candidates}
+    issues = []
     missing_units = []
 
-    for blood_type, units_left in request.distribution.blood_types(request.units):
-        donations = []
+    for blood_type, units_left in needs:
+        compatible = CAN_RECEIVE[blood_type]
 
-        while units_left > 0:
-            if not donations:
-                donations = list(OutstandingDonationsMCI.objects.filter(
-                    blood_type__in=CAN_RECEIVE[blood_type]
-                ).order_by("donation_date")[0:10])
+        for donation_id, donor_type, _, _ in candidates:
+            if units_left <= 0:
+                break
+
+            if donor_type not in compatible or remaining[donation_id] == 0:
+                continue
 
-                if not donations:
-                    missing_units.append((blood_type, units_left))
-                    break
+            issue_units = min(remaining[donation_id], units_left)
+            remaining[donation_id] -= issue_units
+            units_left -= issue_units
 
-            donation = donations.pop()
+            issues.append((donation_id, blood_type, issue_units))
 
-            issue_units = min(donation.units, units_left)
+        if units_left > 0:
+            missing_units.append((blood_type, units_left))
 
-            Issue(
-                request=request,
-                donation_id=donation.donation_id,
-                request_blood_type=blood_type,
-                units=issue_units
-            ).save()
+    return issues, missing_units
 
+
+def _allocation_cost(donor_type: str, expiring: bool) -> int:
+    # versatile donors (O- above all) are the most expensive, expiring units are cheaper to use
+    return len(CAN_DONATE[donor_type]) * 2 + (0 if expiring else 1)
+
+
+def _plan_optimal(
+        needs: Iterable[Tuple[str, int]],
+        candidates: List[Candidate]
+) -> Tuple[List[Tuple[int, str, int]], List[Tuple[str, int]]]:
+    """
+    Solve all needs at once as a min-cost flow from (donor type, expiring) stock groups to the
+    requested blood types over CAN_RECEIVE. Within a group the oldest donations are used first.
+
+    Returns the same shape as _plan.
+    """
+    groups: Dict[Tuple[str, bool], List[List[int]]] = {}
+    for donation_id, donor_type, units, expiring in candidates:
+        groups.setdefault((donor_type, expiring), []).append([donation_id, units])
+
+    demand: Dict[str, int] = {}
+    for blood_type, units in needs:
+        demand[blood_type] = demand.get(blood_type, 0) + units
+
+    group_keys = list(groups.keys())
+    demand_types = list(demand.keys())
+
+    source, sink = 0, 1
+    first_demand = 2 + len(group_keys)
+    flow = MinCostFlow(first_demand + len(demand_types))
+
+    for i, key in enumerate(group_keys):
+        flow.add_edge(source, 2 + i, sum(units for _, units in groups[key]), 0)
+
+    for j, blood_type in enumerate(demand_types):
+        flow.add_edge(first_demand + j, sink, demand[blood_type], 0)
+
+    edges = []
+    for i, (donor_type, expiring) in enumerate(group_keys):
+        for j, blood_type in enumerate(demand_types):
+            if donor_type in CAN_RECEIVE[blood_type]:
+                edges.append((group_keys[i], blood_type, flow.add_edge(
+                    2 + i,
+                    first_demand + j,
+                    demand[blood_type],
+                    _allocation_cost(donor_type, expiring)
+                )))
+
+    flow.solve(source, sink)
+
+    issues = []
+    delivered = dict.fromkeys(demand_types, 0)
+    positions = dict.fromkeys(group_keys, 0)
+
+    for key, blood_type, edge in edges:
+        units_left = edge.flow
+        delivered[blood_type] += units_left
+        group = groups[key]
+
+        while units_left > 0:
+            donation = group[positions[key]]
+            issue_units = min(donation[1], units_left)
+
+            donation[1] -= issue_units
             units_left -= issue_units
 
+            if donation[1] == 0:
+                positions[key] += 1
+
+            issues.append((donation[0], blood_type, issue_units))
+
+    missing_units = [
+        (blood_type, demand[blood_type] - delivered[blood_type])
+        for blood_type in demand_types
+        if delivered[blood_type] < demand[blood_type]
+    ]
+
+    return issues, missing_units
+
+
+def _issue(request: IssueRequest, issues: List[Tuple[int, str, int]]):
+    _issue_many([(request, issues)])
+
+
+def _issue_many(planned: List[Tuple[IssueRequest, List[Tuple[int, str, int]]]]):
+    Issue.objects.bulk_create([
+        Issue(
+            request=request,
+            donation_id=donation_id,
+            request_blood_type=request_blood_type,
+            units=units
+        )
+        for request, issues in planned
+        for donation_id, request_blood_type, units in issues
+    ])
+
+    # bulk_create skips the signals reversion relies on, keep the audit trail complete
+    audit.record_issues(planned)
+
+    issued: Dict[str, int] = {}
+    for _, issues in planned:
+        for _, request_blood_type, units in issues:
+            issued[request_blood_type] = issued.get(request_blood_type, 0) + units
+    metrics.count_issued(issued)
+
+
+def _save_rejects(request_type: Type[IssueRequest], missing: List[List[Tuple[str, int]]],
+                  idempotency_keys: Optional[List[Optional[str]]] = None) -> List[Reject]:
+    if not missing:
+        return []
+
+    content_type = ContentType.objects.get_for_model(request_type)
+    Reject.objects.bulk_create([
+        Reject(request_type=content_type, idempotency_key=key)
+        for key in (idempotency_keys or [None] * len(missing))
+    ])
+
+    # bulk_create doesn't return ids on SQLite. A transaction that wrote holds the only write
+    # lock, so the newest rejects are the ones just inserted
+    rejects = list(Reject.objects.order_by("-id")[0:len(missing)])
+    rejects.reverse()
+
+    RejectType.objects.bulk_create([
+        RejectType(reject=reject, blood_type=blood_type, units=units)
+        for reject, missing_units in zip(rejects, missing)
+        for blood_type, units in missing_units
+    ])
+
+    audit.record_rejects(rejects, missing)
+    metrics.count_rejects(request_type._meta.model_name, len(rejects))
+
+    return rejects
+
+
+Allocation = Tuple[
+    List[Tuple[str, int]],
+    Callable[..., Tuple[List[Tuple[int, str, int]], List[Tuple[str, int]]]],
+    Callable[[inventory.InventoryEngine], List[Candidate]],
+    Callable[[], List[Candidate]]
+]
+
+
+def _single_allocation(blood_type: str, units: int) -> Allocation:
+    # every donation holds at least one unit, so no more than `units` donations are needed
+    return (
+        [(blood_type, units)],
+        _plan,
+        lambda engine: engine.single_candidates(CAN_RECEIVE[blood_type], limit=units),
+        lambda: _candidates(OutstandingDonations, CAN_RECEIVE[blood_type], limit=units)
+    )
+
+
+def _mci_allocation(distribution: BloodTypeDistribution, units: int,
+                    allocation: str) -> Allocation:
+    needs = distribution.blood_types(units)
+    donor_types = set().union(*(CAN_RECEIVE[blood_type] for blood_type, _ in needs))
+
+    return (
+        needs,
+        _plan_optimal if allocation == OPTIMAL_ALLOCATION else _plan,
+        lambda engine: engine.mci_candidates(donor_types),
+        # expires_at is donation_date shifted by a constant, and it is indexed
+        lambda: _candidates(
+            OutstandingDonationsMCI,
+            donor_types,
+            order_by=("expires_at", "donation_id")
+        )
+    )
+
+
+def _plan_allocation(
+        needs: List[Tuple[str, int]],
+        plan: Callable[..., Tuple[List[Tuple[int, str, int]], List[Tuple[str, int]]]],
+        memory_candidates: Callable[[inventory.InventoryEngine], List[Candidate]],
+        database_candidates: Callable[[], List[Candidate]]
+) -> Tuple[List[Tuple[int, str, int]], bool]:
+    """
+    The issues covering needs and whether they were planned from the in-memory inventory.
+    Raises CanNotFulfill when the outstanding units don't cover them.
+    """
+    engine = inventory.get_engine()
+
+    if engine is not None:
+        issues, missing_units = plan(needs, memory_candidates(engine))
+
+        if not missing_units and engine.check(issues):
+            return issues, True
+
+    # the in-memory copy may lag behind other workers, the database has the final say
+    issues, missing_units = plan(needs, database_candidates())
+
     if missing_units:
         raise CanNotFulfill(missing_units)
+
+    return issues, False
+
+
+def _taken(issues: List[Tuple[int, str, int]], in_memory: bool):
+    engine = inventory.get_engine()
+
+    if engine is None:
+        return
+
+    if in_memory:
+        engine.consume(issues)
+    else:
+        engine.invalidate()
+
+
+def _fill(request: IssueRequest, allocation: Allocation):
+    issues, in_memory = _plan_allocation(*allocation)
+    _issue(request, issues)
+    _taken(issues, in_memory)
+
+
+@metrics.timed
+def fill_single_request(single_request: SingleRequest):
+    _fill(
+        single_request,
+        _single_allocation(single_request.patient.blood_type, single_request.units)
+    )
+
+
+@metrics.timed
+def fill_mci_request(request: MCIRequest):
+    _fill(request, _mci_allocation(request.distribution, request.units, request.allocation))
+
+
+def hold_ttl() -> timedelta:
+    return timedelta(seconds=settings.BLOOD_HOLD_SECONDS)
+
+
+def release_expired_holds(now: Optional[datetime] = None) -> int:
+    """
+    Delete the reservations expired by now, their held units are outstanding again. Allocations
+    call this under the write lock, so holds past their time never keep units from them.
+    Returns the number of reservations released.
+    """
+    # usually there are none, one indexed read on the allocation path
+    expired = list(Reservation.objects.filter(expires_at__lte=now or timezone.now())
+                   .values_list("id", flat=True))
+
+    if expired:
+        # one statement for the holds, the collector would select them first
+        Hold.objects.filter(reservation_id__in=expired).delete()
+        Reservation.objects.filter(id__in=expired).delete()
+
+    return len(expired)
+
+
+def _reserve(reservation: Reservation, allocation: Allocation) -> Reservation:
+    lock_inventory()
+    release_expired_holds()
+
+    # a user confirms one request at a time, reloading the confirmation replaces its holds
+    if reservation.user is not None:
+        Reservation.objects.filter(
+            user=reservation.user,
+            patient=reservation.patient,
+            distribution=reservation.distribution
+        ).delete()
+
+    issues, in_memory = _plan_allocation(*allocation)
+
+    reservation.expires_at = timezone.now() + hold_ttl()
+    reservation.save()
+
+    Hold.objects.bulk_create([
+        Hold(reservation=reservation, donation_id=donation_id,
+             request_blood_type=request_blood_type, units=units)
+        for donation_id, request_blood_type, units in issues
+    ])
+    _taken(issues, in_memory)
+
+    return reservation
+
+
+def live_reservation(user, **request) -> Optional[Reservation]:
+    """
+    The user's unexpired reservation for request (its patient or distribution and units), which
+    a reloaded confirmation shows again instead of holding the units anew.
+    """
+    if user is None:
+        return None
+
+    return Reservation.objects \
+        .filter(user=user, expires_at__gt=timezone.now(), **request) \
+        .order_by("-id") \
+        .first()
+
+
+@transaction.atomic
+def reserve_single_request(patient: Patient, units: int, user=None) -> Reservation:
+    """
+    Hold the units a single request would be issued for BLOOD_HOLD_SECONDS, committed by
+    fill_or_reject_single_request with the reservation's id. Raises CanNotFulfill when the
+    outstanding units don't cover the request.
+    """
+    return _reserve(
+        Reservation(user=user, patient=patient, units=units),
+        _single_allocation(patient.blood_type, units)
+    )
+
+
+@transaction.atomic
+def reserve_mci_request(distribution: BloodTypeDistribution, units: int,
+                        allocation: str = GREEDY_ALLOCATION, user=None) -> Reservation:
+    """
+    As reserve_single_request, for an MCI request.
+    """
+    return _reserve(
+        Reservation(user=user, distribution=distribution, units=units, allocation=allocation),
+        _mci_allocation(distribution, units, allocation)
+    )
+
+
+def _take_reservation(reservation_id: Optional[int], user, needs: List[Tuple[str, int]],
+                      **request) -> Optional[List[Tuple[int, str, int]]]:
+    """
+    Release a live reservation the user made for request, returning its holds as planned issues.
+    None when it expired, was taken already or was made by another user or for another request,
+    or when its holds no longer cover needs exactly with donations that are live and compatible
+    (the patient's blood type or the distribution changed meanwhile); the request is then
+    allocated from scratch.
+    """
+    if reservation_id is None:
+        return None
+
+    now = timezone.now()
+    reservation = Reservation.objects \
+        .filter(id=reservation_id, user=user, expires_at__gt=now, **request) \
+        .first()
+
+    if reservation is None:
+        return None
+
+    issues = list(reservation.hold_set.values_list("donation_id", "request_blood_type", "units"))
+    reservation.delete()
+
+    held: Dict[str, int] = {}
+    for _, request_blood_type, units in issues:
+        held[request_blood_type] = held.get(request_blood_type, 0) + units
+
+    needed: Dict[str, int] = {}
+    for blood_type, units in needs:
+        if units > 0:
+            needed[blood_type] = needed.get(blood_type, 0) + units
+
+    if held != needed:
+        return None
+
+    donor_types = dict(
+        RemainingUnits.objects
+        .filter(donation_id__in={donation_id for donation_id, _, _ in issues}, expires_at__gt=now)
+        .values_list("donation_id", "blood_type")
+    )
+
+    if not all(donor_types.get(donation_id) in CAN_RECEIVE[request_blood_type]
+               for donation_id, request_blood_type, _ in issues):
+        return None
+
+    return issues
+
+
+class MCIOrderOutcome(NamedTuple):
+    status: str
+    request: Optional[MCIRequest]
+    reject: Optional[Reject]
+    missing_units: List[Tuple[str, int]]
+
+
+def _order_keys(idempotency_key: Optional[str], count: int) -> List[Optional[str]]:
+    return [f"{idempotency_key}:{i}" if idempotency_key is not None else None
+            for i in range(count)]
+
+
+def batch_payload(orders: Sequence[Tuple[BloodTypeDistribution, int]], allocation: str,
+                  allow_partial: bool) -> str:
+    """
+    Digest of a batch's orders and options, stored with its idempotency key.
+    """
+    return hashlib.sha256(json.dumps([
+        [[distribution.id, units] for distribution, units in orders],
+        allocation,
+        allow_partial
+    ]).encode()).hexdigest()
+
+
+def replay_mci_batch(
+        idempotency_key: Optional[str],
+        orders: Sequence[Tuple[BloodTypeDistribution, int]],
+        allocation: str = GREEDY_ALLOCATION,
+        allow_partial: bool = False
+) -> Optional[List[MCIOrderOutcome]]:
+    """
+    The outcomes of an earlier batch submitted with this key, each order's request and reject
+    carry the key and the order's position. Raises BatchConflict when the key was used for a
+    batch with other orders or options.
+    """
+    if idempotency_key is None:
+        return None
+
+    batch = MCIBatch.objects.filter(idempotency_key=idempotency_key).first()
+    if batch is not None and batch.payload != batch_payload(orders, allocation, allow_partial):
+        raise BatchConflict()
+
+    # one position more tells a longer batch submitted before batches were stored
+    keys = _order_keys(idempotency_key, len(orders) + 1)
+    requests = {
+        request.idempotency_key: request
+        for request in MCIRequest.objects.filter(idempotency_key__in=keys)
+    }
+    rejects = {
+        reject.idempotency_key: reject
+        for reject in Reject.objects.filter(idempotency_key__in=keys)
+        .prefetch_related("rejecttype_set")
+    }
+
+    if batch is None and not requests and not rejects:
+        return None
+
+    if keys[-1] in requests or keys[-1] in rejects:
+        raise BatchConflict()
+
+    outcomes = []
+    for key in keys[:-1]:
+        request, reject = requests.get(key), rejects.get(key)
+
+        if request is None and reject is None:
+            # a shorter batch
+            raise BatchConflict()
+
+        if reject is None:
+            outcomes.append(MCIOrderOutcome(FILLED, request, None, []))
+        else:
+            outcomes.append(MCIOrderOutcome(
+                PARTIAL if request is not None else REJECTED,
+                request,
+                reject,
+                [(reject_type.blood_type, reject_type.units)
+                 for reject_type in reject.rejecttype_set.all()]
+            ))
+
+    return outcomes
+
+
+def _plan_batch(
+        needs: List[List[Tuple[str, int]]],
+        candidates: List[Candidate],
+        plan: Callable[..., Tuple[List[Tuple[int, str, int]], List[Tuple[str, int]]]],
+        allow_partial: bool
+) -> List[Tuple[List[Tuple[int, str, int]], List[Tuple[str, int]]]]:
+    """
+    (issues, missing_units) of every order's needs in turn, each planned against what the
+    previous ones left of the candidates.
+    """
+    remaining = {donation_id: units for donation_id, _, units, _ in candidates}
+
+    planned = []
+    for order_needs in needs:
+        issues, missing_units = plan(order_needs, [
+            (donation_id, donor_type, remaining[donation_id], expiring)
+            for donation_id, donor_type, _, expiring in candidates
+            if remaining[donation_id] > 0
+        ])
+
+        if missing_units and not (allow_partial and issues):
+            issues = []
+
+        for donation_id, _, units in issues:
+            remaining[donation_id] -= units
+
+        planned.append((issues, missing_units))
+
+    return planned
+
+
+@metrics.timed
+@transaction.atomic
+def fill_mci_batch(
+        orders: Sequence[Tuple[BloodTypeDistribution, int]],
+        allocation: str = GREEDY_ALLOCATION,
+        allow_partial: bool = False,
+        idempotency_key: Optional[str] = None
+) -> List[MCIOrderOutcome]:
+    """
+    Allocate several (distribution, units) MCI orders in one transaction from a single read of
+    the inventory, the in-memory one when the engine is enabled. Orders are served in the given
+    order, each planned against what the previous ones left.
+
+    An order that can't be covered completely is rejected, or with allow_partial issued whatever
+    is available and rejected for the rest. A batch submitted again with the same
+    idempotency_key gets the outcomes of the first submission back, a different batch with it
+    raises BatchConflict.
+    """
+    lock_inventory()
+    release_expired_holds()
+
+    previous = replay_mci_batch(idempotency_key, orders, allocation, allow_partial)
+    if previous is not None:
+        return previous
+
+    if idempotency_key is not None:
+        MCIBatch.objects.create(idempotency_key=idempotency_key, orders=len(orders),
+                                payload=batch_payload(orders, allocation, allow_partial))
+
+    plan = _plan_optimal if allocation == OPTIMAL_ALLOCATION else _plan
+    needs = [distribution.blood_types(units) for distribution, units in orders]
+    donor_types = set().union(
+        *(CAN_RECEIVE[blood_type] for order_needs in needs for blood_type, _ in order_needs)
+    )
+
+    engine = inventory.get_engine()
+    in_memory = False
+
+    if engine is not None:
+        # as in _plan_allocation, the copy is trusted for a batch it covers completely and the
+        # ledger confirms
+        planned = _plan_batch(needs, engine.mci_candidates(donor_types), plan, allow_partial)
+        in_memory = not any(missing_units for _, missing_units in planned) and \
+            engine.check([issue for issues, _ in planned for issue in issues])
+
+    if not in_memory:
+        candidates = _candidates(
+            OutstandingDonationsMCI,
+            donor_types,
+            order_by=("expires_at", "donation_id")
+        )
+        planned = _plan_batch(needs, candidates, plan, allow_partial)
+
+    keys = _order_keys(idempotency_key, len(orders))
+
+    requests = []
+    for (distribution, units), (issues, missing_units), key in zip(orders, planned, keys):
+        if issues or not missing_units:
+            request = MCIRequest(distribution=distribution, units=units, allocation=allocation,
+                                 idempotency_key=key)
+            request.save()
+            requests.append(request)
+        else:
+            requests.append(None)
+
+    _issue_many([
+        (request, issues)
+        for request, (issues, _) in zip(requests, planned)
+        if request is not None
+    ])
+    _taken([issue for issues, _ in planned for issue in issues], in_memory)
+
+    rejects = iter(_save_rejects(
+        MCIRequest,
+        [missing_units for _, missing_units in planned if missing_units],
+        [key for (_, missing_units), key in zip(planned, keys) if missing_units]
+    ))
+
+    outcomes = []
+    for request, (_, missing_units) in zip(requests, planned):
+        if not missing_units:
+            outcomes.append(MCIOrderOutcome(FILLED, request, None, []))
+        else:
+            outcomes.append(MCIOrderOutcome(
+                PARTIAL if request is not None else REJECTED,
+                request,
+                next(rejects),
+                missing_units
+            ))
+
+    return outcomes
@@ -0,0 +1,178 @@
+"""
+Expiry forecast: the outstanding units expected to expire unused over the next days if units
+keep being issued at their recent rate, so they can be used or moved while there is time.
+
+The units per blood type and expiry day come from blood_stock_totals, which the ledger triggers
+keep current, in a single read. Issue rates are the units issued from each blood type over the
+last whole days and only change daily. The forecast is cached per process on the inventory
+version like the stock totals, so page views only read the version.
+"""
+from datetime import date, datetime, time, timedelta
+import threading
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Min, Sum
+from django.utils import timezone
+
+from blood.blood_types import AVAILABLE_TYPES
+from blood.models import InventoryVersion, Issue, IssueArchive, RemainingUnits, StockTotal
+
+
+class Forecast(NamedTuple):
+    key: Tuple[int, int, date]
+    days: List[date]
+    # rows of {"blood_type", "issued_per_day", "outstanding", "expiring"} in AVAILABLE_TYPES
+    # order, expiring being the units expected to expire unused on each of the days
+    blood_types: List[Dict]
+    # rows of {"blood_type", "expires_on", "units", "at_risk"} by expiry day, for the buckets
+    # with units expected to expire unused
+    at_risk: List[Dict]
+    valid_until: datetime
+    etag: str
+
+
+def _start_of(day: date, now: datetime) -> datetime:
+    return datetime.combine(day, time.min, tzinfo=now.tzinfo)
+
+
+def issue_rates(today: date, now: datetime) -> Dict[str, float]:
+    """
+    Units issued per day from each blood type over the BLOOD_FORECAST_RATE_DAYS days before
+    today, archived issues included.
+    """
+    days = settings.BLOOD_FORECAST_RATE_DAYS
+    since, until = _start_of(today - timedelta(days=days), now), _start_of(today, now)
+    issued: Dict[str, int] = {}
+
+    for model in (Issue, IssueArchive):
+        for blood_type, units in model.objects \
+                .filter(request__request_time__gte=since, request__request_time__lt=until) \
+                .values("donation__donor__blood_type") \
+                .annotate(total=Sum("units")) \
+                .values_list("donation__donor__blood_type", "total"):
+            issued[blood_type] = issued.get(blood_type, 0) + units
+
+    return {blood_type: units / days for blood_type, units in issued.items()}
+
+
+def _buckets(today: date, last: date, now: datetime) -> Dict[Tuple[str, date], int]:
+    tomorrow = _start_of(today + timedelta(days=1), now)
+    buckets: Dict[Tuple[str, date], int] = {}
+
+    for blood_type, expires_on, units in StockTotal.objects \
+            .filter(expires_on__gt=today, expires_on__lte=last, units__gt=0) \
+            .values_list("blood_type", "expires_on", "units"):
+        buckets[(blood_type, expires_on)] = units
+
+    # today's bucket is partly expired, count its rows exactly like the stock totals do
+    for blood_type, units in RemainingUnits.objects \
+            .filter(units__gt=0, expires_at__gt=now, expires_at__lt=tomorrow) \
+            .values("blood_type") \
+            .annotate(total=Sum(F("units") - F("held"))) \
+            .values_list("blood_type", "total"):
+        if units > 0:
+            buckets[(blood_type, today)] = units
+
+    return buckets
+
+
+def project(buckets: List[int], issued_per_day: float, first_day: float = 1.0) -> List[float]:
+    """
+    Units expected to expire unused on each day, buckets being the units expiring on each day,
+    if issued_per_day are issued every day (first_day of it on the first) from the units
+    expiring first. Issuing doesn't follow expiry that strictly, this is the least that expires.
+    """
+    remaining = [float(units) for units in buckets]
+    expiring = []
+    oldest = 0
+
+    for day in range(len(remaining)):
+        demand = issued_per_day * (first_day if day == 0 else 1.0)
+
+        while demand > 0 and oldest < len(remaining):
+            taken = min(demand, remaining[oldest])
+            remaining[oldest] -= taken
+            demand -= taken
+
+            if remaining[oldest] <= 0:
+                oldest += 1
+
+        expiring.append(remaining[day])
+        remaining[day] = 0.0
+        oldest = max(oldest, day + 1)
+
+    return expiring
+
+
+def _compute(version: int, epoch: int, now: datetime, rates: Dict[str, float]) -> Forecast:
+    today = now.date()
+    days = [today + timedelta(days=i) for i in range(settings.BLOOD_FORECAST_DAYS)]
+    tomorrow = _start_of(today + timedelta(days=1), now)
+    buckets = _buckets(today, days[-1], now)
+    first_day = (tomorrow - now) / timedelta(days=1)
+
+    blood_types = []
+    at_risk = []
+    for blood_type in AVAILABLE_TYPES:
+        units = [buckets.get((blood_type, day), 0) for day in days]
+        expiring = [round(lost) for lost in project(units, rates.get(blood_type, 0.0), first_day)]
+
+        blood_types.append({
+            "blood_type": blood_type,
+            "issued_per_day": round(rates.get(blood_type, 0.0), 1),
+            "outstanding": sum(units),
+            "expiring": expiring
+        })
+
+        at_risk.extend(
+            {"blood_type": blood_type, "expires_on": day, "units": bucket, "at_risk": lost}
+            for day, bucket, lost in zip(days, units, expiring)
+            if lost > 0
+        )
+
+    # today's bucket shrinks as its donations expire, and the days move at midnight
+    next_expiry = RemainingUnits.objects \
+        .filter(units__gt=0, expires_at__gt=now, expires_at__lt=tomorrow) \
+        .aggregate(next_expiry=Min("expires_at"))["next_expiry"]
+    valid_until = min(next_expiry, tomorrow) if next_expiry else tomorrow
+
+    return Forecast(
+        key=(version, epoch, today),
+        days=days,
+        blood_types=blood_types,
+        at_risk=sorted(at_risk, key=lambda row: (row["expires_on"], -row["at_risk"])),
+        valid_until=valid_until,
+        etag=f"{version}.{epoch}.{int(valid_until.timestamp())}"
+    )
+
+
+_cached: Optional[Forecast] = None
+_rates: Optional[Tuple[date, Dict[str, float]]] = None
+_lock = threading.Lock()
+
+
+def forecast() -> Forecast:
+    """
+    The expiry forecast for the next BLOOD_FORECAST_DAYS days. Costs one read of the inventory
+    version while nothing changed, is recomputed from the stock totals when donations or issues
+    change the ledger, and the issue rates are read again once a day.
+    """
+    global _cached, _rates
+
+    with transaction.atomic():
+        version, epoch = InventoryVersion.current()
+        now = timezone.now()
+        cached = _cached
+
+        if cached is not None and cached.key == (version, epoch, now.date()) and \
+                now < cached.valid_until:
+            return cached
+
+        with _lock:
+            if _rates is None or _rates[0] != now.date():
+                _rates = (now.date(), issue_rates(now.date(), now))
+
+            _cached = _compute(version, epoch, now, _rates[1])
+            return _cached
@@ -1,7 +1,12 @@
+from datetime import timedelta
+
 from django import forms
+from django.core.exceptions import ValidationError
+from django.utils import timezone
 
-from blood import models
-from blood.blood_types import AVAILABLE_TYPES_CHOICES
+from blood import models, rollup
+from blood.blood_types import ALLOCATION_CHOICES, AVAILABLE_TYPES, AVAILABLE_TYPES_CHOICES, \
+    GREEDY_ALLOCATION, MAX_BLOOD_AGE_DAYS
 
 
 class IdSearch(forms.Form):
@@ -21,10 +26,126 @@ class AcceptDonation(PatientDetails):
     units = forms.IntegerField(required=True)
 
 
+class ImportedDonation(AcceptDonation):
+    """
+    A row of a blood drive import: the donation form, the donor's id number and the time the
+    donation was collected.
+    """
+    id_number = forms.RegexField(required=True, regex="^\\d{10}$")
+    units = forms.IntegerField(required=True, min_value=1)
+    donation_date = forms.DateTimeField(required=True)
+
+    def validate(self, data) -> bool:
+        """
+        Bind the form to another row and validate it. A new form copies all of its fields,
+        a bulk import validates every row with the same form instead.
+        """
+        self.data = data
+        self.is_bound = True
+        self._errors = None
+
+        return self.is_valid()
+
+    def clean_donation_date(self):
+        donation_date = self.cleaned_data["donation_date"]
+
+        if donation_date > timezone.now():
+            raise ValidationError("Donation date is in the future")
+
+        return donation_date
+
+
+class DonationImportForm(forms.Form):
+    file = forms.FileField(help_text="CSV with a header row, or NDJSON, one donation per row")
+    format = forms.ChoiceField(choices=[("", "From the file name"), ("csv", "CSV"),
+                                        ("ndjson", "NDJSON")], required=False)
+
+
 class SingleRequestForm(PatientDetails):
     units = forms.IntegerField(required=True)
 
 
+class DistributionChoiceField(forms.ModelChoiceField):
+    """
+    Resolves the submitted distribution to its leaf from the process cache instead of querying.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(models.BloodTypeDistribution.objects, **kwargs)
+
+    def to_python(self, value):
+        if value in self.empty_values:
+            return None
+
+        try:
+            return models.get_distribution(int(value))
+        except (ValueError, TypeError, models.BloodTypeDistribution.DoesNotExist):
+            raise ValidationError(
+                self.error_messages['invalid_choice'],
+                code='invalid_choice',
+                params={'value': value},
+            )
+
+
 class MCIRequestForm(forms.Form):
     units = forms.IntegerField(required=True)
-    distribution = forms.ModelChoiceField(models.BloodTypeDistribution.objects)
+    distribution = DistributionChoiceField()
+    allocation = forms.ChoiceField(choices=ALLOCATION_CHOICES, initial=GREEDY_ALLOCATION)
+    # set once per rendered form, a resubmission replays the first allocation
+    idempotency_key = forms.CharField(required=False, max_length=64, widget=forms.HiddenInput)
+    # from mci_request/reserve, the units it holds are issued without planning again
+    reservation = forms.IntegerField(required=False, widget=forms.HiddenInput)
+
+
+class MCIBatchForm(forms.Form):
+    allocation = forms.ChoiceField(choices=ALLOCATION_CHOICES, required=False)
+    allow_partial = forms.BooleanField(required=False)
+
+
+class MCIBatchOrderForm(forms.Form):
+    units = forms.IntegerField(required=True, min_value=1)
+    distribution = DistributionChoiceField()
+
+
+class InventoryHistoryForm(forms.Form):
+    # days a request may span per resolution, bounding the rows it reads and returns
+    MAX_DAYS = {rollup.HOURLY: 31, rollup.DAILY: 3660}
+
+    since = forms.DateTimeField(required=False, help_text="Default 30 days before until")
+    until = forms.DateTimeField(required=False, help_text="Exclusive, default now")
+    blood_type = forms.MultipleChoiceField(choices=AVAILABLE_TYPES_CHOICES, required=False,
+                                           help_text="All blood types if none")
+    resolution = forms.ChoiceField(choices=[(rollup.DAILY, "Daily"), (rollup.HOURLY, "Hourly")],
+                                   required=False)
+
+    def clean(self):
+        data = super().clean()
+
+        until = data.get("until") or timezone.now()
+        since = data.get("since") or until - timedelta(days=30)
+        resolution = data.get("resolution") or rollup.DAILY
+
+        if since >= until:
+            raise ValidationError("since must be before until")
+
+        if until - since > timedelta(days=self.MAX_DAYS[resolution]):
+            raise ValidationError(
+                f"At most {self.MAX_DAYS[resolution]} days at this resolution"
+            )
+
+        selected = data.get("blood_type")
+        data.update(
+            since=since,
+            until=until,
+            resolution=resolution,
+            blood_type=[blood_type for blood_type in AVAILABLE_TYPES
+                        if not selected or blood_type in selected]
+        )
+        return data
+
+
+class SimulationForm(forms.Form):
+    distribution = DistributionChoiceField()
+    units = forms.IntegerField(required=True, min_value=0)
+    horizon = forms.IntegerField(required=True, min_value=0, max_value=MAX_BLOOD_AGE_DAYS,
+                                 initial=7, help_text="Days to project ahead")
@@ -0,0 +1,320 @@
+from bisect import bisect_right, insort
+from collections import defaultdict
+from datetime import datetime, timedelta
+from heapq import merge
+from math import inf
+import threading
+from time import monotonic
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from blood.blood_types import AVAILABLE_TYPES, HIGH_PRIORITY_DAYS, MAX_BLOOD_AGE_DAYS
+from blood.models import BloodRank, InventoryVersion, RemainingUnits
+
+# high_priority_at and expires_at are both fixed offsets from donation_date
+_HIGH_PRIORITY_BEFORE_EXPIRY = timedelta(days=MAX_BLOOD_AGE_DAYS - HIGH_PRIORITY_DAYS)
+
+Entry = Tuple[datetime, int]
+
+
+def _segment(queue: List[Entry], start: int,
+             blood_type: str) -> Iterator[Tuple[datetime, int, str]]:
+    for i in range(start, len(queue)):
+        expires_at, donation_id = queue[i]
+        yield expires_at, donation_id, blood_type
+
+
+class InventoryEngine:
+    """
+    In-process copy of the outstanding inventory, one priority queue per blood type ordered by
+    expiry, so allocations can be planned without querying the outstanding views.
+
+    The copy follows the database through InventoryVersion: every allocation first reads the
+    version and pulls only the ledger rows stamped with a newer one, which also picks up
+    donations written by other workers. Deleted rows, rolled back changes and the periodic
+    reconciliation reload the whole snapshot. The database stays authoritative, plans are
+    checked against the ledger before their issues are written.
+
+    Changes the copy takes from an open transaction, its own allocations and the rows it read,
+    wait for that transaction to commit. If it (or the savepoint they were made in) rolls back
+    instead, the copy is reloaded.
+    """
+
+    def __init__(self, reconcile_seconds: float):
+        self._lock = threading.RLock()
+        self._reconcile_seconds = reconcile_seconds
+
+        self._queues: Dict[str, List[Entry]] = {blood_type: [] for blood_type in AVAILABLE_TYPES}
+        self._entries: Dict[int, Tuple[str, Entry]] = {}
+        self._units: Dict[int, int] = {}
+        self._exhausted = 0
+        # blood_rank, which orders the blood types in the outstanding view
+        self._ranks: Dict[str, int] = {}
+
+        self._version: Optional[int] = None
+        self._epoch: Optional[int] = None
+        self._loaded_at = 0.0
+
+        # on_commit callbacks of the changes not known to be committed yet
+        self._uncommitted: List[Callable[[], None]] = []
+
+    def load(self):
+        """
+        Replace the in-memory copy with a consistent snapshot of the ledger.
+        """
+        with self._lock, transaction.atomic():
+            version, epoch = InventoryVersion.current()
+
+            self._queues = {blood_type: [] for blood_type in AVAILABLE_TYPES}
+            self._entries = {}
+            self._units = {}
+            self._exhausted = 0
+            self._ranks = dict(BloodRank.objects.values_list("blood_type", "rank"))
+
+            for donation_id, blood_type, units, held, expires_at in RemainingUnits.objects.filter(
+                    units__gt=0,
+                    expires_at__gt=timezone.now()
+            ).values_list("donation_id", "blood_type", "units", "held", "expires_at"):
+                entry = (expires_at, donation_id)
+                self._queues[blood_type].append(entry)
+                self._entries[donation_id] = (blood_type, entry)
+                # held units are counted as taken, like the outstanding views do
+                self._set_units(donation_id, units - held)
+
+            for queue in self._queues.values():
+                queue.sort()
+
+            self._version = version
+            self._epoch = epoch
+            self._loaded_at = monotonic()
+
+            self._uncommitted = []
+            self._changed()
+
+    def invalidate(self):
+        with self._lock:
+            self._version = None
+
+    def _changed(self):
+        # a callback per change, one made in a savepoint is dropped if that savepoint rolls back
+        def committed():
+            with self._lock:
+                if committed in self._uncommitted:
+                    self._uncommitted.remove(committed)
+
+        self._uncommitted.append(committed)
+        transaction.on_commit(committed)
+
+    def _rolled_back(self) -> bool:
+        """
+        Whether a change was rolled back: its callback neither ran nor awaits this connection's
+        commit. Allocations hold the write lock, the changes of other threads have committed
+        by then, unless their callbacks are about to run; that costs a reload at most.
+        """
+        if not self._uncommitted:
+            return False
+
+        awaiting = {entry[1] for entry in connection.run_on_commit}
+        return any(committed not in awaiting for committed in self._uncommitted)
+
+    def _set_units(self, donation_id: int, units: int):
+        previous = self._units.get(donation_id)
+
+        if previous is not None and previous <= 0:
+            self._exhausted -= 1
+
+        if units <= 0:
+            self._exhausted += 1
+
+        self._units[donation_id] = units
+
+    def _remove(self, donation_id: int):
+        blood_type, entry = self._entries.pop(donation_id)
+        self._queues[blood_type].remove(entry)
+
+        if self._units.pop(donation_id) <= 0:
+            self._exhausted -= 1
+
+    def _put(self, donation_id: int, blood_type: str, units: int, expires_at: datetime):
+        current = self._entries.get(donation_id)
+
+        if current is not None and current != (blood_type, (expires_at, donation_id)):
+            # blood type or donation date corrections, rare enough for a linear remove
+            self._remove(donation_id)
+            current = None
+
+        if current is None:
+            if units <= 0:
+                return
+
+            entry = (expires_at, donation_id)
+            insort(self._queues[blood_type], entry)
+            self._entries[donation_id] = (blood_type, entry)
+
+        self._set_units(donation_id, units)
+
+    def _prune(self, now: datetime):
+        for blood_type, queue in self._queues.items():
+            expired = bisect_right(queue, (now, inf))
+
+            for _, donation_id in queue[0:expired]:
+                del self._entries[donation_id]
+                if self._units.pop(donation_id) <= 0:
+                    self._exhausted -= 1
+
+            del queue[0:expired]
+
+        if self._exhausted > len(self._units) // 2:
+            for blood_type, queue in self._queues.items():
+                self._queues[blood_type] = [
+                    entry for entry in queue if self._units[entry[1]] > 0
+                ]
+
+            for donation_id in [d for d, units in self._units.items() if units <= 0]:
+                del self._units[donation_id]
+                del self._entries[donation_id]
+
+            self._exhausted = 0
+
+    def sync(self):
+        with self._lock:
+            if self._version is None or monotonic() - self._loaded_at > self._reconcile_seconds \
+                    or self._rolled_back():
+                self.load()
+                return
+
+            version, epoch = InventoryVersion.current()
+
+            if epoch != self._epoch or version < self._version:
+                # ledger rows were deleted, or changes this copy already saw were rolled back
+                self.load()
+                return
+
+            if version > self._version:
+                for donation_id, blood_type, units, held, expires_at in \
+                        RemainingUnits.objects.filter(version__gt=self._version).values_list(
+                            "donation_id", "blood_type", "units", "held", "expires_at"
+                        ):
+                    self._put(donation_id, blood_type, units - held, expires_at)
+
+                self._version = version
+                self._changed()
+
+            self._prune(timezone.now())
+
+    def single_candidates(self, blood_types: Iterable[str], limit: int) -> List[tuple]:
+        """
+        Candidates in the order of the blood_outstanding_donations view: donations that are not
+        yet high priority first, then by donor rank (blood_rank). Within a rank the view has no
+        order, the engine takes the oldest first.
+        """
+        with self._lock:
+            self.sync()
+
+            now = timezone.now()
+            boundary = (now + _HIGH_PRIORITY_BEFORE_EXPIRY, inf)
+            blood_types = sorted(blood_types, key=lambda blood_type: self._ranks[blood_type])
+
+            fresh = []
+            expiring = []
+            for blood_type in blood_types:
+                queue = self._queues[blood_type]
+                split = bisect_right(queue, boundary)
+
+                fresh.append((blood_type, queue, split, len(queue)))
+                expiring.append((blood_type, queue, bisect_right(queue, (now, inf)), split))
+
+            result = []
+            for is_expiring, segments in ((False, fresh), (True, expiring)):
+                for blood_type, queue, start, end in segments:
+                    for i in range(start, end):
+                        donation_id = queue[i][1]
+                        units = self._units[donation_id]
+
+                        if units > 0:
+                            result.append((donation_id, blood_type, units, is_expiring))
+
+                            if len(result) == limit:
+                                return result
+
+            return result
+
+    def mci_candidates(self, blood_types: Iterable[str]) -> List[tuple]:
+        """
+        Candidates of all the given blood types, oldest first.
+        """
+        with self._lock:
+            self.sync()
+
+            now = timezone.now()
+            boundary = now + _HIGH_PRIORITY_BEFORE_EXPIRY
+
+            segments = []
+            for blood_type in set(blood_types):
+                queue = self._queues[blood_type]
+                segments.append(_segment(queue, bisect_right(queue, (now, inf)), blood_type))
+
+            result = []
+            for expires_at, donation_id, blood_type in merge(*segments):
+                units = self._units[donation_id]
+
+                if units > 0:
+                    result.append((donation_id, blood_type, units, expires_at <= boundary))
+
+            return result
+
+    def check(self, issues: List[Tuple[int, str, int]]) -> bool:
+        """
+        Verify a plan against the ledger, invalidating the copy if it promised units that are no
+        longer there.
+        """
+        usage = defaultdict(int)
+        for donation_id, _, units in issues:
+            usage[donation_id] += units
+
+        available = dict(RemainingUnits.objects.filter(
+            donation_id__in=list(usage.keys()),
+            expires_at__gt=timezone.now()
+        ).annotate(available=F("units") - F("held")).values_list("donation_id", "available"))
+
+        if all(available.get(donation_id, 0) >= units for donation_id, units in usage.items()):
+            return True
+
+        self.invalidate()
+        return False
+
+    def consume(self, issues: List[Tuple[int, str, int]]):
+        # The next sync reads these rows back from the ledger, this only keeps other requests
+        # served in the meantime from planning the same units. Taken back by a reload if the
+        # allocation rolls back.
+        with self._lock:
+            for donation_id, _, units in issues:
+                if donation_id in self._units:
+                    self._set_units(donation_id, self._units[donation_id] - units)
+
+            self._changed()
+
+
+_engine: Optional[InventoryEngine] = None
+_engine_lock = threading.Lock()
+
+
+def get_engine() -> Optional[InventoryEngine]:
+    """
+    The process wide engine, or None unless BLOOD_INVENTORY_ENGINE is enabled.
+    """
+    global _engine
+
+    if not settings.BLOOD_INVENTORY_ENGINE:
+        return None
+
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = InventoryEngine(settings.BLOOD_INVENTORY_RECONCILE_SECONDS)
+
+    return _engine
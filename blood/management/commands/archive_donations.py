@@ -0,0 +1,54 @@
+from datetime import timedelta
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from blood.archive import archive_batch, count_candidates
+
+
+class Command(BaseCommand):
+    help = 'Moves expired and fully issued donations, with their issues, to the archive tables ' \
+           'in batches, each in its own short transaction'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Donations archived per transaction')
+        parser.add_argument('--issued-days', type=int, default=7,
+                            help='Only archive fully issued donations donated at least this many '
+                                 'days ago, issues corrected before then may give units back')
+        parser.add_argument('--expired-only', action='store_true',
+                            help='Leave fully issued donations that have not expired')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only count the donations and issues that would be archived')
+
+    def handle(self, *args, **kwargs):
+        now = timezone.now()
+        issued_before = now - timedelta(days=kwargs["issued_days"])
+
+        if kwargs["dry_run"]:
+            candidates = count_candidates(now, issued_before, kwargs["expired_only"])
+            self.stdout.write(
+                f"would archive {candidates.donations} donations and {candidates.issues} issues"
+            )
+            return
+
+        start = perf_counter()
+        donations = issues = 0
+
+        while True:
+            batch = archive_batch(now, issued_before, kwargs["batch_size"],
+                                  kwargs["expired_only"])
+            if batch.donations == 0:
+                break
+
+            donations += batch.donations
+            issues += batch.issues
+
+            if kwargs["verbosity"] > 1:
+                self.stdout.write(f"archived {donations} donations")
+
+        self.stdout.write(
+            f"archived {donations} donations and {issues} issues "
+            f"in {perf_counter() - start:.1f}s"
+        )
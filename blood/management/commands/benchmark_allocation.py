@@ -0,0 +1,132 @@
+from contextlib import nullcontext
+from datetime import date, timedelta
+from random import Random
+from time import perf_counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+import reversion
+
+from blood import blood_types, models
+from blood.audit import COMPACT_AUDIT, VERSION_AUDIT
+from blood.blood_types import GREEDY_ALLOCATION, OPTIMAL_ALLOCATION
+from blood.fill_request import CanNotFulfill, fill_mci_request, fill_single_request
+
+
+class Rollback(Exception):
+    pass
+
+
+def build_inventory(total: int, seed: int):
+    rnd = Random(seed)
+    now = timezone.now()
+
+    patients = [
+        models.Patient(
+            id=f"9{i:09d}",
+            first_name="Bench",
+            last_name=str(i),
+            birthday=date(1980, 1, 1),
+            blood_type=rnd.choice(blood_types.AVAILABLE_TYPES),
+            smokes=False,
+            phone_number=None
+        )
+        for i in range(total)
+    ]
+    models.Patient.objects.bulk_create(patients, batch_size=500)
+
+    donations = []
+    for patient in patients:
+        donation = models.Donation(donor=patient, units=rnd.randint(1, 3))
+        donation.donation_date = now - timedelta(
+            seconds=rnd.randrange(blood_types.MAX_BLOOD_AGE_DAYS * 24 * 60 * 60 - 3600)
+        )
+        donations.append(donation)
+
+    models.Donation.objects.bulk_create(donations, batch_size=500)
+
+    recipient = models.Patient(
+        id="8000000000",
+        first_name="Bench",
+        last_name="Recipient",
+        birthday=date(1980, 1, 1),
+        blood_type="AB+",
+        smokes=False
+    )
+    recipient.save()
+
+    return recipient, models.BloodTypeDistribution.objects.first().leaf
+
+
+class Command(BaseCommand):
+    help = 'Measures query count and wall-clock time of the allocation paths. ' \
+           'All data is created inside a transaction that is rolled back.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--donations', type=int, default=5000,
+                            help='Number of donations in the benchmark inventory')
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000],
+                            help='Request sizes (units) to measure')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--allocations', nargs='+', default=[GREEDY_ALLOCATION],
+                            choices=[GREEDY_ALLOCATION, OPTIMAL_ALLOCATION],
+                            help='MCI allocation modes to measure')
+        parser.add_argument('--without-revision', action='store_true',
+                            help='Do not wrap the allocation in a reversion revision')
+        parser.add_argument('--audit', choices=[VERSION_AUDIT, COMPACT_AUDIT],
+                            help='Audit mode to measure, BLOOD_AUDIT_MODE by default')
+
+    def measure(self, label: str, units: int, fill, with_revision: bool):
+        sid = transaction.savepoint()
+
+        with CaptureQueriesContext(connection) as queries:
+            start = perf_counter()
+            try:
+                with reversion.create_revision() if with_revision else nullcontext():
+                    fill()
+                outcome = "filled"
+            except CanNotFulfill:
+                outcome = "rejected"
+            elapsed = perf_counter() - start
+
+        transaction.savepoint_rollback(sid)
+
+        self.stdout.write(
+            f"{label:<12}{units:>8}{len(queries):>10}{elapsed * 1000:>12.1f}  {outcome}"
+        )
+
+    def handle(self, *args, **kwargs):
+        if kwargs["audit"]:
+            settings.BLOOD_AUDIT_MODE = kwargs["audit"]
+
+        try:
+            with transaction.atomic():
+                recipient, distribution = build_inventory(kwargs["donations"], kwargs["seed"])
+
+                self.stdout.write(f"{'path':<12}{'units':>8}{'queries':>10}{'ms':>12}")
+
+                for units in kwargs["sizes"]:
+                    single_request = models.SingleRequest(patient=recipient, units=units)
+                    single_request.save()
+
+                    self.measure("single", units, lambda: fill_single_request(single_request),
+                                 not kwargs["without_revision"])
+
+                    for allocation in kwargs["allocations"]:
+                        mci_request = models.MCIRequest(
+                            distribution=distribution,
+                            units=units,
+                            allocation=allocation
+                        )
+                        mci_request.save()
+
+                        self.measure(f"mci-{allocation}", units,
+                                     lambda: fill_mci_request(mci_request),
+                                     not kwargs["without_revision"])
+
+                raise Rollback()
+        except Rollback:
+            pass
@@ -0,0 +1,326 @@
+from contextlib import contextmanager
+import gc
+import json
+import os
+import platform
+from random import Random
+import shutil
+import sqlite3
+import tempfile
+from time import perf_counter
+from typing import Callable, Dict, List, Optional
+
+import django
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from django.utils import timezone
+import reversion
+
+from blood import blood_types, models
+from blood.fill_request import CanNotFulfill, fill_mci_request, fill_or_reject_single_request, \
+    fill_single_request
+
+# allocations kept in the dataset so the audit trail has revisions to export
+AUDIT_REVISIONS = 200
+
+BENCHMARK_USER = "benchmark"
+
+SINGLE_UNITS = 2
+MCI_UNITS = 20
+
+# (name, url name) of the views, requested by a superuser
+VIEWS = [
+    ("homepage", "homepage"),
+    ("show_outstanding", "outstanding"),
+    ("export_stats", "stats_export"),
+    ("export_audit_trail", "audit_export"),
+]
+
+# regressions are only flagged on these, the tail of a few samples is too noisy
+COMPARED = ("p50_ms", "p95_ms")
+
+
+class Rollback(Exception):
+    pass
+
+
+@contextmanager
+def _timed():
+    # like timeit, a garbage collection pass inside a sample would only add noise
+    gc.collect()
+    gc.disable()
+
+    try:
+        yield
+    finally:
+        gc.enable()
+
+
+def percentile(samples: List[float], percent: float) -> float:
+    # nearest rank
+    ordered = sorted(samples)
+    return ordered[max(0, min(len(ordered) - 1, round(percent / 100 * len(ordered)) - 1))]
+
+
+def summarize(times: List[float], queries: List[int]) -> Dict:
+    return {
+        "samples": len(times),
+        "p50_ms": percentile(times, 50) * 1000,
+        "p90_ms": percentile(times, 90) * 1000,
+        "p95_ms": percentile(times, 95) * 1000,
+        "p99_ms": percentile(times, 99) * 1000,
+        "max_ms": max(times) * 1000,
+        "mean_ms": sum(times) / len(times) * 1000,
+        "queries": max(queries),
+    }
+
+
+class Command(BaseCommand):
+    help = 'Builds benchmark datasets of each size in scratch databases and records latency ' \
+           'percentiles and query counts of the allocation and reporting paths as JSON, ' \
+           'optionally flagging regressions against a baseline'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000],
+                            help='Donations in each dataset')
+        parser.add_argument('--repeat', type=int, default=20, help='Samples per measurement')
+        parser.add_argument('--warmup', type=int, default=2,
+                            help='Unrecorded runs before the samples')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--cache-dir',
+                            help='Keep dataset snapshots here and restore them on later runs '
+                                 'instead of generating them again')
+        parser.add_argument('--output', help='Write the results to this JSON file')
+        parser.add_argument('--input',
+                            help='Compare the results in this JSON file instead of running')
+        parser.add_argument('--baseline', help='Results JSON to compare against')
+        parser.add_argument('--threshold', type=float, default=0.25,
+                            help='Relative slowdown of p50 or p95 flagged as a regression')
+        parser.add_argument('--noise-ms', type=float, default=1.0,
+                            help='Slowdowns smaller than this are never flagged')
+
+    def use_database(self, path: str):
+        connections.close_all()
+        connection.settings_dict["NAME"] = path
+
+    def build(self, size: int, seed: int, cache_dir: Optional[str]):
+        """
+        Fill the current, empty database with the dataset of the given size.
+        """
+        snapshot = os.path.join(cache_dir, f"bench-{size}-{seed}.sqlite3") if cache_dir else None
+
+        if snapshot and os.path.isfile(snapshot):
+            call_command("dataset_snapshot", "restore", snapshot, stdout=self.stdout)
+            return
+
+        start = perf_counter()
+        call_command("migrate", verbosity=0)
+        call_command("generate_donations", size, seed=seed, days=90, requests=size // 5,
+                     stdout=self.stdout)
+
+        user = User.objects.create_superuser(BENCHMARK_USER, "benchmark@example.com", None)
+        rnd = Random(seed)
+        recipients = list(models.Patient.objects.values_list("id", flat=True)[:1000])
+
+        for _ in range(AUDIT_REVISIONS):
+            with transaction.atomic(), reversion.create_revision():
+                reversion.set_user(user)
+                fill_or_reject_single_request(
+                    models.Patient.objects.get(id=rnd.choice(recipients)),
+                    rnd.randint(1, 4)
+                )
+
+        self.stdout.write(f"built {size} donations in {perf_counter() - start:.1f}s")
+
+        if snapshot:
+            os.makedirs(cache_dir, exist_ok=True)
+            call_command("dataset_snapshot", "export", snapshot, stdout=self.stdout)
+
+    def sample(self, run: Callable[[], None], repeat: int, warmup: int) -> Dict:
+        times, queries = [], []
+
+        for i in range(warmup + repeat):
+            with _timed(), CaptureQueriesContext(connection) as captured:
+                start = perf_counter()
+                run()
+                elapsed = perf_counter() - start
+
+            if i >= warmup:
+                times.append(elapsed)
+                queries.append(len(captured))
+
+        return summarize(times, queries)
+
+    def sample_fill(self, make_request: Callable[[], models.IssueRequest],
+                    fill: Callable[[models.IssueRequest], None], repeat: int,
+                    warmup: int) -> Dict:
+        """
+        Time fill alone, each run in a transaction that is rolled back so every run sees the
+        same inventory.
+        """
+        times, queries = [], []
+
+        for i in range(warmup + repeat):
+            try:
+                with transaction.atomic():
+                    request = make_request()
+
+                    with _timed(), CaptureQueriesContext(connection) as captured:
+                        start = perf_counter()
+                        try:
+                            fill(request)
+                        except CanNotFulfill:
+                            pass
+                        elapsed = perf_counter() - start
+
+                    raise Rollback()
+            except Rollback:
+                pass
+
+            if i >= warmup:
+                times.append(elapsed)
+                queries.append(len(captured))
+
+        return summarize(times, queries)
+
+    def run_cases(self, seed: int, repeat: int, warmup: int) -> Dict[str, Dict]:
+        rnd = Random(seed)
+        recipients = list(models.Patient.objects.all()[:1000])
+        distribution = models.get_distribution(
+            models.BloodTypeDistribution.objects.values_list("id", flat=True).first()
+        )
+        results = {}
+
+        results["fill_single_request"] = self.sample_fill(
+            lambda: models.SingleRequest.objects.create(patient=rnd.choice(recipients),
+                                                        units=SINGLE_UNITS),
+            fill_single_request,
+            repeat,
+            warmup
+        )
+
+        results["fill_mci_request"] = self.sample_fill(
+            lambda: models.MCIRequest.objects.create(distribution=distribution, units=MCI_UNITS,
+                                                     allocation=blood_types.GREEDY_ALLOCATION),
+            fill_mci_request,
+            repeat,
+            warmup
+        )
+
+        client = Client()
+        client.force_login(User.objects.get(username=BENCHMARK_USER))
+
+        for name, url_name in VIEWS:
+            url = reverse(url_name)
+
+            def get():
+                response = client.get(url)
+
+                if response.status_code != 200:
+                    raise CommandError(f"{url} answered {response.status_code}")
+
+                # streamed exports are only done once the whole body is read
+                if response.streaming:
+                    for _ in response.streaming_content:
+                        pass
+
+            results[name] = self.sample(get, repeat, warmup)
+
+        return results
+
+    def run(self, kwargs) -> Dict:
+        workdir = tempfile.mkdtemp(prefix="bloodline-bench-")
+        original = connection.settings_dict["NAME"]
+        datasets = {}
+
+        try:
+            with override_settings(ALLOWED_HOSTS=["testserver"]):
+                for size in kwargs["sizes"]:
+                    self.use_database(os.path.join(workdir, f"{size}.sqlite3"))
+                    self.build(size, kwargs["seed"], kwargs["cache_dir"])
+
+                    datasets[str(size)] = self.run_cases(kwargs["seed"], kwargs["repeat"],
+                                                         kwargs["warmup"])
+                    self.report(size, datasets[str(size)])
+        finally:
+            self.use_database(original)
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        return {
+            "meta": {
+                "created": timezone.now().isoformat(),
+                "python": platform.python_version(),
+                "django": django.get_version(),
+                "sqlite": sqlite3.sqlite_version,
+                "seed": kwargs["seed"],
+                "repeat": kwargs["repeat"],
+            },
+            "datasets": datasets,
+        }
+
+    def report(self, size: int, results: Dict[str, Dict]):
+        self.stdout.write(f"\n{size} donations")
+        self.stdout.write(
+            f"{'case':<22}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'queries':>9}"
+        )
+
+        for case, result in results.items():
+            self.stdout.write(
+                f"{case:<22}{result['p50_ms']:>10.1f}{result['p95_ms']:>10.1f}"
+                f"{result['p99_ms']:>10.1f}{result['max_ms']:>10.1f}{result['queries']:>9}"
+            )
+
+    def compare(self, results: Dict, baseline: Dict, threshold: float,
+                noise_ms: float) -> List[str]:
+        regressions = []
+
+        for size, cases in results["datasets"].items():
+            for case, result in cases.items():
+                before = baseline["datasets"].get(size, {}).get(case)
+                if before is None:
+                    continue
+
+                for metric in COMPARED:
+                    if result[metric] > before[metric] * (1 + threshold) and \
+                            result[metric] - before[metric] > noise_ms:
+                        regressions.append(
+                            f"{size} {case} {metric}: {before[metric]:.1f} -> "
+                            f"{result[metric]:.1f} "
+                            f"(+{(result[metric] / before[metric] - 1) * 100:.0f}%)"
+                        )
+
+                if result["queries"] > before["queries"]:
+                    regressions.append(
+                        f"{size} {case} queries: {before['queries']} -> {result['queries']}"
+                    )
+
+        return regressions
+
+    def handle(self, *args, **kwargs):
+        if kwargs["input"]:
+            with open(kwargs["input"]) as f:
+                results = json.load(f)
+        else:
+            results = self.run(kwargs)
+
+        if kwargs["output"]:
+            with open(kwargs["output"], "w") as f:
+                json.dump(results, f, indent=2)
+
+        if kwargs["baseline"]:
+            with open(kwargs["baseline"]) as f:
+                baseline = json.load(f)
+
+            regressions = self.compare(results, baseline, kwargs["threshold"],
+                                       kwargs["noise_ms"])
+
+            if regressions:
+                raise CommandError("Regressions against the baseline:\n" +
+                                   "\n".join(regressions))
+
+            self.stdout.write("No regressions against the baseline")
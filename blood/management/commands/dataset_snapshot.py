@@ -0,0 +1,77 @@
+import os
+import sqlite3
+from time import perf_counter
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connection
+
+from blood import models
+
+EXPORT = "export"
+RESTORE = "restore"
+
+
+class Command(BaseCommand):
+    help = 'Exports the database to a snapshot file, or restores it from one, with the SQLite ' \
+           'backup API. Recreates a generated benchmark dataset in seconds'
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=[EXPORT, RESTORE])
+        parser.add_argument('path', help='Snapshot file')
+
+    def export(self, path: str):
+        target = sqlite3.connect(path)
+
+        try:
+            connection.connection.backup(target)
+        finally:
+            target.close()
+
+    def restore(self, path: str):
+        if not os.path.isfile(path):
+            raise CommandError(f"No snapshot at {path}")
+
+        try:
+            _, epoch = models.InventoryVersion.current()
+            distribution_version = models.DistributionVersion.current()
+        except DatabaseError:
+            # restoring into an empty database
+            epoch = distribution_version = 0
+
+        source = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+
+        try:
+            source.backup(connection.connection)
+        finally:
+            source.close()
+
+        # processes caching inventory derived data by (version, epoch), or distributions by
+        # their version, must not mistake the restored rows for the ones they have seen
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "UPDATE blood_inventory_version SET epoch = MAX(epoch, %s) + 1 WHERE id = 1",
+                [epoch]
+            )
+            cursor.execute(
+                "UPDATE blood_distribution_version SET version = MAX(version, %s) + 1 "
+                "WHERE id = 1",
+                [distribution_version]
+            )
+
+        models.clear_distribution_cache()
+
+    def handle(self, *args, **kwargs):
+        if connection.vendor != "sqlite":
+            raise CommandError("Snapshots need the SQLite backend")
+
+        connection.ensure_connection()
+        start = perf_counter()
+
+        if kwargs["action"] == EXPORT:
+            self.export(kwargs["path"])
+        else:
+            self.restore(kwargs["path"])
+
+        self.stdout.write(
+            f"{kwargs['action']} of {kwargs['path']} in {perf_counter() - start:.1f}s"
+        )
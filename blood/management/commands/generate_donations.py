@@ -1,72 +1,291 @@
+import argparse
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from random import choice, randint, randrange
+import multiprocessing
+from random import Random
+from time import perf_counter
+from typing import List, Sequence, Tuple
 
+from django.contrib.contenttypes.models import ContentType
 from django.core.management.base import BaseCommand
-from django.db import transaction
-import faker
+from django.db import connection, connections, transaction
+from django.db.models import Max
+from django.utils import timezone
 
 from blood import blood_types, models
+from blood.synthetic import DatasetSpec, HistorySimulator, generate_chunk
 
+SINGLE_UNITS = (1, 4)
+MCI_UNITS = (10, 50)
 
-def random_date(start, end):
+
+def _type_weight(value: str) -> Tuple[str, float]:
+    blood_type, _, weight = value.partition("=")
+
+    if blood_type not in blood_types.AVAILABLE_TYPES:
+        raise argparse.ArgumentTypeError(f"unknown blood type {blood_type!r}")
+
+    try:
+        return blood_type, float(weight or 1)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid weight {weight!r}") from None
+
+
+def _until(value: str) -> datetime:
+    try:
+        until = datetime.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid date {value!r}") from None
+
+    return until if timezone.is_aware(until) else timezone.make_aware(until)
+
+
+@contextmanager
+def _page_cache(megabytes: int):
+    """
+    A larger SQLite page cache for the duration, random patient ids and the ledger triggers
+    touch index pages all over the database.
+    """
+    if connection.vendor != "sqlite":
+        yield
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute("PRAGMA cache_size")
+        previous = cursor.fetchone()[0]
+        cursor.execute(f"PRAGMA cache_size = {-megabytes * 1024}")
+
+    try:
+        yield
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute(f"PRAGMA cache_size = {int(previous)}")
+
+
+def _generate(args):
+    return generate_chunk(*args)
+
+
+def _insert(model, fields: Sequence[str], rows: List[tuple], batch_size: int,
+            ignore_conflicts: bool = False):
     """
-    This function will return a random datetime between two datetime
-    objects.
+    INSERT of already adapted rows, batch_size at a time. Unlike bulk_create it can insert
+    multi-table inherited requests and keeps the auto_now_add times of the history.
     """
-    delta = end - start
-    int_delta = (delta.days * 24 * 60 * 60) + delta.seconds
-    random_second = randrange(int_delta)
-    return start + timedelta(seconds=random_second)
+    quote = connection.ops.quote_name
+    columns = ", ".join(quote(model._meta.get_field(name).column) for name in fields)
+    sql = f"{connection.ops.insert_statement(ignore_conflicts=ignore_conflicts)} " \
+          f"{quote(model._meta.db_table)} ({columns}) " \
+          f"VALUES ({', '.join(['%s'] * len(fields))})"
+
+    with connection.cursor() as cursor:
+        for i in range(0, len(rows), batch_size):
+            cursor.executemany(sql, rows[i:i + batch_size])
 
 
 class Command(BaseCommand):
-    help = 'Displays current time'
+    help = 'Generates a reproducible synthetic dataset: patients with one donation each, and ' \
+           'optionally a history of single and MCI requests issued from those donations'
 
     def add_arguments(self, parser):
         parser.add_argument('total', type=int,
                             help='Indicates the number of donations to be created')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--batch-size', type=int, default=2000,
+                            help='Rows per bulk insert and per generated chunk')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Processes generating rows, the inserts stay in this one')
+        parser.add_argument('--type-mix', type=_type_weight, nargs='+', metavar='TYPE=WEIGHT',
+                            help='Relative weight of each donor blood type, e.g. O+=38 A+=34, '
+                                 'every type equally likely by default')
+        parser.add_argument('--days', type=float, default=12,
+                            help='Donation dates are spread evenly over this many days')
+        parser.add_argument('--until', type=_until,
+                            help='End of the donation date spread (ISO date), now by default')
+        parser.add_argument('--requests', type=int, default=0,
+                            help='Requests to replay over the generated donations')
+        parser.add_argument('--mci-share', type=float, default=0.1,
+                            help='Share of the requests that are MCI requests')
 
-    @transaction.atomic
-    def generate_donation(self):
-        id_number = choice("123456789")
-        for _ in range(0, 8):
-            id_number += choice("1234567890")
-
-        f = faker.Faker()
-
-        first_name, _, last_name = f.name().partition(" ")
-
-        phone_number = None
-        if randint(0, 10) < 8:
-            phone_number = choice(
-                ("054", "08", "03", "07", "02")
-            ) + "-" + choice("123456789")
-
-            for _ in range(0, 7):
-                phone_number += choice("1234567890")
-
-        p = models.Patient(
-            id=id_number,
-            first_name=first_name,
-            last_name=last_name,
-            blood_type=choice(blood_types.AVAILABLE_TYPES),
-            smokes=randint(0, 10) >= 8,
-            phone_number=phone_number,
-            birthday=f.date_of_birth()
-        )
+    def generate(self, results, batch_size: int) -> int:
+        # model instances cost more to build and compile than the inserts themselves, the rows
+        # go in as tuples with their expiry computed the way Donation.set_expiry does
+        high_priority = timedelta(days=blood_types.HIGH_PRIORITY_DAYS)
+        expiry = timedelta(days=blood_types.MAX_BLOOD_AGE_DAYS)
+        created = 0
+
+        for patients, donations in results:
+            # ids already taken keep their patient, the donation goes to them
+            _insert(
+                models.Patient,
+                ["id", "first_name", "last_name", "birthday", "blood_type", "smokes",
+                 "phone_number"],
+                [
+                    (id_number, first_name, last_name, str(birthday), blood_type, smokes,
+                     phone_number)
+                    for id_number, first_name, last_name, birthday, blood_type, smokes,
+                    phone_number in patients
+                ],
+                batch_size,
+                ignore_conflicts=True
+            )
+
+            rows = []
+            for donor_id, units, date in donations:
+                date = timezone.make_naive(date, timezone.utc)
+                rows.append((donor_id, units, str(date), str(date + high_priority),
+                             str(date + expiry)))
+
+            _insert(
+                models.Donation,
+                ["donor", "units", "donation_date", "high_priority_at", "expires_at"],
+                rows,
+                batch_size
+            )
+
+            created += len(donations)
 
-        p.save()
+        return created
 
-        d = models.Donation(
-            donor=p,
-            units=randint(1, 3),
-            donation_date=random_date(datetime.now() - timedelta(days=12), datetime.now())
+    def replay(self, spec: DatasetSpec, donations: List[tuple], kwargs) -> Tuple[int, int]:
+        rnd = Random(spec.seed)
+        batch_size = kwargs["batch_size"]
+        adapt = connection.ops.adapt_datetimefield_value
+
+        simulator = HistorySimulator([
+            (donation_id, blood_type, units, donation_date)
+            for donation_id, _, blood_type, units, donation_date in donations
+        ])
+        recipients = [(donor_id, blood_type) for _, donor_id, blood_type, _, _ in donations]
+
+        distributions = [
+            models.get_distribution(distribution_id)
+            for distribution_id in models.BloodTypeDistribution.objects.values_list("id",
+                                                                                   flat=True)
+        ]
+        mci_share = kwargs["mci_share"] if distributions else 0
+        if kwargs["mci_share"] and not distributions:
+            self.stderr.write("No blood type distributions, generating single requests only")
+
+        single_type = ContentType.objects.get_for_model(models.SingleRequest)
+        mci_type = ContentType.objects.get_for_model(models.MCIRequest)
+
+        # bulk inserts don't return ids, nobody else can write until this transaction ends
+        next_request = (models.IssueRequest.objects.aggregate(last=Max("id"))["last"] or 0) + 1
+        next_reject = (models.Reject.objects.aggregate(last=Max("id"))["last"] or 0) + 1
+
+        requests, singles, mcis, issues, rejects, reject_types = [], [], [], [], [], []
+
+        times = sorted(
+            spec.start + timedelta(seconds=rnd.randrange(max(spec.seconds, 1)))
+            for _ in range(kwargs["requests"])
         )
 
-        d.save()
+        for time in times:
+            simulator.advance(time)
+
+            if rnd.random() < mci_share:
+                distribution = rnd.choice(distributions)
+                units = rnd.randint(*MCI_UNITS)
+                demand = {}
+                for blood_type, type_units in distribution.blood_types(units):
+                    if type_units > 0:
+                        demand[blood_type] = demand.get(blood_type, 0) + type_units
+                request_type = mci_type
+            else:
+                recipient, blood_type = rnd.choice(recipients)
+                units = rnd.randint(*SINGLE_UNITS)
+                demand = {blood_type: units}
+                request_type = single_type
+
+            issued, missing = simulator.request(demand)
+
+            if missing:
+                rejects.append((next_reject, adapt(time), request_type.id))
+                reject_types.extend(
+                    (next_reject, blood_type, units) for blood_type, units in missing
+                )
+                next_reject += 1
+                continue
+
+            requests.append((next_request, request_type.id, adapt(time)))
+            if request_type == mci_type:
+                mcis.append((next_request, units, distribution.id,
+                             blood_types.GREEDY_ALLOCATION))
+            else:
+                singles.append((next_request, recipient, units))
+
+            issues.extend(
+                (next_request, donation_id, request_blood_type, units)
+                for donation_id, request_blood_type, units in issued
+            )
+            next_request += 1
+
+        _insert(models.IssueRequest, ["id", "content_type", "request_time"], requests, batch_size)
+        _insert(models.SingleRequest, ["issuerequest_ptr", "patient", "units"], singles,
+                batch_size)
+        _insert(models.MCIRequest, ["issuerequest_ptr", "units", "distribution", "allocation"],
+                mcis, batch_size)
+        _insert(models.Issue, ["request", "donation", "request_blood_type", "units"], issues,
+                batch_size)
+
+        _insert(models.Reject, ["id", "time", "request_type"], rejects, batch_size)
+        _insert(models.RejectType, ["reject", "blood_type", "units"], reject_types, batch_size)
+
+        return len(requests), len(rejects)
 
     def handle(self, *args, **kwargs):
-        donations = kwargs["total"]
+        type_mix = kwargs["type_mix"] or [(blood_type, 1)
+                                          for blood_type in blood_types.AVAILABLE_TYPES]
+        until = (kwargs["until"] or timezone.now()).astimezone(timezone.utc)
+        seconds = int(kwargs["days"] * 24 * 60 * 60)
+
+        spec = DatasetSpec(
+            seed=kwargs["seed"],
+            blood_types=[blood_type for blood_type, _ in type_mix],
+            weights=[weight for _, weight in type_mix],
+            start=until - timedelta(seconds=seconds),
+            seconds=seconds
+        )
+
+        total = kwargs["total"]
+        batch_size = kwargs["batch_size"]
+        chunks = [
+            (spec, chunk, first, min(batch_size, total - first))
+            for chunk, first in enumerate(range(0, total, batch_size))
+        ]
+
+        pool = None
+        if kwargs["workers"] > 1:
+            # forked workers must not share this process' database connection
+            connections.close_all()
+            pool = multiprocessing.Pool(kwargs["workers"])
+
+        start = perf_counter()
+
+        try:
+            with transaction.atomic(), _page_cache(256):
+                last_donation = models.Donation.objects.aggregate(last=Max("id"))["last"] or 0
+                created = self.generate(
+                    pool.imap(_generate, chunks) if pool else map(_generate, chunks),
+                    batch_size
+                )
+                self.stdout.write(f"{created} donations in {perf_counter() - start:.1f}s")
+
+                if kwargs["requests"]:
+                    donations = list(
+                        models.Donation.objects
+                        .filter(id__gt=last_donation)
+                        .values_list("id", "donor_id", "donor__blood_type", "units",
+                                     "donation_date")
+                    )
+                    filled, rejected = self.replay(spec, donations, kwargs)
 
-        for _ in range(1, donations):
-            self.generate_donation()
+                    self.stdout.write(
+                        f"{filled} requests filled, {rejected} rejected in "
+                        f"{perf_counter() - start:.1f}s"
+                    )
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
@@ -0,0 +1,60 @@
+import io
+import sys
+from time import perf_counter
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from blood.donation_import import CHUNK_SIZE, CSV, NDJSON, import_file, write_report
+
+
+class Command(BaseCommand):
+    help = 'Imports the donations collected at a blood drive from a CSV or NDJSON file, writing ' \
+           'the rows that could not be imported to an error report'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File to import, - for standard input')
+        parser.add_argument('--format', choices=[CSV, NDJSON],
+                            help='Defaults to NDJSON for .ndjson, .jsonl and .json files, CSV '
+                                 'otherwise')
+        parser.add_argument('--report', help='Write the rejected rows here as CSV instead of '
+                                             'to standard error')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                            help='Rows written per transaction')
+        parser.add_argument('--user', help='Username the revisions are recorded for')
+
+    def handle(self, *args, **kwargs):
+        user = None
+        if kwargs["user"]:
+            try:
+                user = User.objects.get(username=kwargs["user"])
+            except User.DoesNotExist:
+                raise CommandError(f"No user {kwargs['user']}")
+
+        path = kwargs["path"]
+
+        if path == "-":
+            stream = io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8-sig", newline="")
+        else:
+            try:
+                stream = open(path, encoding="utf-8-sig", newline="")
+            except OSError as e:
+                raise CommandError(f"Can't read {path}: {e}")
+
+        report = open(kwargs["report"], "w", newline="") if kwargs["report"] else self.stderr
+        start = perf_counter()
+
+        try:
+            result = import_file(stream, kwargs["format"], path, write_report(report),
+                                 chunk_size=kwargs["chunk_size"], user=user,
+                                 comment=f"Imported donations from {path}")
+        finally:
+            stream.close()
+            if report is not self.stderr:
+                report.close()
+
+        self.stdout.write(
+            f"{result.rows} rows, {result.donations} donations imported, "
+            f"{result.patients_created} patients created, {result.patients_updated} updated, "
+            f"{result.rejected} rows rejected in {perf_counter() - start:.1f}s"
+        )
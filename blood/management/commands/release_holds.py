@@ -0,0 +1,29 @@
+from time import sleep
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from blood.fill_request import lock_inventory, release_expired_holds
+
+
+class Command(BaseCommand):
+    help = 'Releases the units held by expired reservations. Allocations release them as well, ' \
+           'this keeps the outstanding units and stock totals current while none run'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Keep running, sweeping every this many seconds')
+
+    def handle(self, *args, **kwargs):
+        while True:
+            with transaction.atomic():
+                lock_inventory()
+                released = release_expired_holds()
+
+            if released or kwargs["verbosity"] > 1:
+                self.stdout.write(f"released {released} reservations")
+
+            if not kwargs["interval"]:
+                break
+
+            sleep(kwargs["interval"])
@@ -0,0 +1,47 @@
+from time import perf_counter, sleep
+
+from django.core.management.base import BaseCommand
+
+from blood import rollup
+
+
+class Command(BaseCommand):
+    help = 'Brings the hourly inventory rollups up to the last complete hour, a week of hours ' \
+           'per transaction. With --backfill they are recomputed from the first donation'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backfill', action='store_true',
+                            help='Drop the rollups and recompute them from the start')
+        parser.add_argument('--hours', type=int, default=rollup.MAX_HOURS,
+                            help='Hours rolled up per transaction')
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Keep running, rolling up every this many seconds')
+
+    def handle(self, *args, **kwargs):
+        if kwargs["backfill"]:
+            rollup.reset()
+
+        while True:
+            start = perf_counter()
+            hours = rows = 0
+
+            while True:
+                result = rollup.roll_up(max_hours=kwargs["hours"])
+                if result.start is None:
+                    break
+
+                hours += int((result.end - result.start).total_seconds()) // 3600
+                rows += result.rows
+
+                if kwargs["verbosity"] > 1:
+                    self.stdout.write(f"rolled up until {result.end.isoformat()}")
+
+            if hours or kwargs["verbosity"] > 1:
+                self.stdout.write(
+                    f"rolled up {hours} hours into {rows} rows in {perf_counter() - start:.1f}s"
+                )
+
+            if not kwargs["interval"]:
+                break
+
+            sleep(kwargs["interval"])
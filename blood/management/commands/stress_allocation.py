@@ -0,0 +1,174 @@
+import os
+from random import Random
+import shutil
+import tempfile
+import threading
+from time import perf_counter
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, transaction
+import reversion
+
+from blood import blood_types, models
+from blood.dispatcher import AllocationDispatcher
+from blood.fill_request import fill_or_reject_mci_request, fill_or_reject_single_request
+from blood.management.commands.benchmark_allocation import build_inventory
+
+# Donations that gave more units than they had, and ledger rows out of step with the issues
+_OVER_ISSUED = """
+SELECT COUNT(*)
+FROM blood_donation d
+JOIN (SELECT donation_id, SUM(units) AS issued FROM blood_issue GROUP BY donation_id) i
+    ON i.donation_id = d.id
+WHERE i.issued > d.units
+"""
+
+_LEDGER_MISMATCH = """
+SELECT COUNT(*)
+FROM blood_donation d
+JOIN blood_remaining_units r ON r.donation_id = d.id
+WHERE r.units <> d.units - COALESCE(
+    (SELECT SUM(units) FROM blood_issue WHERE donation_id = d.id), 0
+)
+"""
+
+
+class Command(BaseCommand):
+    help = 'Runs concurrent allocations against a scratch copy of the database and verifies ' \
+           'that no donation was over-issued, reporting throughput per number of clients'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, nargs='+', default=[1, 4, 16],
+                            help='Numbers of concurrent clients to measure')
+        parser.add_argument('--requests', type=int, default=400,
+                            help='Allocation requests per round, shared by all clients')
+        parser.add_argument('--donations', type=int, default=3000,
+                            help='Number of donations in the scratch inventory')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--batch-size', type=int,
+                            default=settings.BLOOD_ALLOCATION_BATCH_SIZE)
+        parser.add_argument('--inline', action='store_true',
+                            help='Allocate in the client threads instead of through the '
+                                 'dispatcher, for comparison')
+
+    def use_database(self, path: str):
+        connections.close_all()
+        connection.settings_dict["NAME"] = path
+
+    def build_template(self, path: str, donations: int, seed: int):
+        self.use_database(path)
+        call_command("migrate", verbosity=0)
+        build_inventory(donations, seed)
+        connections.close_all()
+
+    def run_round(self, clients: int, kwargs) -> dict:
+        recipients = list(models.Patient.objects.filter(first_name="Bench"))
+        distribution = models.BloodTypeDistribution.objects.first().leaf
+        dispatcher = None if kwargs["inline"] else AllocationDispatcher(kwargs["batch_size"])
+
+        remaining = [kwargs["requests"]]
+        counter_lock = threading.Lock()
+        outcomes = {"filled": 0, "rejected": 0, "failed": 0}
+
+        def allocate(rnd: Random):
+            if rnd.random() < 0.8:
+                return fill_or_reject_single_request, (rnd.choice(recipients), rnd.randint(1, 6))
+
+            return fill_or_reject_mci_request, (
+                distribution,
+                rnd.randint(10, 40),
+                rnd.choice([blood_types.GREEDY_ALLOCATION, blood_types.OPTIMAL_ALLOCATION])
+            )
+
+        def client(number: int):
+            rnd = Random(kwargs["seed"] * 1000 + number)
+
+            try:
+                while True:
+                    with counter_lock:
+                        if remaining[0] == 0:
+                            return
+                        remaining[0] -= 1
+
+                    fill, args = allocate(rnd)
+
+                    try:
+                        if dispatcher is None:
+                            with transaction.atomic(), reversion.create_revision():
+                                result = fill(*args)
+                        else:
+                            result = dispatcher.submit(fill, *args).result()
+
+                        outcome = "rejected" if isinstance(result, models.Reject) else "filled"
+                    except Exception:  # pylint: disable=broad-except
+                        outcome = "failed"
+
+                    with counter_lock:
+                        outcomes[outcome] += 1
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+
+        start = perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = perf_counter() - start
+
+        if dispatcher is not None:
+            dispatcher.shutdown()
+
+        with connection.cursor() as cursor:
+            cursor.execute(_OVER_ISSUED)
+            over_issued = cursor.fetchone()[0]
+            cursor.execute(_LEDGER_MISMATCH)
+            mismatched = cursor.fetchone()[0]
+
+        return dict(
+            outcomes,
+            rps=kwargs["requests"] / elapsed,
+            over_issued=over_issued,
+            mismatched=mismatched
+        )
+
+    def handle(self, *args, **kwargs):
+        original = connection.settings_dict["NAME"]
+        workdir = tempfile.mkdtemp(prefix="bloodline-stress-")
+        template = os.path.join(workdir, "template.sqlite3")
+        failures = []
+
+        try:
+            self.build_template(template, kwargs["donations"], kwargs["seed"])
+
+            self.stdout.write(
+                f"{'clients':>8}{'req/s':>10}{'filled':>8}{'rejected':>10}{'failed':>8}"
+                f"{'over-issued':>13}"
+            )
+
+            for clients in kwargs["clients"]:
+                path = os.path.join(workdir, f"round-{clients}.sqlite3")
+                shutil.copyfile(template, path)
+                self.use_database(path)
+
+                result = self.run_round(clients, kwargs)
+
+                self.stdout.write(
+                    f"{clients:>8}{result['rps']:>10.1f}{result['filled']:>8}"
+                    f"{result['rejected']:>10}{result['failed']:>8}{result['over_issued']:>13}"
+                )
+
+                if result["over_issued"] or result["mismatched"]:
+                    failures.append(
+                        f"{clients} clients: {result['over_issued']} over-issued donations, "
+                        f"{result['mismatched']} ledger rows out of step"
+                    )
+        finally:
+            self.use_database(original)
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        if failures:
+            raise CommandError("\n".join(failures))
@@ -0,0 +1,241 @@
+"""
+In-process metrics, exposed in the Prometheus text format at /metrics. Every process keeps its
+own values, scrape each worker process or run a single one.
+"""
+from bisect import bisect_left
+from collections import defaultdict
+from contextvars import ContextVar
+from functools import wraps
+import math
+import threading
+from time import perf_counter
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from django.db import transaction
+from django.template.backends.django import DjangoTemplates
+
+# Prometheus' default buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+
+_registry: List['_Metric'] = []
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _labels(self, values: Tuple[str, ...], extra: str = "") -> str:
+        pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError()
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.type}"
+        yield from self.samples()
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[Tuple[str, ...], float] = defaultdict(float)
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            self._values[labels] += amount
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+
+        for labels, value in values:
+            yield f"{self.name}{self._labels(labels)} {_format(value)}"
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets) + (math.inf,)
+        # per label values: observations per bucket, not cumulative, and their sum
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *labels: str):
+        index = bisect_left(self.buckets, value)
+
+        with self._lock:
+            if labels not in self._values:
+                self._values[labels] = ([0] * len(self.buckets), [0.0])
+
+            counts, total = self._values[labels]
+            counts[index] += 1
+            total[0] += value
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = sorted((labels, (list(counts), total[0]))
+                            for labels, (counts, total) in self._values.items())
+
+        for labels, (counts, total) in values:
+            cumulative = 0
+
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = 'le="' + _format(bound) + '"'
+                yield f"{self.name}_bucket{self._labels(labels, le)} {cumulative}"
+
+            yield f"{self.name}_sum{self._labels(labels)} {_format(total)}"
+            yield f"{self.name}_count{self._labels(labels)} {cumulative}"
+
+
+def render() -> str:
+    return "\n".join(line for metric in _registry for line in metric.render()) + "\n"
+
+
+REQUEST_SECONDS = Histogram(
+    "bloodline_request_duration_seconds",
+    "Time to answer a request, streamed bodies included",
+    ["view", "method"]
+)
+REQUEST_QUERIES = Counter(
+    "bloodline_request_db_queries_total",
+    "Database queries made while answering requests",
+    ["view"]
+)
+REQUEST_QUERY_SECONDS = Counter(
+    "bloodline_request_db_query_seconds_total",
+    "Time spent in database queries while answering requests",
+    ["view"]
+)
+TEMPLATE_SECONDS = Histogram(
+    "bloodline_template_render_seconds",
+    "Time to render the templates of a request",
+    ["view"]
+)
+UNITS_ISSUED = Counter(
+    "bloodline_units_issued_total",
+    "Units issued, by requested blood type",
+    ["blood_type"]
+)
+REJECTS = Counter(
+    "bloodline_rejects_total",
+    "Requests rejected for lack of units, by request type",
+    ["request_type"]
+)
+FILL_SECONDS = Histogram(
+    "bloodline_fill_duration_seconds",
+    "Time to fill an allocation request",
+    ["function"]
+)
+
+
+class RequestState:
+    """
+    What the current request spent on queries and templates so far.
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.template_seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        # a connection.execute_wrapper
+        start = perf_counter()
+
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.query_seconds += perf_counter() - start
+
+
+current_request: "ContextVar[Optional[RequestState]]" = ContextVar("current_request", default=None)
+
+
+def timed(function: Callable) -> Callable:
+    """
+    Record the duration of each call of function in FILL_SECONDS.
+    """
+    name = function.__name__
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        start = perf_counter()
+
+        try:
+            return function(*args, **kwargs)
+        finally:
+            FILL_SECONDS.observe(perf_counter() - start, name)
+
+    return wrapper
+
+
+def count_issued(units_by_type: Dict[str, int]):
+    # counted once committed, allocations that are rolled back issued nothing
+    def count():
+        for blood_type, units in units_by_type.items():
+            UNITS_ISSUED.inc(blood_type, amount=units)
+
+    transaction.on_commit(count)
+
+
+def count_rejects(request_type: str, rejects: int):
+    transaction.on_commit(lambda: REJECTS.inc(request_type, amount=rejects))
+
+
+class _TimedTemplate:
+    def __init__(self, template):
+        self.template = template
+
+    def __getattr__(self, name):
+        return getattr(self.template, name)
+
+    def render(self, context=None, request=None):
+        start = perf_counter()
+
+        try:
+            return self.template.render(context, request)
+        finally:
+            state = current_request.get()
+            if state is not None:
+                state.template_seconds += perf_counter() - start
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """
+    The Django template backend, adding the render time of each template to the current
+    request's metrics. Templates included by others are timed as part of them.
+    """
+
+    def from_string(self, template_code):
+        return _TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return _TimedTemplate(super().get_template(template_name))
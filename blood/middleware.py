@@ -0,0 +1,55 @@
+from time import perf_counter
+
+from django.db import connection
+
+from blood import metrics
+
+
+class MetricsMiddleware:
+    """
+    Records each request's latency, database queries and template render time per URL name,
+    in memory only. Queries the allocation dispatcher runs on its own thread count towards the
+    latency but not the queries of the view.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        state = metrics.RequestState()
+        token = metrics.current_request.set(state)
+        start = perf_counter()
+
+        try:
+            with connection.execute_wrapper(state):
+                response = self.get_response(request)
+        finally:
+            metrics.current_request.reset(token)
+
+        if response.streaming:
+            # the body, and the queries behind it, are produced after the view returned
+            response.streaming_content = self.stream(response.streaming_content, request,
+                                                     state, start)
+        else:
+            self.record(request, state, start)
+
+        return response
+
+    def stream(self, content, request, state: metrics.RequestState, start: float):
+        token = metrics.current_request.set(state)
+
+        try:
+            with connection.execute_wrapper(state):
+                yield from content
+        finally:
+            metrics.current_request.reset(token)
+            self.record(request, state, start)
+
+    def record(self, request, state: metrics.RequestState, start: float):
+        match = request.resolver_match
+        view = match.view_name if match is not None else "unresolved"
+
+        metrics.REQUEST_SECONDS.observe(perf_counter() - start, view, request.method)
+        metrics.REQUEST_QUERIES.inc(view, amount=state.queries)
+        metrics.REQUEST_QUERY_SECONDS.inc(view, amount=state.query_seconds)
+        metrics.TEMPLATE_SECONDS.observe(state.template_seconds, view)
@@ -9,7 +9,8 @@ def add_groups(apps, _schema_editor):
     Permission = apps.get_model('auth', 'Permission')
     ContentType = apps.get_model('contenttypes', 'ContentType')
 
-    donation_ct = ContentType.objects.get(app_label='blood', model='donation')
+    # content types are created once migrate finishes, on a fresh database there is none yet
+    donation_ct, _ = ContentType.objects.get_or_create(app_label='blood', model='donation')
 
     def add_permissions(group: Group, *codes: str):
         for code in codes:
@@ -0,0 +1,224 @@
+# Generated by Django 3.2 on 2026-10-18 16:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+from blood.blood_types import HIGH_PRIORITY_DAYS, MAX_BLOOD_AGE_DAYS
+
+_NOW = "strftime('%Y-%m-%d %H:%M:%f', 'now')"
+
+
+def _offset(column: str, days: int) -> str:
+    return f"strftime('%Y-%m-%d %H:%M:%f', {column}, '+{days} days')"
+
+
+_BACKFILL = f"""
+INSERT INTO blood_remaining_units
+    (donation_id, blood_type, rank, units, donation_date, high_priority_at, expires_at)
+SELECT
+    bd.id,
+    bp.blood_type,
+    br.rank,
+    bd.units - IFNULL(SUM(bi.units),0),
+    bd.donation_date,
+    {_offset("bd.donation_date", HIGH_PRIORITY_DAYS)},
+    {_offset("bd.donation_date", MAX_BLOOD_AGE_DAYS)}
+FROM
+    blood_donation bd
+    JOIN blood_patient bp on bd.donor_id = bp.id
+    JOIN blood_rank br on bp.blood_type = br.blood_type
+    LEFT JOIN blood_issue bi on bd.id = bi.donation_id
+GROUP BY bd.id, bp.blood_type, br.rank
+"""
+
+_TRIGGERS = [
+    f"""
+CREATE TRIGGER blood_remaining_donation_insert AFTER INSERT ON blood_donation
+BEGIN
+    INSERT INTO blood_remaining_units
+        (donation_id, blood_type, rank, units, donation_date, high_priority_at, expires_at)
+    SELECT
+        NEW.id,
+        bp.blood_type,
+        br.rank,
+        NEW.units,
+        NEW.donation_date,
+        {_offset("NEW.donation_date", HIGH_PRIORITY_DAYS)},
+        {_offset("NEW.donation_date", MAX_BLOOD_AGE_DAYS)}
+    FROM
+        blood_patient bp
+        JOIN blood_rank br on bp.blood_type = br.blood_type
+    WHERE bp.id = NEW.donor_id;
+END
+""",
+    f"""
+CREATE TRIGGER blood_remaining_donation_update
+AFTER UPDATE OF units, donor_id, donation_date ON blood_donation
+BEGIN
+    UPDATE blood_remaining_units SET
+        units = units + NEW.units - OLD.units,
+        donation_date = NEW.donation_date,
+        high_priority_at = {_offset("NEW.donation_date", HIGH_PRIORITY_DAYS)},
+        expires_at = {_offset("NEW.donation_date", MAX_BLOOD_AGE_DAYS)},
+        blood_type = (SELECT blood_type FROM blood_patient WHERE id = NEW.donor_id),
+        rank = (
+            SELECT br.rank
+            FROM blood_patient bp JOIN blood_rank br on bp.blood_type = br.blood_type
+            WHERE bp.id = NEW.donor_id
+        )
+    WHERE donation_id = NEW.id;
+END
+""",
+    """
+CREATE TRIGGER blood_remaining_donation_delete AFTER DELETE ON blood_donation
+BEGIN
+    DELETE FROM blood_remaining_units WHERE donation_id = OLD.id;
+END
+""",
+    """
+CREATE TRIGGER blood_remaining_issue_insert AFTER INSERT ON blood_issue
+BEGIN
+    UPDATE blood_remaining_units SET units = units - NEW.units
+    WHERE donation_id = NEW.donation_id;
+END
+""",
+    """
+CREATE TRIGGER blood_remaining_issue_update AFTER UPDATE OF units, donation_id ON blood_issue
+BEGIN
+    UPDATE blood_remaining_units SET units = units + OLD.units
+    WHERE donation_id = OLD.donation_id;
+    UPDATE blood_remaining_units SET units = units - NEW.units
+    WHERE donation_id = NEW.donation_id;
+END
+""",
+    """
+CREATE TRIGGER blood_remaining_issue_delete AFTER DELETE ON blood_issue
+BEGIN
+    UPDATE blood_remaining_units SET units = units + OLD.units
+    WHERE donation_id = OLD.donation_id;
+END
+""",
+    """
+CREATE TRIGGER blood_remaining_patient_update AFTER UPDATE OF blood_type ON blood_patient
+WHEN NEW.blood_type <> OLD.blood_type
+BEGIN
+    UPDATE blood_remaining_units SET
+        blood_type = NEW.blood_type,
+        rank = (SELECT rank FROM blood_rank WHERE blood_type = NEW.blood_type)
+    WHERE donation_id IN (SELECT id FROM blood_donation WHERE donor_id = NEW.id);
+END
+"""
+]
+
+_DROP_TRIGGERS = [
+    "DROP TRIGGER blood_remaining_donation_insert",
+    "DROP TRIGGER blood_remaining_donation_update",
+    "DROP TRIGGER blood_remaining_donation_delete",
+    "DROP TRIGGER blood_remaining_issue_insert",
+    "DROP TRIGGER blood_remaining_issue_update",
+    "DROP TRIGGER blood_remaining_issue_delete",
+    "DROP TRIGGER blood_remaining_patient_update"
+]
+
+
+# the views of migration 0001, aggregating the issues of every donation
+def _previous_outstanding(name: str, order: str) -> str:
+    return f"""
+CREATE VIEW {name} AS
+SELECT
+    bd.id as donation_id,
+    bd.units - IFNULL(SUM(bi.units),0) as units,
+    bp.blood_type,
+    bd.donation_date
+FROM
+    blood_donation bd
+    JOIN blood_patient bp on bd.donor_id = bp.id
+    JOIN blood_rank br on bp.blood_type = br.blood_type
+    LEFT JOIN blood_issue bi on bd.id = bi.donation_id
+WHERE julianday('now') - julianday(bd.donation_date) < {MAX_BLOOD_AGE_DAYS}
+GROUP BY bd.id, bp.blood_type
+HAVING bd.units > IFNULL(SUM(bi.units),0)
+ORDER BY
+    julianday('now') - julianday(bd.donation_date) > {HIGH_PRIORITY_DAYS},
+    {order}
+"""
+
+
+_OUTSTANDING_DONATIONS = f"""
+CREATE VIEW blood_outstanding_donations AS
+SELECT
+    donation_id,
+    units,
+    blood_type,
+    donation_date
+FROM blood_remaining_units
+WHERE units > 0 AND expires_at > {_NOW}
+ORDER BY
+    high_priority_at <= {_NOW},
+    rank
+"""
+
+_OUTSTANDING_DONATIONS_MCI = f"""
+CREATE VIEW blood_outstanding_donations_mci AS
+SELECT
+    donation_id,
+    units,
+    blood_type,
+    donation_date
+FROM blood_remaining_units
+WHERE units > 0 AND expires_at > {_NOW}
+ORDER BY
+    high_priority_at <= {_NOW},
+    rank DESC
+"""
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('blood', '0003_create_groups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RemainingUnits',
+            fields=[
+                ('donation', models.OneToOneField(on_delete=django.db.models.deletion.DO_NOTHING,
+                                                  primary_key=True, serialize=False,
+                                                  to='blood.donation')),
+                ('blood_type', models.CharField(
+                    choices=[('A+', 'A+'), ('O+', 'O+'), ('B+', 'B+'), ('AB+', 'AB+'), ('A-', 'A-'),
+                             ('O-', 'O-'), ('B-', 'B-'), ('AB-', 'AB-')], max_length=10)),
+                ('rank', models.IntegerField()),
+                ('units', models.IntegerField()),
+                ('donation_date', models.DateTimeField()),
+                ('high_priority_at', models.DateTimeField()),
+                ('expires_at', models.DateTimeField()),
+            ],
+            options={
+                'db_table': 'blood_remaining_units',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='remainingunits',
+            index=models.Index(condition=models.Q(('units__gt', 0)),
+                               fields=['blood_type', 'expires_at'],
+                               name='blood_remaining_type_expiry'),
+        ),
+        migrations.AddIndex(
+            model_name='remainingunits',
+            index=models.Index(condition=models.Q(('units__gt', 0)), fields=['expires_at'],
+                               name='blood_remaining_expiry'),
+        ),
+        migrations.RunSQL(_BACKFILL, migrations.RunSQL.noop),
+        migrations.RunSQL(_TRIGGERS, _DROP_TRIGGERS),
+        migrations.RunSQL(
+            "DROP VIEW blood_outstanding_donations",
+            _previous_outstanding("blood_outstanding_donations", "br.rank")
+        ),
+        migrations.RunSQL(
+            "DROP VIEW blood_outstanding_donations_mci",
+            _previous_outstanding("blood_outstanding_donations_mci", "br.rank DESC")
+        ),
+        migrations.RunSQL(_OUTSTANDING_DONATIONS, "DROP VIEW blood_outstanding_donations"),
+        migrations.RunSQL(_OUTSTANDING_DONATIONS_MCI, "DROP VIEW blood_outstanding_donations_mci")
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.2 on 2026-10-18 17:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('blood', '0004_remaining_units'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mcirequest',
+            name='allocation',
+            field=models.CharField(choices=[('greedy', 'Greedy, blood type by blood type'),
+                                            ('optimal', 'Optimal, whole request at once')],
+                                   default='greedy', max_length=10),
+        ),
+    ]
@@ -0,0 +1,278 @@
+# Generated by Django 3.2 on 2026-10-18 17:40
+
+from django.db import migrations, models
+import django.utils.timezone
+
+from blood.blood_types import HIGH_PRIORITY_DAYS, MAX_BLOOD_AGE_DAYS
+
+_NOW = "strftime('%Y-%m-%d %H:%M:%f', 'now')"
+
+_BACKFILL = f"""
+UPDATE blood_donation SET
+    high_priority_at = strftime('%Y-%m-%d %H:%M:%f', donation_date, '+{HIGH_PRIORITY_DAYS} days'),
+    expires_at = strftime('%Y-%m-%d %H:%M:%f', donation_date, '+{MAX_BLOOD_AGE_DAYS} days')
+"""
+
+_SYNC_LEDGER = """
+UPDATE blood_remaining_units SET
+    high_priority_at = (
+        SELECT high_priority_at FROM blood_donation WHERE id = blood_remaining_units.donation_id
+    ),
+    expires_at = (
+        SELECT expires_at FROM blood_donation WHERE id = blood_remaining_units.donation_id
+    )
+"""
+
+# SQLite remakes blood_donation and blood_patient to alter them, triggers referencing them have
+# to be dropped first and recreated afterwards
+_DROP_TRIGGERS = [
+    "DROP TRIGGER blood_remaining_donation_insert",
+    "DROP TRIGGER blood_remaining_donation_update",
+    "DROP TRIGGER blood_remaining_donation_delete",
+    "DROP TRIGGER blood_remaining_patient_update"
+]
+
+
+def _offset(column: str, days: int) -> str:
+    return f"strftime('%Y-%m-%d %H:%M:%f', {column}, '+{days} days')"
+
+
+# the triggers of migration 0004, computing the ledger's dates from the donation date
+_PREVIOUS_TRIGGERS = [
+    f"""
+CREATE TRIGGER blood_remaining_donation_insert AFTER INSERT ON blood_donation
+BEGIN
+    INSERT INTO blood_remaining_units
+        (donation_id, blood_type, rank, units, donation_date, high_priority_at, expires_at)
+    SELECT
+        NEW.id,
+        bp.blood_type,
+        br.rank,
+        NEW.units,
+        NEW.donation_date,
+        {_offset("NEW.donation_date", HIGH_PRIORITY_DAYS)},
+        {_offset("NEW.donation_date", MAX_BLOOD_AGE_DAYS)}
+    FROM
+        blood_patient bp
+        JOIN blood_rank br on bp.blood_type = br.blood_type
+    WHERE bp.id = NEW.donor_id;
+END
+""",
+    f"""
+CREATE TRIGGER blood_remaining_donation_update
+AFTER UPDATE OF units, donor_id, donation_date ON blood_donation
+BEGIN
+    UPDATE blood_remaining_units SET
+        units = units + NEW.units - OLD.units,
+        donation_date = NEW.donation_date,
+        high_priority_at = {_offset("NEW.donation_date", HIGH_PRIORITY_DAYS)},
+        expires_at = {_offset("NEW.donation_date", MAX_BLOOD_AGE_DAYS)},
+        blood_type = (SELECT blood_type FROM blood_patient WHERE id = NEW.donor_id),
+        rank = (
+            SELECT br.rank
+            FROM blood_patient bp JOIN blood_rank br on bp.blood_type = br.blood_type
+            WHERE bp.id = NEW.donor_id
+        )
+    WHERE donation_id = NEW.id;
+END
+""",
+    """
+CREATE TRIGGER blood_remaining_donation_delete AFTER DELETE ON blood_donation
+BEGIN
+    DELETE FROM blood_remaining_units WHERE donation_id = OLD.id;
+END
+""",
+    """
+CREATE TRIGGER blood_remaining_patient_update AFTER UPDATE OF blood_type ON blood_patient
+WHEN NEW.blood_type <> OLD.blood_type
+BEGIN
+    UPDATE blood_remaining_units SET
+        blood_type = NEW.blood_type,
+        rank = (SELECT rank FROM blood_rank WHERE blood_type = NEW.blood_type)
+    WHERE donation_id IN (SELECT id FROM blood_donation WHERE donor_id = NEW.id);
+END
+"""
+]
+
+_TRIGGERS = [
+    """
+CREATE TRIGGER blood_remaining_donation_insert AFTER INSERT ON blood_donation
+BEGIN
+    INSERT INTO blood_remaining_units
+        (donation_id, blood_type, rank, units, donation_date, high_priority_at, expires_at)
+    SELECT
+        NEW.id,
+        bp.blood_type,
+        br.rank,
+        NEW.units,
+        NEW.donation_date,
+        NEW.high_priority_at,
+        NEW.expires_at
+    FROM
+        blood_patient bp
+        JOIN blood_rank br on bp.blood_type = br.blood_type
+    WHERE bp.id = NEW.donor_id;
+END
+""",
+    """
+CREATE TRIGGER blood_remaining_donation_update
+AFTER UPDATE OF units, donor_id, donation_date, high_priority_at, expires_at ON blood_donation
+BEGIN
+    UPDATE blood_remaining_units SET
+        units = units + NEW.units - OLD.units,
+        donation_date = NEW.donation_date,
+        high_priority_at = NEW.high_priority_at,
+        expires_at = NEW.expires_at,
+        blood_type = (SELECT blood_type FROM blood_patient WHERE id = NEW.donor_id),
+        rank = (
+            SELECT br.rank
+            FROM blood_patient bp JOIN blood_rank br on bp.blood_type = br.blood_type
+            WHERE bp.id = NEW.donor_id
+        )
+    WHERE donation_id = NEW.id;
+END
+""",
+    """
+CREATE TRIGGER blood_remaining_donation_delete AFTER DELETE ON blood_donation
+BEGIN
+    DELETE FROM blood_remaining_units WHERE donation_id = OLD.id;
+END
+""",
+    """
+CREATE TRIGGER blood_remaining_patient_update AFTER UPDATE OF blood_type ON blood_patient
+WHEN NEW.blood_type <> OLD.blood_type
+BEGIN
+    UPDATE blood_remaining_units SET
+        blood_type = NEW.blood_type,
+        rank = (SELECT rank FROM blood_rank WHERE blood_type = NEW.blood_type)
+    WHERE donation_id IN (SELECT id FROM blood_donation WHERE donor_id = NEW.id);
+END
+"""
+]
+
+_OUTSTANDING_DONATIONS = f"""
+CREATE VIEW blood_outstanding_donations AS
+SELECT
+    donation_id,
+    units,
+    blood_type,
+    donation_date,
+    high_priority_at,
+    expires_at
+FROM blood_remaining_units
+WHERE units > 0 AND expires_at > {_NOW}
+ORDER BY
+    high_priority_at <= {_NOW},
+    rank
+"""
+
+_OUTSTANDING_DONATIONS_MCI = f"""
+CREATE VIEW blood_outstanding_donations_mci AS
+SELECT
+    donation_id,
+    units,
+    blood_type,
+    donation_date,
+    high_priority_at,
+    expires_at
+FROM blood_remaining_units
+WHERE units > 0 AND expires_at > {_NOW}
+ORDER BY
+    high_priority_at <= {_NOW},
+    rank DESC
+"""
+
+
+
+# the views of migration 0004, without the expiry columns
+def _previous_outstanding(name: str, order: str) -> str:
+    return f"""
+CREATE VIEW {name} AS
+SELECT
+    donation_id,
+    units,
+    blood_type,
+    donation_date
+FROM blood_remaining_units
+WHERE units > 0 AND expires_at > {_NOW}
+ORDER BY
+    high_priority_at <= {_NOW},
+    {order}
+"""
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('blood', '0005_mcirequest_allocation'),
+    ]
+
+    operations = [
+        migrations.RunSQL(_DROP_TRIGGERS, _PREVIOUS_TRIGGERS),
+        migrations.AlterField(
+            model_name='donation',
+            name='donation_date',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now,
+                                       editable=False),
+        ),
+        migrations.AddField(
+            model_name='donation',
+            name='high_priority_at',
+            field=models.DateTimeField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='donation',
+            name='expires_at',
+            field=models.DateTimeField(editable=False, null=True),
+        ),
+        migrations.RunSQL(_BACKFILL, migrations.RunSQL.noop),
+        migrations.AlterField(
+            model_name='donation',
+            name='high_priority_at',
+            field=models.DateTimeField(db_index=True, editable=False),
+        ),
+        migrations.AlterField(
+            model_name='donation',
+            name='expires_at',
+            field=models.DateTimeField(db_index=True, editable=False),
+        ),
+        migrations.AlterField(
+            model_name='patient',
+            name='blood_type',
+            field=models.CharField(
+                choices=[('A+', 'A+'), ('O+', 'O+'), ('B+', 'B+'), ('AB+', 'AB+'), ('A-', 'A-'),
+                         ('O-', 'O-'), ('B-', 'B-'), ('AB-', 'AB-')], db_index=True,
+                max_length=10),
+        ),
+        migrations.AddField(
+            model_name='outstandingdonations',
+            name='high_priority_at',
+            field=models.DateTimeField(),
+        ),
+        migrations.AddField(
+            model_name='outstandingdonations',
+            name='expires_at',
+            field=models.DateTimeField(),
+        ),
+        migrations.AddField(
+            model_name='outstandingdonationsmci',
+            name='high_priority_at',
+            field=models.DateTimeField(),
+        ),
+        migrations.AddField(
+            model_name='outstandingdonationsmci',
+            name='expires_at',
+            field=models.DateTimeField(),
+        ),
+        migrations.RunSQL(_SYNC_LEDGER, migrations.RunSQL.noop),
+        migrations.RunSQL(_TRIGGERS, _DROP_TRIGGERS),
+        migrations.RunSQL(
+            "DROP VIEW blood_outstanding_donations",
+            _previous_outstanding("blood_outstanding_donations", "rank")
+        ),
+        migrations.RunSQL(
+            "DROP VIEW blood_outstanding_donations_mci",
+            _previous_outstanding("blood_outstanding_donations_mci", "rank DESC")
+        ),
+        migrations.RunSQL(_OUTSTANDING_DONATIONS, "DROP VIEW blood_outstanding_donations"),
+        migrations.RunSQL(_OUTSTANDING_DONATIONS_MCI, "DROP VIEW blood_outstanding_donations_mci")
+    ]
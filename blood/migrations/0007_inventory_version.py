@@ -0,0 +1,86 @@
+# Generated by Django 3.2 on 2026-10-18 18:10
+
+from django.db import migrations, models
+
+_STAMP = """
+    UPDATE blood_inventory_version SET version = version + 1 WHERE id = 1;
+    UPDATE blood_remaining_units
+    SET version = (SELECT version FROM blood_inventory_version WHERE id = 1)
+    WHERE donation_id = NEW.donation_id;
+"""
+
+_TRIGGERS = [
+    f"""
+CREATE TRIGGER blood_inventory_version_insert AFTER INSERT ON blood_remaining_units
+BEGIN
+{_STAMP}
+END
+""",
+    f"""
+CREATE TRIGGER blood_inventory_version_update
+AFTER UPDATE OF units, blood_type, rank, donation_date, high_priority_at, expires_at
+ON blood_remaining_units
+BEGIN
+{_STAMP}
+END
+""",
+    """
+CREATE TRIGGER blood_inventory_version_delete AFTER DELETE ON blood_remaining_units
+BEGIN
+    UPDATE blood_inventory_version SET version = version + 1, epoch = epoch + 1 WHERE id = 1;
+END
+"""
+]
+
+
+_DROP_TRIGGERS = [
+    "DROP TRIGGER blood_inventory_version_insert",
+    "DROP TRIGGER blood_inventory_version_update",
+    "DROP TRIGGER blood_inventory_version_delete"
+]
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('blood', '0006_donation_expiry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InventoryVersion',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('version', models.BigIntegerField()),
+                ('epoch', models.IntegerField()),
+            ],
+            options={
+                'db_table': 'blood_inventory_version',
+            },
+        ),
+        migrations.RunSQL(
+            "INSERT INTO blood_inventory_version (id, version, epoch) VALUES (1, 0, 0)",
+            "DELETE FROM blood_inventory_version WHERE id = 1"
+        ),
+        # ADD COLUMN instead of remaking the ledger, the triggers on other tables reference it
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(
+                    "ALTER TABLE blood_remaining_units "
+                    "ADD COLUMN version bigint NOT NULL DEFAULT 0",
+                    "ALTER TABLE blood_remaining_units DROP COLUMN version"
+                ),
+                migrations.RunSQL(
+                    "CREATE INDEX blood_remaining_units_version ON blood_remaining_units (version)",
+                    "DROP INDEX blood_remaining_units_version"
+                ),
+            ],
+            state_operations=[
+                migrations.AddField(
+                    model_name='remainingunits',
+                    name='version',
+                    field=models.BigIntegerField(db_index=True, default=0),
+                ),
+            ]
+        ),
+        migrations.RunSQL(_TRIGGERS, _DROP_TRIGGERS)
+    ]
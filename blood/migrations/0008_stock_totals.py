@@ -0,0 +1,78 @@
+# Generated by Django 3.2 on 2026-10-18 19:00
+
+from django.db import migrations, models
+
+_BACKFILL = """
+INSERT INTO blood_stock_totals (blood_type, expires_on, units)
+SELECT blood_type, date(expires_at), SUM(units)
+FROM blood_remaining_units
+GROUP BY blood_type, date(expires_at)
+"""
+
+
+def _add(row: str, sign: str) -> str:
+    return f"""
+    INSERT OR IGNORE INTO blood_stock_totals (blood_type, expires_on, units)
+    VALUES ({row}.blood_type, date({row}.expires_at), 0);
+    UPDATE blood_stock_totals SET units = units {sign} {row}.units
+    WHERE blood_type = {row}.blood_type AND expires_on = date({row}.expires_at);
+"""
+
+
+_TRIGGERS = [
+    f"""
+CREATE TRIGGER blood_stock_totals_insert AFTER INSERT ON blood_remaining_units
+BEGIN
+{_add("NEW", "+")}
+END
+""",
+    f"""
+CREATE TRIGGER blood_stock_totals_update
+AFTER UPDATE OF units, blood_type, expires_at ON blood_remaining_units
+BEGIN
+{_add("OLD", "-")}
+{_add("NEW", "+")}
+END
+""",
+    f"""
+CREATE TRIGGER blood_stock_totals_delete AFTER DELETE ON blood_remaining_units
+BEGIN
+{_add("OLD", "-")}
+END
+"""
+]
+
+
+_DROP_TRIGGERS = [
+    "DROP TRIGGER blood_stock_totals_insert",
+    "DROP TRIGGER blood_stock_totals_update",
+    "DROP TRIGGER blood_stock_totals_delete"
+]
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('blood', '0007_inventory_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockTotal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False,
+                                           verbose_name='ID')),
+                ('blood_type', models.CharField(
+                    choices=[('A+', 'A+'), ('O+', 'O+'), ('B+', 'B+'), ('AB+', 'AB+'),
+                             ('A-', 'A-'), ('O-', 'O-'), ('B-', 'B-'), ('AB-', 'AB-')],
+                    max_length=10)),
+                ('expires_on', models.DateField()),
+                ('units', models.BigIntegerField()),
+            ],
+            options={
+                'db_table': 'blood_stock_totals',
+                'unique_together': {('blood_type', 'expires_on')},
+            },
+        ),
+        migrations.RunSQL(_BACKFILL, migrations.RunSQL.noop),
+        migrations.RunSQL(_TRIGGERS, _DROP_TRIGGERS)
+    ]
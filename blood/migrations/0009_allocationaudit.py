@@ -0,0 +1,32 @@
+# Generated by Django 3.2 on 2026-10-18 19:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('reversion', '0001_squashed_0004_auto_20160611_1202'),
+        ('blood', '0008_stock_totals'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AllocationAudit',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False,
+                                           verbose_name='ID')),
+                ('owner_id', models.CharField(max_length=191)),
+                ('serialized_data', models.TextField()),
+                ('record_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE,
+                                                  related_name='+',
+                                                  to='contenttypes.contenttype')),
+                ('owner_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE,
+                                                 related_name='+',
+                                                 to='contenttypes.contenttype')),
+                ('revision', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE,
+                                               to='reversion.revision')),
+            ],
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 3.2 on 2026-10-18 20:10
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('blood', '0009_allocationaudit'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RequestProfile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False,
+                                           verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('method', models.CharField(max_length=10)),
+                ('path', models.CharField(max_length=2000)),
+                ('view_name', models.CharField(max_length=250)),
+                ('status', models.IntegerField()),
+                ('duration_ms', models.FloatField()),
+                ('queries', models.IntegerField()),
+                ('query_ms', models.FloatField()),
+                ('sql', models.TextField()),
+                ('profile_file', models.CharField(max_length=250)),
+                ('user', models.ForeignKey(null=True,
+                                           on_delete=django.db.models.deletion.SET_NULL,
+                                           related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,125 @@
+# Generated by Django 3.2 on 2026-10-18 20:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+_BLOOD_TYPES = [('A+', 'A+'), ('O+', 'O+'), ('B+', 'B+'), ('AB+', 'AB+'), ('A-', 'A-'),
+                ('O-', 'O-'), ('B-', 'B-'), ('AB-', 'AB-')]
+
+_DONATION_HISTORY = """
+CREATE VIEW blood_donation_history AS
+SELECT id, donor_id, units, donation_date, high_priority_at, expires_at, 0 AS archived
+FROM blood_donation
+UNION ALL
+SELECT id, donor_id, units, donation_date, high_priority_at, expires_at, 1 AS archived
+FROM blood_donation_archive
+"""
+
+_ISSUE_HISTORY = """
+CREATE VIEW blood_issue_history AS
+SELECT bi.id, bi.request_id, bi.donation_id, bi.request_blood_type, bp.blood_type, bi.units,
+    0 AS archived
+FROM
+    blood_issue bi
+    JOIN blood_donation bd ON bd.id = bi.donation_id
+    JOIN blood_patient bp ON bp.id = bd.donor_id
+UNION ALL
+SELECT ai.id, ai.request_id, ai.donation_id, ai.request_blood_type, bp.blood_type, ai.units,
+    1 AS archived
+FROM
+    blood_issue_archive ai
+    JOIN blood_donation_archive ad ON ad.id = ai.donation_id
+    JOIN blood_patient bp ON bp.id = ad.donor_id
+"""
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('blood', '0010_requestprofile'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DonationArchive',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('units', models.IntegerField()),
+                ('donation_date', models.DateTimeField()),
+                ('high_priority_at', models.DateTimeField()),
+                ('expires_at', models.DateTimeField()),
+                ('archived_at', models.DateTimeField(db_index=True)),
+                ('donor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE,
+                                            related_name='+', to='blood.patient')),
+            ],
+            options={
+                'db_table': 'blood_donation_archive',
+            },
+        ),
+        migrations.CreateModel(
+            name='IssueArchive',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('request_blood_type', models.CharField(choices=_BLOOD_TYPES, max_length=10)),
+                ('units', models.IntegerField()),
+                ('donation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE,
+                                               to='blood.donationarchive')),
+                ('request', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE,
+                                              related_name='+', to='blood.issuerequest')),
+            ],
+            options={
+                'db_table': 'blood_issue_archive',
+            },
+        ),
+        migrations.RunSQL(_DONATION_HISTORY, "DROP VIEW blood_donation_history"),
+        migrations.RunSQL(_ISSUE_HISTORY, "DROP VIEW blood_issue_history"),
+        migrations.CreateModel(
+            name='DonationHistory',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('units', models.IntegerField()),
+                ('donation_date', models.DateTimeField()),
+                ('high_priority_at', models.DateTimeField()),
+                ('expires_at', models.DateTimeField()),
+                ('archived', models.BooleanField()),
+                ('donor', models.ForeignKey(on_delete=django.db.models.deletion.DO_NOTHING,
+                                            related_name='+', to='blood.patient')),
+            ],
+            options={
+                'db_table': 'blood_donation_history',
+                'managed': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='IssueHistory',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('request_blood_type', models.CharField(choices=_BLOOD_TYPES, max_length=10)),
+                ('blood_type', models.CharField(choices=_BLOOD_TYPES, max_length=10)),
+                ('units', models.IntegerField()),
+                ('archived', models.BooleanField()),
+                ('donation', models.ForeignKey(db_constraint=False,
+                                               on_delete=django.db.models.deletion.DO_NOTHING,
+                                               to='blood.donationhistory')),
+                ('request', models.ForeignKey(on_delete=django.db.models.deletion.DO_NOTHING,
+                                              related_name='issue_history',
+                                              to='blood.issuerequest')),
+            ],
+            options={
+                'db_table': 'blood_issue_history',
+                'managed': False,
+            },
+        ),
+        # views, the collector must not delete from them along with a donation
+        migrations.AlterField(
+            model_name='outstandingdonations',
+            name='donation',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.DO_NOTHING,
+                                       primary_key=True, serialize=False, to='blood.donation'),
+        ),
+        migrations.AlterField(
+            model_name='outstandingdonationsmci',
+            name='donation',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.DO_NOTHING,
+                                       primary_key=True, serialize=False, to='blood.donation'),
+        ),
+    ]
@@ -0,0 +1,83 @@
+# Generated by Django 3.2 on 2026-10-18 22:10
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+_STAMP = """
+    UPDATE blood_patient
+    SET sync_version = (SELECT MAX(sync_version) FROM blood_patient) + 1
+    WHERE id = NEW.id;
+"""
+
+# SQLite has a single writer, a version taken from MAX() inside the writing transaction is
+# committed in order
+_TRIGGERS = [
+    f"""
+CREATE TRIGGER blood_patient_sync_insert AFTER INSERT ON blood_patient
+BEGIN
+{_STAMP}
+END
+""",
+    f"""
+CREATE TRIGGER blood_patient_sync_update
+AFTER UPDATE OF first_name, last_name, birthday, blood_type, smokes, phone_number
+ON blood_patient
+BEGIN
+{_STAMP}
+END
+""",
+]
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('blood', '0011_archive'),
+    ]
+
+    operations = [
+        # ADD COLUMN instead of remaking blood_patient, triggers and views reference it
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(
+                    "ALTER TABLE blood_patient ADD COLUMN sync_version bigint NOT NULL DEFAULT 0",
+                    "ALTER TABLE blood_patient DROP COLUMN sync_version"
+                ),
+                migrations.RunSQL(
+                    "UPDATE blood_patient SET sync_version = rowid",
+                    migrations.RunSQL.noop
+                ),
+                migrations.RunSQL(
+                    "CREATE INDEX blood_patient_sync_version ON blood_patient (sync_version)",
+                    "DROP INDEX blood_patient_sync_version"
+                ),
+            ],
+            state_operations=[
+                migrations.AddField(
+                    model_name='patient',
+                    name='sync_version',
+                    field=models.BigIntegerField(db_index=True, default=0, editable=False),
+                ),
+            ]
+        ),
+        migrations.RunSQL(
+            _TRIGGERS,
+            ["DROP TRIGGER blood_patient_sync_insert", "DROP TRIGGER blood_patient_sync_update"]
+        ),
+        migrations.CreateModel(
+            name='DonationSubmission',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False,
+                                           verbose_name='ID')),
+                ('client_id', models.CharField(max_length=64, unique=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('donation', models.ForeignKey(db_constraint=False,
+                                               on_delete=django.db.models.deletion.DO_NOTHING,
+                                               related_name='+', to='blood.donation')),
+                ('user', models.ForeignKey(null=True,
+                                           on_delete=django.db.models.deletion.SET_NULL,
+                                           related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,81 @@
+# Generated by Django 3.2 on 2026-10-18 23:30
+
+from django.db import migrations
+
+_NUMERIC_ID = "GLOB '" + "[0-9]" * 10 + "'"
+
+
+def _values(row: str) -> str:
+    # the phone number is indexed as written and as digits alone, 050-1234567 is found by 0501234
+    phone = f"COALESCE({row}phone_number, '')"
+    return f"""
+    CAST({row}id AS INTEGER),
+    {row}id,
+    {row}first_name,
+    {row}last_name,
+    {phone} || ' ' || REPLACE({phone}, '-', '')
+"""
+
+
+_INSERT = "INSERT INTO blood_patient_search " \
+          "(rowid, patient_id, first_name, last_name, phone_number)"
+
+
+def _index(row: str) -> str:
+    return f"{_INSERT} SELECT {_values(row + '.')} WHERE {row}.id {_NUMERIC_ID};"
+
+
+def _unindex(row: str) -> str:
+    return f"DELETE FROM blood_patient_search " \
+           f"WHERE rowid = CAST({row}.id AS INTEGER) AND {row}.id {_NUMERIC_ID};"
+
+
+# Keyed by the numeric patient id: blood_patient's own rowid may change on VACUUM, patient ids
+# are ten digits (IdSearch), others are not indexed
+_CREATE = [
+    """
+CREATE VIRTUAL TABLE blood_patient_search USING fts5(
+    patient_id, first_name, last_name, phone_number,
+    tokenize = 'unicode61 remove_diacritics 2',
+    prefix = '2 3 4'
+)
+""",
+    f"{_INSERT} SELECT {_values('')} FROM blood_patient WHERE id {_NUMERIC_ID}",
+    f"""
+CREATE TRIGGER blood_patient_search_insert AFTER INSERT ON blood_patient
+BEGIN
+{_index("NEW")}
+END
+""",
+    f"""
+CREATE TRIGGER blood_patient_search_update
+AFTER UPDATE OF id, first_name, last_name, phone_number ON blood_patient
+BEGIN
+{_unindex("OLD")}
+{_index("NEW")}
+END
+""",
+    f"""
+CREATE TRIGGER blood_patient_search_delete AFTER DELETE ON blood_patient
+BEGIN
+{_unindex("OLD")}
+END
+""",
+]
+
+_DROP = [
+    "DROP TRIGGER blood_patient_search_insert",
+    "DROP TRIGGER blood_patient_search_update",
+    "DROP TRIGGER blood_patient_search_delete",
+    "DROP TABLE blood_patient_search",
+]
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('blood', '0012_sync'),
+    ]
+
+    operations = [
+        migrations.RunSQL(_CREATE, _DROP),
+    ]
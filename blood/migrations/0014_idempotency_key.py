@@ -0,0 +1,38 @@
+# Generated by Django 3.2 on 2026-10-18 17:20
+
+from django.db import migrations, models
+
+
+def _add_key(table: str, model_name: str):
+    # ADD COLUMN and a separate unique index, SQLite can't add a UNIQUE column and remaking
+    # the table would break the triggers and views on its neighbours
+    return migrations.SeparateDatabaseAndState(
+        database_operations=[
+            migrations.RunSQL(
+                f"ALTER TABLE {table} ADD COLUMN idempotency_key varchar(100) NULL",
+                f"ALTER TABLE {table} DROP COLUMN idempotency_key"
+            ),
+            migrations.RunSQL(
+                f"CREATE UNIQUE INDEX {table}_idempotency_key ON {table} (idempotency_key)",
+                f"DROP INDEX {table}_idempotency_key"
+            ),
+        ],
+        state_operations=[
+            migrations.AddField(
+                model_name=model_name,
+                name='idempotency_key',
+                field=models.CharField(editable=False, max_length=100, null=True, unique=True),
+            ),
+        ]
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('blood', '0013_patient_search'),
+    ]
+
+    operations = [
+        _add_key('blood_issuerequest', 'issuerequest'),
+        _add_key('blood_reject', 'reject'),
+    ]
@@ -0,0 +1,244 @@
+# Generated by Django 3.2 on 2026-10-18 17:50
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+_BLOOD_TYPES = [('A+', 'A+'), ('O+', 'O+'), ('B+', 'B+'), ('AB+', 'AB+'), ('A-', 'A-'),
+                ('O-', 'O-'), ('B-', 'B-'), ('AB-', 'AB-')]
+
+_NOW = "strftime('%Y-%m-%d %H:%M:%f', 'now')"
+
+_HOLD_TRIGGERS = [
+    """
+CREATE TRIGGER blood_remaining_hold_insert AFTER INSERT ON blood_hold
+BEGIN
+    UPDATE blood_remaining_units SET held = held + NEW.units
+    WHERE donation_id = NEW.donation_id;
+END
+""",
+    """
+CREATE TRIGGER blood_remaining_hold_delete AFTER DELETE ON blood_hold
+BEGIN
+    UPDATE blood_remaining_units SET held = held - OLD.units
+    WHERE donation_id = OLD.donation_id;
+END
+"""
+]
+
+# Held units are no longer outstanding: the inventory version follows them, stock totals and
+# the outstanding views count units - held. units > 0 stays in the views' filter so they keep
+# using the partial indexes.
+_VERSION_UPDATE = """
+CREATE TRIGGER blood_inventory_version_update
+AFTER UPDATE OF units, held, blood_type, rank, donation_date, high_priority_at, expires_at
+ON blood_remaining_units
+BEGIN
+    UPDATE blood_inventory_version SET version = version + 1 WHERE id = 1;
+    UPDATE blood_remaining_units
+    SET version = (SELECT version FROM blood_inventory_version WHERE id = 1)
+    WHERE donation_id = NEW.donation_id;
+END
+"""
+
+
+def _add(row: str, sign: str) -> str:
+    return f"""
+    INSERT OR IGNORE INTO blood_stock_totals (blood_type, expires_on, units)
+    VALUES ({row}.blood_type, date({row}.expires_at), 0);
+    UPDATE blood_stock_totals SET units = units {sign} ({row}.units - {row}.held)
+    WHERE blood_type = {row}.blood_type AND expires_on = date({row}.expires_at);
+"""
+
+
+_STOCK_TOTALS_TRIGGERS = [
+    f"""
+CREATE TRIGGER blood_stock_totals_insert AFTER INSERT ON blood_remaining_units
+BEGIN
+{_add("NEW", "+")}
+END
+""",
+    f"""
+CREATE TRIGGER blood_stock_totals_update
+AFTER UPDATE OF units, held, blood_type, expires_at ON blood_remaining_units
+BEGIN
+{_add("OLD", "-")}
+{_add("NEW", "+")}
+END
+""",
+    f"""
+CREATE TRIGGER blood_stock_totals_delete AFTER DELETE ON blood_remaining_units
+BEGIN
+{_add("OLD", "-")}
+END
+"""
+]
+
+# the triggers of migrations 0007 and 0008 restored by the reverse, with the stock totals
+# counted again without the held units
+_PREVIOUS_STAMP = """
+    UPDATE blood_inventory_version SET version = version + 1 WHERE id = 1;
+    UPDATE blood_remaining_units
+    SET version = (SELECT version FROM blood_inventory_version WHERE id = 1)
+    WHERE donation_id = NEW.donation_id;
+"""
+
+
+def _previous_add(row: str, sign: str) -> str:
+    return f"""
+    INSERT OR IGNORE INTO blood_stock_totals (blood_type, expires_on, units)
+    VALUES ({row}.blood_type, date({row}.expires_at), 0);
+    UPDATE blood_stock_totals SET units = units {sign} {row}.units
+    WHERE blood_type = {row}.blood_type AND expires_on = date({row}.expires_at);
+"""
+
+
+_PREVIOUS_LEDGER_TRIGGERS = [
+    f"""
+CREATE TRIGGER blood_inventory_version_update
+AFTER UPDATE OF units, blood_type, rank, donation_date, high_priority_at, expires_at
+ON blood_remaining_units
+BEGIN
+{_PREVIOUS_STAMP}
+END
+""",
+    f"""
+CREATE TRIGGER blood_stock_totals_insert AFTER INSERT ON blood_remaining_units
+BEGIN
+{_previous_add("NEW", "+")}
+END
+""",
+    f"""
+CREATE TRIGGER blood_stock_totals_update
+AFTER UPDATE OF units, blood_type, expires_at ON blood_remaining_units
+BEGIN
+{_previous_add("OLD", "-")}
+{_previous_add("NEW", "+")}
+END
+""",
+    f"""
+CREATE TRIGGER blood_stock_totals_delete AFTER DELETE ON blood_remaining_units
+BEGIN
+{_previous_add("OLD", "-")}
+END
+""",
+    "DELETE FROM blood_stock_totals",
+    """
+INSERT INTO blood_stock_totals (blood_type, expires_on, units)
+SELECT blood_type, date(expires_at), SUM(units)
+FROM blood_remaining_units
+GROUP BY blood_type, date(expires_at)
+""",
+]
+
+_DROP_LEDGER_TRIGGERS = [
+    "DROP TRIGGER blood_inventory_version_update",
+    "DROP TRIGGER blood_stock_totals_insert",
+    "DROP TRIGGER blood_stock_totals_update",
+    "DROP TRIGGER blood_stock_totals_delete",
+]
+
+
+def _outstanding(name: str, rank_order: str, held: bool = True) -> str:
+    # without held, the view of migration 0006 restored by the reverse
+    return f"""
+CREATE VIEW {name} AS
+SELECT
+    donation_id,
+    {"units - held AS units" if held else "units"},
+    blood_type,
+    donation_date,
+    high_priority_at,
+    expires_at
+FROM blood_remaining_units
+WHERE units > 0{" AND units > held" if held else ""} AND expires_at > {_NOW}
+ORDER BY
+    high_priority_at <= {_NOW},
+    {rank_order}
+"""
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('blood', '0014_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Reservation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False,
+                                           verbose_name='ID')),
+                ('allocation', models.CharField(
+                    choices=[('greedy', 'Greedy, blood type by blood type'),
+                             ('optimal', 'Optimal, whole request at once')],
+                    default='greedy', max_length=10)),
+                ('units', models.IntegerField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('expires_at', models.DateTimeField(db_index=True)),
+                ('distribution', models.ForeignKey(null=True,
+                                                   on_delete=django.db.models.deletion.CASCADE,
+                                                   related_name='+',
+                                                   to='blood.bloodtypedistribution')),
+                ('patient', models.ForeignKey(null=True,
+                                              on_delete=django.db.models.deletion.CASCADE,
+                                              related_name='+', to='blood.patient')),
+                ('user', models.ForeignKey(null=True,
+                                           on_delete=django.db.models.deletion.CASCADE,
+                                           related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Hold',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False,
+                                           verbose_name='ID')),
+                ('request_blood_type', models.CharField(choices=_BLOOD_TYPES, max_length=10)),
+                ('units', models.IntegerField()),
+                ('donation', models.ForeignKey(db_constraint=False,
+                                               on_delete=django.db.models.deletion.DO_NOTHING,
+                                               related_name='+', to='blood.donation')),
+                ('reservation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE,
+                                                  to='blood.reservation')),
+            ],
+        ),
+        # ADD COLUMN instead of remaking the ledger, the triggers on other tables reference it
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(
+                    "ALTER TABLE blood_remaining_units ADD COLUMN held integer NOT NULL DEFAULT 0",
+                    "ALTER TABLE blood_remaining_units DROP COLUMN held"
+                ),
+            ],
+            state_operations=[
+                migrations.AddField(
+                    model_name='remainingunits',
+                    name='held',
+                    field=models.IntegerField(default=0),
+                ),
+            ]
+        ),
+        migrations.RunSQL(
+            _HOLD_TRIGGERS,
+            ["DROP TRIGGER blood_remaining_hold_insert", "DROP TRIGGER blood_remaining_hold_delete"]
+        ),
+        migrations.RunSQL(_DROP_LEDGER_TRIGGERS, _PREVIOUS_LEDGER_TRIGGERS),
+        migrations.RunSQL([_VERSION_UPDATE] + _STOCK_TOTALS_TRIGGERS, _DROP_LEDGER_TRIGGERS),
+        migrations.RunSQL(
+            "DROP VIEW blood_outstanding_donations",
+            _outstanding("blood_outstanding_donations", "rank", held=False)
+        ),
+        migrations.RunSQL(
+            "DROP VIEW blood_outstanding_donations_mci",
+            _outstanding("blood_outstanding_donations_mci", "rank DESC", held=False)
+        ),
+        migrations.RunSQL(
+            _outstanding("blood_outstanding_donations", "rank"),
+            "DROP VIEW blood_outstanding_donations"
+        ),
+        migrations.RunSQL(
+            _outstanding("blood_outstanding_donations_mci", "rank DESC"),
+            "DROP VIEW blood_outstanding_donations_mci"
+        )
+    ]
@@ -0,0 +1,75 @@
+# Generated by Django 3.2 on 2026-10-18 18:10
+
+from django.db import migrations, models
+
+_BLOOD_TYPES = [('A+', 'A+'), ('O+', 'O+'), ('B+', 'B+'), ('AB+', 'AB+'), ('A-', 'A-'),
+                ('O-', 'O-'), ('B-', 'B-'), ('AB-', 'AB-')]
+
+
+def _add_index(table: str, model_name: str, name: str, field: models.Field):
+    # CREATE INDEX instead of an AlterField, SQLite would remake the table and break the
+    # triggers and views referencing it
+    return migrations.SeparateDatabaseAndState(
+        database_operations=[
+            migrations.RunSQL(
+                f"CREATE INDEX {table}_{name} ON {table} ({name})",
+                f"DROP INDEX {table}_{name}"
+            ),
+        ],
+        state_operations=[
+            migrations.AlterField(model_name=model_name, name=name, field=field),
+        ]
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('blood', '0015_reservation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InventoryRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False,
+                                           verbose_name='ID')),
+                ('hour', models.DateTimeField()),
+                ('blood_type', models.CharField(choices=_BLOOD_TYPES, max_length=10)),
+                ('stock', models.BigIntegerField()),
+                ('donated', models.BigIntegerField()),
+                ('issued', models.BigIntegerField()),
+                ('rejected', models.BigIntegerField()),
+                ('expired', models.BigIntegerField()),
+            ],
+            options={
+                'db_table': 'blood_inventory_rollup',
+                'unique_together': {('hour', 'blood_type')},
+            },
+        ),
+        migrations.CreateModel(
+            name='RollupWatermark',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('hour', models.DateTimeField(null=True)),
+                ('donation_id', models.BigIntegerField()),
+                ('issue_id', models.BigIntegerField()),
+                ('reject_id', models.BigIntegerField()),
+            ],
+            options={
+                'db_table': 'blood_rollup_watermark',
+            },
+        ),
+        migrations.RunSQL(
+            "INSERT INTO blood_rollup_watermark (id, hour, donation_id, issue_id, reject_id) "
+            "VALUES (1, NULL, 0, 0, 0)",
+            "DELETE FROM blood_rollup_watermark"
+        ),
+        _add_index('blood_issuerequest', 'issuerequest', 'request_time',
+                   models.DateTimeField(auto_now_add=True, db_index=True)),
+        _add_index('blood_reject', 'reject', 'time',
+                   models.DateTimeField(auto_now_add=True, db_index=True)),
+        _add_index('blood_donation_archive', 'donationarchive', 'donation_date',
+                   models.DateTimeField(db_index=True)),
+        _add_index('blood_donation_archive', 'donationarchive', 'expires_at',
+                   models.DateTimeField(db_index=True)),
+    ]
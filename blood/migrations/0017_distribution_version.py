@@ -0,0 +1,26 @@
+# Generated by Django 3.2 on 2026-10-18 19:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('blood', '0016_inventory_rollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DistributionVersion',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('version', models.BigIntegerField()),
+            ],
+            options={
+                'db_table': 'blood_distribution_version',
+            },
+        ),
+        migrations.RunSQL(
+            "INSERT INTO blood_distribution_version (id, version) VALUES (1, 0)",
+            "DELETE FROM blood_distribution_version"
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.2 on 2026-10-18 19:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('blood', '0017_distribution_version'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='remainingunits',
+            index=models.Index(condition=models.Q(units__gt=0), fields=['rank', 'donation'],
+                               name='blood_remaining_rank'),
+        ),
+    ]
@@ -0,0 +1,82 @@
+# Generated by Django 3.2 on 2026-10-18 23:05
+
+from django.db import migrations, models
+
+# patients and tombstones share one sequence so the change feed orders both by a single
+# cursor; deleted patients' versions live on in their tombstones
+_NEXT_VERSION = """(SELECT MAX(version) FROM (
+        SELECT MAX(sync_version) AS version FROM blood_patient
+        UNION ALL
+        SELECT MAX(sync_version) FROM blood_patient_tombstone
+    )) + 1"""
+
+_STAMP = f"""
+    UPDATE blood_patient
+    SET sync_version = {_NEXT_VERSION}
+    WHERE id = NEW.id;
+"""
+
+_OLD_STAMP = """
+    UPDATE blood_patient
+    SET sync_version = (SELECT MAX(sync_version) FROM blood_patient) + 1
+    WHERE id = NEW.id;
+"""
+
+
+def _stamp_triggers(stamp: str):
+    return [
+        f"""
+CREATE TRIGGER blood_patient_sync_insert AFTER INSERT ON blood_patient
+BEGIN
+{stamp}
+END
+""",
+        f"""
+CREATE TRIGGER blood_patient_sync_update
+AFTER UPDATE OF first_name, last_name, birthday, blood_type, smokes, phone_number
+ON blood_patient
+BEGIN
+{stamp}
+END
+""",
+    ]
+
+
+_DROP_STAMP_TRIGGERS = [
+    "DROP TRIGGER blood_patient_sync_insert",
+    "DROP TRIGGER blood_patient_sync_update",
+]
+
+# the deleted row is gone from blood_patient already, its own version must still be passed
+_DELETE_TRIGGER = f"""
+CREATE TRIGGER blood_patient_sync_delete AFTER DELETE ON blood_patient
+BEGIN
+    INSERT OR REPLACE INTO blood_patient_tombstone (patient_id, sync_version)
+    VALUES (OLD.id, MAX(OLD.sync_version + 1, IFNULL({_NEXT_VERSION}, 0)));
+END
+"""
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('blood', '0018_remaining_rank_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PatientTombstone',
+            fields=[
+                ('patient_id', models.CharField(max_length=10, primary_key=True,
+                                                serialize=False)),
+                ('sync_version', models.BigIntegerField(db_index=True)),
+            ],
+            options={
+                'db_table': 'blood_patient_tombstone',
+            },
+        ),
+        migrations.RunSQL(
+            _DROP_STAMP_TRIGGERS + _stamp_triggers(_STAMP) + [_DELETE_TRIGGER],
+            ["DROP TRIGGER blood_patient_sync_delete"] + _DROP_STAMP_TRIGGERS
+            + _stamp_triggers(_OLD_STAMP)
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 3.2 on 2026-10-18 23:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('blood', '0019_patient_tombstone'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MCIBatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False,
+                                           verbose_name='ID')),
+                ('idempotency_key', models.CharField(max_length=100, unique=True)),
+                ('orders', models.IntegerField()),
+                ('payload', models.CharField(max_length=64)),
+            ],
+        ),
+    ]
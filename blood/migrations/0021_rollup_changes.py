@@ -0,0 +1,66 @@
+# Generated by Django 3.2 on 2026-10-19 10:20
+
+from django.db import migrations, models
+
+# the earliest hour a changed or deleted row was counted in, roll_up recomputes from there
+_MARK = """
+    UPDATE blood_rollup_watermark
+    SET changed_from = MIN(IFNULL(changed_from, {0}), {0})
+    WHERE id = 1 AND hour IS NOT NULL;
+"""
+
+_ISSUE_TIME = "(SELECT request_time FROM blood_issuerequest WHERE id = {}.request_id)"
+
+# archiving deletes the rows after copying them, the rollups read both tables alike
+_TRIGGERS = [
+    f"""
+CREATE TRIGGER blood_rollup_issue_update AFTER UPDATE OF units, donation_id, request_id
+ON blood_issue
+BEGIN
+{_MARK.format(f"MIN({_ISSUE_TIME.format('OLD')}, {_ISSUE_TIME.format('NEW')})")}
+END
+""",
+    f"""
+CREATE TRIGGER blood_rollup_issue_delete AFTER DELETE ON blood_issue
+WHEN NOT EXISTS (SELECT 1 FROM blood_issue_archive WHERE id = OLD.id)
+BEGIN
+{_MARK.format(_ISSUE_TIME.format('OLD'))}
+END
+""",
+    f"""
+CREATE TRIGGER blood_rollup_donation_update AFTER UPDATE OF donor_id, units, donation_date
+ON blood_donation
+BEGIN
+{_MARK.format("MIN(OLD.donation_date, NEW.donation_date)")}
+END
+""",
+    f"""
+CREATE TRIGGER blood_rollup_donation_delete AFTER DELETE ON blood_donation
+WHEN NOT EXISTS (SELECT 1 FROM blood_donation_archive WHERE id = OLD.id)
+BEGIN
+{_MARK.format("OLD.donation_date")}
+END
+""",
+]
+
+_DROP_TRIGGERS = [
+    "DROP TRIGGER blood_rollup_issue_update",
+    "DROP TRIGGER blood_rollup_issue_delete",
+    "DROP TRIGGER blood_rollup_donation_update",
+    "DROP TRIGGER blood_rollup_donation_delete",
+]
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('blood', '0020_mcibatch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rollupwatermark',
+            name='changed_from',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.RunSQL(_TRIGGERS, _DROP_TRIGGERS),
+    ]
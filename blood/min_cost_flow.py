@@ -0,0 +1,97 @@
+from heapq import heappop, heappush
+from math import inf
+from typing import List, Tuple
+
+
+class Edge:
+    __slots__ = ("target", "capacity", "cost", "reverse")
+
+    def __init__(self, target: int, capacity: int, cost: int):
+        self.target = target
+        self.capacity = capacity
+        self.cost = cost
+        self.reverse = None
+
+    @property
+    def flow(self) -> int:
+        return self.reverse.capacity
+
+
+class MinCostFlow:
+    """
+    Min-cost max-flow using successive shortest paths (Dijkstra with potentials).
+
+    Intended for small graphs such as blood type transportation problems, where the
+    number of nodes is a few dozen regardless of how many donations are in stock.
+    """
+
+    def __init__(self, nodes: int):
+        self.graph: List[List[Edge]] = [[] for _ in range(nodes)]
+
+    def add_edge(self, source: int, target: int, capacity: int, cost: int) -> Edge:
+        if cost < 0:
+            raise ValueError("negative edge costs are not supported")
+
+        forward = Edge(target, capacity, cost)
+        backward = Edge(source, 0, -cost)
+        forward.reverse = backward
+        backward.reverse = forward
+
+        self.graph[source].append(forward)
+        self.graph[target].append(backward)
+
+        return forward
+
+    def solve(self, source: int, sink: int) -> Tuple[int, int]:
+        """
+        Push as much flow as possible from source to sink at minimum cost, returns (flow, cost).
+        """
+        nodes = len(self.graph)
+        potential = [0] * nodes
+        total_flow = 0
+        total_cost = 0
+
+        while True:
+            distance = [inf] * nodes
+            distance[source] = 0
+            previous: List[Tuple[int, Edge]] = [None] * nodes
+            queue = [(0, source)]
+
+            while queue:
+                dist, node = heappop(queue)
+
+                if dist > distance[node]:
+                    continue
+
+                for edge in self.graph[node]:
+                    if edge.capacity <= 0:
+                        continue
+
+                    candidate = dist + edge.cost + potential[node] - potential[edge.target]
+
+                    if candidate < distance[edge.target]:
+                        distance[edge.target] = candidate
+                        previous[edge.target] = (node, edge)
+                        heappush(queue, (candidate, edge.target))
+
+            if distance[sink] == inf:
+                return total_flow, total_cost
+
+            for node in range(nodes):
+                if distance[node] < inf:
+                    potential[node] += distance[node]
+
+            push = inf
+            node = sink
+            while node != source:
+                node, edge = previous[node]
+                push = min(push, edge.capacity)
+
+            node = sink
+            while node != source:
+                node, edge = previous[node]
+                edge.capacity -= push
+                edge.reverse.capacity += push
+                total_cost += push * edge.cost
+
+            total_flow += push
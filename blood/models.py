@@ -1,14 +1,21 @@
-from datetime import datetime
+import copy
+from datetime import datetime, timedelta
+from decimal import Decimal
 from math import ceil
 import re
-from typing import List, Optional, Tuple, Type
+import threading
+from typing import Dict, List, Optional, Tuple, Type
 
 from django.contrib.auth.models import Group, Permission, User
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.utils import timezone
 import reversion
+from reversion.models import Revision
 
-from blood.blood_types import AVAILABLE_TYPES_CHOICES, POPULATION_BLOOD_TYPE_DISTRIBUTION
+from blood.blood_types import ALLOCATION_CHOICES, AVAILABLE_TYPES_CHOICES, GREEDY_ALLOCATION, \
+    HIGH_PRIORITY_DAYS, MAX_BLOOD_AGE_DAYS, POPULATION_BLOOD_TYPE_DISTRIBUTION
 
 
 class InvalidPatientId(Exception):
@@ -24,15 +31,19 @@ class Patient(models.Model):
 
     birthday = models.DateField()
 
-    blood_type = models.CharField(max_length=10, choices=AVAILABLE_TYPES_CHOICES)
+    blood_type = models.CharField(max_length=10, choices=AVAILABLE_TYPES_CHOICES, db_index=True)
 
     smokes = models.BooleanField()
     phone_number = models.CharField(max_length=20, null=True)
 
+    # stamped by triggers on every insert and change (see migration 0012), the cursor of the
+    # sync change feed
+    sync_version = models.BigIntegerField(default=0, db_index=True, editable=False)
+
     def __str__(self):
         return f"({self.id}) {self.first_name} {self.last_name}"
 
-    def update(
+    def apply(
             self,
             first_name: str,
             last_name: str,
@@ -40,8 +51,11 @@ class Patient(models.Model):
             blood_type: str,
             smokes: bool,
             phone_number: Optional[str]
-    ):
-        if not (
+    ) -> bool:
+        """
+        Set the details without saving, returns whether any of them changed.
+        """
+        if (
                 first_name == self.first_name and
                 last_name == self.last_name and
                 birthday == self.birthday and
@@ -49,14 +63,28 @@ class Patient(models.Model):
                 smokes == self.smokes and
                 phone_number == self.phone_number
         ):
-            self.first_name = first_name
-            self.last_name = last_name
-            self.birthday = birthday
-            # Blood type is a major change, ask for confirmation
-            self.blood_type = blood_type
-            self.smokes = smokes
-            self.phone_number = phone_number
+            return False
 
+        self.first_name = first_name
+        self.last_name = last_name
+        self.birthday = birthday
+        # Blood type is a major change, ask for confirmation
+        self.blood_type = blood_type
+        self.smokes = smokes
+        self.phone_number = phone_number
+
+        return True
+
+    def update(
+            self,
+            first_name: str,
+            last_name: str,
+            birthday: datetime.date,
+            blood_type: str,
+            smokes: bool,
+            phone_number: Optional[str]
+    ):
+        if self.apply(first_name, last_name, birthday, blood_type, smokes, phone_number):
             self.save()
 
     @property
@@ -83,6 +111,17 @@ class Patient(models.Model):
             return patient, {}
 
 
+class DonationManager(models.Manager):
+    def bulk_create(self, objs, *args, **kwargs):
+        # bulk_create bypasses save(), the expiry columns still have to be filled in
+        objs = list(objs)
+
+        for donation in objs:
+            donation.set_expiry()
+
+        return super().bulk_create(objs, *args, **kwargs)
+
+
 @reversion.register
 class Donation(models.Model):
     id = models.AutoField(primary_key=True)
@@ -91,11 +130,26 @@ class Donation(models.Model):
 
     units = models.IntegerField()
 
-    donation_date = models.DateTimeField(auto_now_add=True)
+    donation_date = models.DateTimeField(default=timezone.now, editable=False, db_index=True)
+
+    # stored so that outstanding queries range scan instead of computing the blood age per row
+    high_priority_at = models.DateTimeField(editable=False, db_index=True)
+    expires_at = models.DateTimeField(editable=False, db_index=True)
+
+    objects = DonationManager()
 
     def __str__(self):
         return f"{self.donor.blood_type} {self.units} units"
 
+    def set_expiry(self):
+        self.high_priority_at = self.donation_date + timedelta(days=HIGH_PRIORITY_DAYS)
+        self.expires_at = self.donation_date + timedelta(days=MAX_BLOOD_AGE_DAYS)
+
+    def save(self, *args, **kwargs):
+        self.set_expiry()
+
+        super(Donation, self).save(*args, **kwargs)
+
     @property
     def blood_type(self) -> str:
         return self.donor.blood_type
@@ -108,12 +162,169 @@ class Donation(models.Model):
         ]
 
 
+class DonationSubmission(models.Model):
+    """
+    The client generated id a donation was submitted with through the sync API, so a batch sent
+    again after a lost response doesn't collect its donations twice.
+    """
+    client_id = models.CharField(max_length=64, unique=True)
+    # no constraint, archiving moves the donation out of blood_donation
+    donation = models.ForeignKey(Donation, on_delete=models.DO_NOTHING, db_constraint=False,
+                                 related_name="+")
+    user = models.ForeignKey(User, null=True, on_delete=models.SET_NULL, related_name="+")
+    created = models.DateTimeField(auto_now_add=True)
+
+
+class PatientTombstone(models.Model):
+    """
+    A deleted patient, so the sync change feed can tell clients to drop it. Written by a
+    trigger on blood_patient (see migration 0019), sync_version is taken from the same sequence
+    as Patient.sync_version.
+    """
+    patient_id = models.CharField(max_length=10, primary_key=True)
+    sync_version = models.BigIntegerField(db_index=True)
+
+    class Meta:
+        db_table = "blood_patient_tombstone"
+
+
+class RemainingUnits(models.Model):
+    """
+    Ledger of the units left on every donation.
+
+    The table is maintained by database triggers (see migration 0006) whenever a donation,
+    issue or patient blood type is written, so it must never be written from Python. Blood type,
+    expiry and priority are denormalized so the outstanding views are plain index scans.
+    """
+    donation = models.OneToOneField(Donation, on_delete=models.DO_NOTHING, primary_key=True)
+    blood_type = models.CharField(max_length=10, choices=AVAILABLE_TYPES_CHOICES)
+    rank = models.IntegerField()
+    units = models.IntegerField()
+    donation_date = models.DateTimeField()
+    high_priority_at = models.DateTimeField()
+    expires_at = models.DateTimeField()
+    # InventoryVersion.version of the last change to this row
+    version = models.BigIntegerField(default=0, db_index=True)
+    # units of live reservations (Hold), not outstanding any more but not issued yet
+    held = models.IntegerField(default=0)
+
+    class Meta:
+        db_table = "blood_remaining_units"
+        indexes = [
+            models.Index(
+                fields=["blood_type", "expires_at"],
+                condition=models.Q(units__gt=0),
+                name="blood_remaining_type_expiry"
+            ),
+            models.Index(
+                fields=["expires_at"],
+                condition=models.Q(units__gt=0),
+                name="blood_remaining_expiry"
+            ),
+            # the order of the outstanding page within a priority tier
+            models.Index(
+                fields=["rank", "donation"],
+                condition=models.Q(units__gt=0),
+                name="blood_remaining_rank"
+            )
+        ]
+
+
+class InventoryVersion(models.Model):
+    """
+    Single row counter bumped by triggers on every change to blood_remaining_units, so other
+    processes can tell cheaply whether their view of the inventory is still current. The epoch
+    is bumped as well when ledger rows are deleted.
+    """
+    id = models.IntegerField(primary_key=True)
+    version = models.BigIntegerField()
+    epoch = models.IntegerField()
+
+    class Meta:
+        db_table = "blood_inventory_version"
+
+    @classmethod
+    def current(cls) -> Tuple[int, int]:
+        return cls.objects.values_list("version", "epoch").get(id=1)
+
+
+class DistributionVersion(models.Model):
+    """
+    Single row counter bumped whenever a distribution or its percentages are saved or deleted,
+    so processes caching distributions can tell whether their copy is still current.
+    """
+    id = models.IntegerField(primary_key=True)
+    version = models.BigIntegerField()
+
+    class Meta:
+        db_table = "blood_distribution_version"
+
+    @classmethod
+    def current(cls) -> int:
+        return cls.objects.values_list("version", flat=True).get(id=1)
+
+
+class StockTotal(models.Model):
+    """
+    Remaining units per blood type and expiry day, kept up to date by triggers on the ledger
+    (see migration 0008) so stock totals don't aggregate every outstanding donation.
+    """
+    blood_type = models.CharField(max_length=10, choices=AVAILABLE_TYPES_CHOICES)
+    expires_on = models.DateField()
+    units = models.BigIntegerField()
+
+    class Meta:
+        db_table = "blood_stock_totals"
+        unique_together = (("blood_type", "expires_on"),)
+
+
+class InventoryRollup(models.Model):
+    """
+    Units per blood type and hour (see blood.rollup): outstanding at the end of the hour and
+    donated, issued, rejected and expired during it. Issued units count against the donor's
+    blood type, rejected ones against the requested type. Hours with nothing to record, no stock
+    and no movement, have no row.
+    """
+    hour = models.DateTimeField()
+    blood_type = models.CharField(max_length=10, choices=AVAILABLE_TYPES_CHOICES)
+    stock = models.BigIntegerField()
+    donated = models.BigIntegerField()
+    issued = models.BigIntegerField()
+    rejected = models.BigIntegerField()
+    expired = models.BigIntegerField()
+
+    class Meta:
+        db_table = "blood_inventory_rollup"
+        unique_together = (("hour", "blood_type"),)
+
+
+class RollupWatermark(models.Model):
+    """
+    Single row, how far blood_inventory_rollup is complete: every hour before hour, counting the
+    donations, issues and rejects up to these ids. Later rows dated before hour arrived late,
+    the rollups are recomputed from their hour. Triggers set changed_from to the earliest hour
+    of a donation or issue changed or deleted since, the rollups are recomputed from there too.
+    """
+    id = models.IntegerField(primary_key=True)
+    hour = models.DateTimeField(null=True)
+    donation_id = models.BigIntegerField()
+    issue_id = models.BigIntegerField()
+    reject_id = models.BigIntegerField()
+    changed_from = models.DateTimeField(null=True)
+
+    class Meta:
+        db_table = "blood_rollup_watermark"
+
+
 @reversion.register
 class OutstandingDonations(models.Model):
-    donation = models.OneToOneField(Donation, on_delete=models.CASCADE, primary_key=True)
+    # a view, deleting a donation must not try to delete from it
+    donation = models.OneToOneField(Donation, on_delete=models.DO_NOTHING, primary_key=True)
     units = models.IntegerField()
     blood_type = models.CharField(max_length=10, choices=AVAILABLE_TYPES_CHOICES)
     donation_date = models.DateTimeField()
+    high_priority_at = models.DateTimeField()
+    expires_at = models.DateTimeField()
 
     class Meta:
         managed = False
@@ -122,10 +333,12 @@ class OutstandingDonations(models.Model):
 
 @reversion.register
 class OutstandingDonationsMCI(models.Model):
-    donation = models.OneToOneField(Donation, on_delete=models.CASCADE, primary_key=True)
+    donation = models.OneToOneField(Donation, on_delete=models.DO_NOTHING, primary_key=True)
     units = models.IntegerField()
     blood_type = models.CharField(max_length=10, choices=AVAILABLE_TYPES_CHOICES)
     donation_date = models.DateTimeField()
+    high_priority_at = models.DateTimeField()
+    expires_at = models.DateTimeField()
 
     class Meta:
         managed = False
@@ -155,7 +368,11 @@ class IssueRequest(models.Model):
         on_delete=models.CASCADE
     )
 
-    request_time = models.DateTimeField(auto_now_add=True, editable=False)
+    request_time = models.DateTimeField(auto_now_add=True, editable=False, db_index=True)
+
+    # the client's key of the submission that created the request, scoped to its user, so a
+    # repeated submission gets this request back instead of a new allocation
+    idempotency_key = models.CharField(max_length=100, null=True, unique=True, editable=False)
 
     def save(self, *args, **kwargs):
         if not self.content_type:
@@ -205,7 +422,7 @@ class BloodTypeDistribution(models.Model):
 
     @property
     def leaf(self) -> 'BloodTypeDistribution':
-        return self.cls.objects.get(id=self.id)
+        return get_distribution(self.id)
 
     @classmethod
     def distribution_type(cls) -> str:
@@ -215,6 +432,9 @@ class BloodTypeDistribution(models.Model):
     def query_required(cls) -> bool:
         return False
 
+    def percentages(self) -> List[Tuple[str, Decimal]]:
+        return self.leaf.percentages()
+
     def blood_types(self, total_units: int) -> List[Tuple[str, int]]:
         if self.cls.query_required:
             return self.leaf.blood_types(total_units)
@@ -231,11 +451,14 @@ class PopulationBloodTypeDistribution(BloodTypeDistribution):
     def blood_types(self, total_units: int) -> List[Tuple[str, int]]:
         result = []
 
-        for p in PopulationBloodTypePercentage.objects.filter(distribution=self):
-            result.append((p.blood_type, ceil(float(total_units) * float(p.percentage) / 100.0)))
+        for blood_type, percentage in self.percentages():
+            result.append((blood_type, ceil(float(total_units) * float(percentage) / 100.0)))
 
         return result
 
+    def percentages(self) -> List[Tuple[str, Decimal]]:
+        return _distributions.percentages(self.id)
+
     @classmethod
     def distribution_type(cls) -> str:
         return POPULATION_BLOOD_TYPE_DISTRIBUTION
@@ -262,10 +485,113 @@ class PopulationBloodTypePercentage(models.Model):
         unique_together = (("distribution_id", "blood_type"))
 
 
+class _DistributionCache:
+    """
+    Process level copy of every distribution, resolved to its leaf class, with the percentage
+    vector of population distributions. Distributions are edited rarely and read on every MCI
+    request, the copy is kept while DistributionVersion stays the same, which the save and
+    delete signals below bump. Ids missing from a current copy don't exist, looking them up
+    doesn't reload it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (version, distributions by id, percentages by distribution id)
+        self._loaded: Optional[Tuple[int, Dict[int, BloodTypeDistribution],
+                                     Dict[int, List[Tuple[str, Decimal]]]]] = None
+
+    def clear(self):
+        self._loaded = None
+
+    def _load(self, version: int):
+        ids_by_type = {}
+        for dist_type, distribution_id in BloodTypeDistribution.objects \
+                .values_list("dist_type", "id"):
+            ids_by_type.setdefault(dist_type, []).append(distribution_id)
+
+        # one query per leaf class rather than one per distribution
+        entries = {}
+        for dist_type, ids in ids_by_type.items():
+            cls = BloodTypeDistribution(dist_type=dist_type).cls
+            entries.update((leaf.id, leaf) for leaf in cls.objects.filter(id__in=ids))
+
+        percentages = {}
+        for distribution_id, blood_type, percentage in PopulationBloodTypePercentage.objects \
+                .order_by("id") \
+                .values_list("distribution_id", "blood_type", "percentage"):
+            percentages.setdefault(distribution_id, []).append((blood_type, percentage))
+
+        self._loaded = (version, entries, percentages)
+
+    def _current(self) -> Tuple[int, Dict[int, BloodTypeDistribution],
+                                Dict[int, List[Tuple[str, Decimal]]]]:
+        # read in the caller's transaction: an uncommitted edit is seen under its new version,
+        # which no longer matches once it rolls back
+        version = DistributionVersion.current()
+        loaded = self._loaded
+
+        if loaded is None or loaded[0] != version:
+            with self._lock:
+                loaded = self._loaded
+
+                if loaded is None or loaded[0] != version:
+                    self._load(version)
+                    loaded = self._loaded
+
+        return loaded
+
+    def get(self, distribution_id: int) -> BloodTypeDistribution:
+        _, entries, _ = self._current()
+
+        if distribution_id not in entries:
+            raise BloodTypeDistribution.DoesNotExist(
+                f"No blood type distribution with id {distribution_id}"
+            )
+
+        # callers may modify or attach the instance, don't hand out the shared one
+        return copy.copy(entries[distribution_id])
+
+    def percentages(self, distribution_id: int) -> List[Tuple[str, Decimal]]:
+        _, _, percentages = self._current()
+        return percentages.get(distribution_id, [])
+
+
+_distributions = _DistributionCache()
+
+
+def get_distribution(distribution_id: int) -> BloodTypeDistribution:
+    """
+    The leaf instance of a distribution, from the process cache.
+    """
+    return _distributions.get(distribution_id)
+
+
+def clear_distribution_cache():
+    """
+    Drop this process' copy of the distributions, for code replacing the rows underneath it.
+    """
+    _distributions.clear()
+
+
+def _distribution_changed(**kwargs):
+    DistributionVersion.objects.filter(id=1).update(version=models.F("version") + 1)
+
+
+for _model in (BloodTypeDistribution, PopulationBloodTypeDistribution,
+               PopulationBloodTypePercentage):
+    post_save.connect(_distribution_changed, sender=_model)
+    post_delete.connect(_distribution_changed, sender=_model)
+
+
 @reversion.register
 class MCIRequest(IssueRequest):
     units = models.IntegerField()
     distribution = models.ForeignKey(BloodTypeDistribution, on_delete=models.CASCADE)
+    allocation = models.CharField(
+        max_length=10,
+        choices=ALLOCATION_CHOICES,
+        default=GREEDY_ALLOCATION
+    )
 
     def __str__(self):
         return f"MCIRequest for {self.units} with {self.distribution} distribution"
@@ -286,15 +612,85 @@ class Issue(models.Model):
         return self.donation.blood_type
 
 
+class DonationArchive(models.Model):
+    """
+    Donations moved out of blood_donation by the archive_donations command once expired or
+    fully issued, with their original ids.
+    """
+    id = models.IntegerField(primary_key=True)
+    donor = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name="+")
+    units = models.IntegerField()
+    # indexed for the hourly rollups, which read donations and expiries by time
+    donation_date = models.DateTimeField(db_index=True)
+    high_priority_at = models.DateTimeField()
+    expires_at = models.DateTimeField(db_index=True)
+    archived_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        db_table = "blood_donation_archive"
+
+
+class IssueArchive(models.Model):
+    id = models.IntegerField(primary_key=True)
+    request = models.ForeignKey(IssueRequest, on_delete=models.CASCADE, related_name="+")
+    donation = models.ForeignKey(DonationArchive, on_delete=models.CASCADE)
+    request_blood_type = models.CharField(max_length=10, choices=AVAILABLE_TYPES_CHOICES)
+    units = models.IntegerField()
+
+    class Meta:
+        db_table = "blood_issue_archive"
+
+
+class DonationHistory(models.Model):
+    """
+    Live and archived donations (a UNION ALL view, see migration 0011), for history and
+    reporting. Like the triggers, the history views have to be dropped and recreated around
+    migrations that remake blood_donation, blood_issue or blood_patient.
+    """
+    id = models.IntegerField(primary_key=True)
+    donor = models.ForeignKey(Patient, on_delete=models.DO_NOTHING, related_name="+")
+    units = models.IntegerField()
+    donation_date = models.DateTimeField()
+    high_priority_at = models.DateTimeField()
+    expires_at = models.DateTimeField()
+    archived = models.BooleanField()
+
+    class Meta:
+        managed = False
+        db_table = "blood_donation_history"
+
+
+class IssueHistory(models.Model):
+    """
+    Live and archived issues, with the blood type of the donation.
+    """
+    id = models.IntegerField(primary_key=True)
+    request = models.ForeignKey(IssueRequest, on_delete=models.DO_NOTHING,
+                                related_name="issue_history")
+    donation = models.ForeignKey(DonationHistory, on_delete=models.DO_NOTHING,
+                                 db_constraint=False)
+    request_blood_type = models.CharField(max_length=10, choices=AVAILABLE_TYPES_CHOICES)
+    blood_type = models.CharField(max_length=10, choices=AVAILABLE_TYPES_CHOICES)
+    units = models.IntegerField()
+    archived = models.BooleanField()
+
+    class Meta:
+        managed = False
+        db_table = "blood_issue_history"
+
+
 @reversion.register
 class Reject(models.Model):
-    time = models.DateTimeField(auto_now_add=True, editable=False)
+    time = models.DateTimeField(auto_now_add=True, editable=False, db_index=True)
 
     request_type = models.ForeignKey(
         ContentType,
         on_delete=models.CASCADE
     )
 
+    # as IssueRequest.idempotency_key, a rejected submission has no request
+    idempotency_key = models.CharField(max_length=100, null=True, unique=True, editable=False)
+
 
 @reversion.register
 class RejectType(models.Model):
@@ -308,6 +704,82 @@ class RejectType(models.Model):
     units = models.IntegerField()
 
 
+class Reservation(models.Model):
+    """
+    Units set aside for a single (patient) or MCI (distribution) request between its
+    confirmation and its commit, which then issues the holds without searching the inventory
+    again. Holds count against the outstanding units until the reservation is committed or
+    expires (see blood.fill_request.reserve_single_request and release_expired_holds).
+    """
+    user = models.ForeignKey(User, null=True, on_delete=models.CASCADE, related_name="+")
+    patient = models.ForeignKey(Patient, null=True, on_delete=models.CASCADE, related_name="+")
+    distribution = models.ForeignKey(BloodTypeDistribution, null=True, on_delete=models.CASCADE,
+                                     related_name="+")
+    allocation = models.CharField(max_length=10, choices=ALLOCATION_CHOICES,
+                                  default=GREEDY_ALLOCATION)
+    units = models.IntegerField()
+    created = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+
+class Hold(models.Model):
+    """
+    Units of one donation held by a reservation, triggers (see migration 0015) add them to the
+    donation's held units in the ledger while the row exists.
+    """
+    reservation = models.ForeignKey(Reservation, on_delete=models.CASCADE)
+    # no constraint, archiving moves the donation out of blood_donation
+    donation = models.ForeignKey(Donation, on_delete=models.DO_NOTHING, db_constraint=False,
+                                 related_name="+")
+    request_blood_type = models.CharField(max_length=10, choices=AVAILABLE_TYPES_CHOICES)
+    units = models.IntegerField()
+
+
+class MCIBatch(models.Model):
+    """
+    An MCI batch submitted with an idempotency key. The digest of its orders and options tells
+    the same batch sent again from a different one reusing the key (see
+    blood.fill_request.replay_mci_batch).
+    """
+    idempotency_key = models.CharField(max_length=100, unique=True)
+    orders = models.IntegerField()
+    payload = models.CharField(max_length=64)
+
+
+class AllocationAudit(models.Model):
+    """
+    Compact audit record of the rows an allocation wrote for one request or reject, attached to
+    the revision as meta data in place of a Version per row (BLOOD_AUDIT_MODE = "compact").
+    """
+    revision = models.ForeignKey(Revision, on_delete=models.CASCADE)
+    owner_type = models.ForeignKey(ContentType, on_delete=models.CASCADE, related_name="+")
+    owner_id = models.CharField(max_length=191)
+    record_type = models.ForeignKey(ContentType, on_delete=models.CASCADE, related_name="+")
+    serialized_data = models.TextField()
+
+
+class RequestProfile(models.Model):
+    """
+    A request profiled on demand (see blood.profiling), its cProfile stats are in
+    BLOOD_PROFILE_DIR under profile_file.
+    """
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+    user = models.ForeignKey(User, null=True, on_delete=models.SET_NULL, related_name="+")
+    method = models.CharField(max_length=10)
+    path = models.CharField(max_length=2000)
+    view_name = models.CharField(max_length=250)
+    status = models.IntegerField()
+    duration_ms = models.FloatField()
+    queries = models.IntegerField()
+    query_ms = models.FloatField()
+    # json list of {"sql", "params", "ms"}
+    sql = models.TextField()
+    profile_file = models.CharField(max_length=250)
+
+    def __str__(self):
+        return f"{self.method} {self.path} ({self.duration_ms:.0f} ms)"
+
+
 reversion.register(User)
 reversion.register(Group)
 reversion.register(Permission)
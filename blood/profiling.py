@@ -0,0 +1,139 @@
+"""
+Profiles single requests on demand. A superuser adds ?_profile=1 or an X-Bloodline-Profile
+header and gets that request run under cProfile, with its queries timed. The profile is saved
+as a pstats file (snakeviz, pstats, ...) and listed in the admin under Request profiles.
+"""
+import cProfile
+import json
+import os
+from time import perf_counter
+from typing import Dict, List
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from blood.models import RequestProfile
+
+PROFILE_PARAMETER = "_profile"
+PROFILE_HEADER = "HTTP_X_BLOODLINE_PROFILE"
+
+
+class _QueryLog:
+    def __init__(self):
+        self.queries: List[Dict] = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = perf_counter()
+
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append({
+                "sql": sql,
+                "params": params if not many else None,
+                "ms": (perf_counter() - start) * 1000
+            })
+
+
+class ProfilingMiddleware:
+    """
+    Requests that don't ask for a profile only pay for a header and query parameter lookup.
+    Allocations the dispatcher runs on its writer thread show up as waiting, not in detail.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if PROFILE_HEADER not in request.META and request.GET.get(PROFILE_PARAMETER) != "1":
+            return self.get_response(request)
+
+        if not (request.user.is_authenticated and request.user.is_superuser):
+            return self.get_response(request)
+
+        return self.profile(request)
+
+    def profile(self, request):
+        profiler = cProfile.Profile()
+        log = _QueryLog()
+        start = perf_counter()
+
+        try:
+            profiler.enable()
+        except ValueError:
+            # another profiler is already running in this thread
+            return self.get_response(request)
+
+        try:
+            with connection.execute_wrapper(log):
+                response = self.get_response(request)
+        finally:
+            profiler.disable()
+
+        filename = f"{timezone.now():%Y%m%d-%H%M%S-%f}.prof"
+        response["X-Bloodline-Profile"] = filename
+
+        if response.streaming:
+            response.streaming_content = self.stream(response.streaming_content, request,
+                                                     response, profiler, log, start, filename)
+        else:
+            self.save(request, response, profiler, log, start, filename)
+
+        return response
+
+    def stream(self, content, request, response, profiler: cProfile.Profile, log: _QueryLog,
+               start: float, filename: str):
+        # the body is built while the next chunk is pulled, writing it out isn't profiled
+        chunks = iter(content)
+
+        try:
+            with connection.execute_wrapper(log):
+                while True:
+                    profiler.enable()
+                    try:
+                        chunk = next(chunks)
+                    except StopIteration:
+                        return
+                    finally:
+                        profiler.disable()
+
+                    yield chunk
+        finally:
+            self.save(request, response, profiler, log, start, filename)
+
+    def save(self, request, response, profiler: cProfile.Profile, log: _QueryLog, start: float,
+             filename: str):
+        duration = perf_counter() - start
+        directory = settings.BLOOD_PROFILE_DIR
+        os.makedirs(directory, exist_ok=True)
+        profiler.dump_stats(os.path.join(directory, filename))
+
+        match = request.resolver_match
+
+        RequestProfile.objects.create(
+            user=request.user,
+            method=request.method,
+            path=request.get_full_path()[:2000],
+            view_name=match.view_name if match is not None else "",
+            status=response.status_code,
+            duration_ms=duration * 1000,
+            queries=len(log.queries),
+            query_ms=sum(query["ms"] for query in log.queries),
+            sql=json.dumps(log.queries, default=str),
+            profile_file=filename
+        )
+
+        _prune(directory)
+
+
+def _prune(directory: str):
+    old = RequestProfile.objects.order_by("-created", "-id")[settings.BLOOD_PROFILE_KEEP:]
+
+    for profile in list(old):
+        try:
+            os.remove(os.path.join(directory, profile.profile_file))
+        except FileNotFoundError:
+            pass
+
+        profile.delete()
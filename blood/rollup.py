@@ -0,0 +1,336 @@
+"""
+Hourly rollups of the inventory per blood type (blood_inventory_rollup), so reports over weeks
+or months read a row per hour and blood type instead of replaying donations and issues.
+
+roll_up carries the rollups forward from the watermark one range of complete hours at a time,
+reading only the rows dated within that range through the time indexes, live and archived
+alike. The stock at the end of each hour follows from the stock an hour earlier. Rows that
+arrive dated before the watermark (imported or synced donations) are found by id, and the
+rollups are recomputed from their hour on, and so are they from the hour of a donation or issue
+changed or deleted after the fact, which triggers record on the watermark.
+"""
+from datetime import datetime, timedelta
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from django.db import connection, transaction
+from django.db.models import Max, Min
+from django.utils import timezone
+
+from blood.blood_types import AVAILABLE_TYPES
+from blood.fill_request import lock_inventory
+from blood.models import Donation, DonationArchive, InventoryRollup, Issue, IssueRequest, \
+    Reject, RollupWatermark
+
+HOURLY = "hour"
+DAILY = "day"
+
+# hours recomputed per transaction, allocations wait for the write lock meanwhile
+MAX_HOURS = 24 * 7
+
+COLUMNS = ["stock", "donated", "issued", "rejected", "expired"]
+
+_HOUR = "strftime('%%Y-%%m-%%d %%H:00:00', {})"
+
+_DONATED = f"""
+SELECT {_HOUR.format("d.donation_date")}, bp.blood_type, SUM(d.units)
+FROM (
+    SELECT donor_id, units, donation_date FROM blood_donation
+    WHERE donation_date >= %s AND donation_date < %s
+    UNION ALL
+    SELECT donor_id, units, donation_date FROM blood_donation_archive
+    WHERE donation_date >= %s AND donation_date < %s
+) d JOIN blood_patient bp ON bp.id = d.donor_id
+GROUP BY 1, 2
+"""
+
+# by the donor's blood type, the stock the units left
+_ISSUED = f"""
+SELECT {_HOUR.format("i.request_time")}, bp.blood_type, SUM(i.units)
+FROM (
+    SELECT r.request_time, bd.donor_id, bi.units
+    FROM
+        blood_issuerequest r
+        JOIN blood_issue bi ON bi.request_id = r.id
+        JOIN blood_donation bd ON bd.id = bi.donation_id
+    WHERE r.request_time >= %s AND r.request_time < %s
+    UNION ALL
+    SELECT r.request_time, ad.donor_id, ai.units
+    FROM
+        blood_issuerequest r
+        JOIN blood_issue_archive ai ON ai.request_id = r.id
+        JOIN blood_donation_archive ad ON ad.id = ai.donation_id
+    WHERE r.request_time >= %s AND r.request_time < %s
+) i JOIN blood_patient bp ON bp.id = i.donor_id
+GROUP BY 1, 2
+"""
+
+_REJECTED = f"""
+SELECT {_HOUR.format("r.time")}, rt.blood_type, SUM(rt.units)
+FROM blood_reject r JOIN blood_rejecttype rt ON rt.reject_id = r.id
+WHERE r.time >= %s AND r.time < %s
+GROUP BY 1, 2
+"""
+
+# what was left on a donation when it expired, no unit is issued after that
+_EXPIRED = f"""
+SELECT {_HOUR.format("d.expires_at")}, bp.blood_type, SUM(d.units)
+FROM (
+    SELECT bd.expires_at, bd.donor_id,
+        bd.units - IFNULL((SELECT SUM(units) FROM blood_issue WHERE donation_id = bd.id), 0)
+        AS units
+    FROM blood_donation bd
+    WHERE bd.expires_at >= %s AND bd.expires_at < %s
+    UNION ALL
+    SELECT ad.expires_at, ad.donor_id,
+        ad.units - IFNULL(
+            (SELECT SUM(units) FROM blood_issue_archive WHERE donation_id = ad.id), 0
+        ) AS units
+    FROM blood_donation_archive ad
+    WHERE ad.expires_at >= %s AND ad.expires_at < %s
+) d JOIN blood_patient bp ON bp.id = d.donor_id
+GROUP BY 1, 2
+"""
+
+# (column, query, times the range is repeated in its parameters)
+_MOVEMENTS = [
+    ("donated", _DONATED, 2),
+    ("issued", _ISSUED, 2),
+    ("rejected", _REJECTED, 1),
+    ("expired", _EXPIRED, 2),
+]
+
+# a day's stock is the stock of its last hour with a row: an hour without one has no stock,
+# and neither has any hour after it without a movement
+_DAILY = """
+SELECT date(hour), blood_type, MAX(hour), stock, SUM(donated), SUM(issued), SUM(rejected),
+    SUM(expired)
+FROM blood_inventory_rollup
+WHERE hour >= %s AND hour < %s AND blood_type IN ({})
+GROUP BY 1, 2
+"""
+
+# datetime() keeps the hour a string, like date() does the day, rather than converted
+_HOURLY = """
+SELECT datetime(hour), blood_type, stock, donated, issued, rejected, expired
+FROM blood_inventory_rollup
+WHERE hour >= %s AND hour < %s AND blood_type IN ({})
+"""
+
+
+class RollupResult(NamedTuple):
+    start: Optional[datetime]
+    end: Optional[datetime]
+    rows: int
+
+
+def _datetime(value: datetime) -> str:
+    return connection.ops.adapt_datetimefield_value(value)
+
+
+def _hour(value: datetime) -> datetime:
+    return value.replace(minute=0, second=0, microsecond=0)
+
+
+def _key(value: datetime) -> str:
+    return value.strftime("%Y-%m-%d %H:00:00")
+
+
+def _earliest(*values: Optional[datetime]) -> Optional[datetime]:
+    return min((value for value in values if value is not None), default=None)
+
+
+def _first_row() -> Optional[datetime]:
+    return _earliest(
+        Donation.objects.aggregate(t=Min("donation_date"))["t"],
+        DonationArchive.objects.aggregate(t=Min("donation_date"))["t"],
+        IssueRequest.objects.aggregate(t=Min("request_time"))["t"],
+        Reject.objects.aggregate(t=Min("time"))["t"]
+    )
+
+
+def _first_new_row(watermark: RollupWatermark) -> Optional[datetime]:
+    # the rows after the ids are a short primary key range
+    return _earliest(
+        Donation.objects.filter(id__gt=watermark.donation_id)
+        .aggregate(t=Min("donation_date"))["t"],
+        Issue.objects.filter(id__gt=watermark.issue_id)
+        .aggregate(t=Min("request__request_time"))["t"],
+        Reject.objects.filter(id__gt=watermark.reject_id).aggregate(t=Min("time"))["t"]
+    )
+
+
+def _roll_up_range(start: datetime, end: datetime) -> int:
+    """
+    Recompute the rollups of the hours from start until end, dropping those after. Returns the
+    number of rows written.
+    """
+    movements: Dict[Tuple[str, str], Dict[str, int]] = {}
+
+    with connection.cursor() as cursor:
+        for column, sql, repeat in _MOVEMENTS:
+            cursor.execute(sql, [_datetime(start), _datetime(end)] * repeat)
+
+            for hour, blood_type, units in cursor.fetchall():
+                movements.setdefault((hour, blood_type), {})[column] = units
+
+        cursor.execute(
+            "SELECT blood_type, stock FROM blood_inventory_rollup WHERE hour = %s",
+            [_datetime(start - timedelta(hours=1))]
+        )
+        stock = dict(cursor.fetchall())
+
+        cursor.execute("DELETE FROM blood_inventory_rollup WHERE hour >= %s", [_datetime(start)])
+
+    rows = []
+    hour = start
+    while hour < end:
+        key = _key(hour)
+
+        for blood_type in AVAILABLE_TYPES:
+            moved = movements.get((key, blood_type))
+
+            if moved is None and not stock.get(blood_type):
+                continue
+
+            moved = moved or {}
+            stock[blood_type] = stock.get(blood_type, 0) + moved.get("donated", 0) - \
+                moved.get("issued", 0) - moved.get("expired", 0)
+
+            rows.append(InventoryRollup(
+                hour=hour,
+                blood_type=blood_type,
+                stock=stock[blood_type],
+                donated=moved.get("donated", 0),
+                issued=moved.get("issued", 0),
+                rejected=moved.get("rejected", 0),
+                expired=moved.get("expired", 0)
+            ))
+
+        hour += timedelta(hours=1)
+
+    InventoryRollup.objects.bulk_create(rows, batch_size=1000)
+    return len(rows)
+
+
+@transaction.atomic
+def roll_up(now: Optional[datetime] = None, max_hours: int = MAX_HOURS) -> RollupResult:
+    """
+    Carry the rollups forward by up to max_hours of the complete hours before now, from the
+    watermark or from the hour of the earliest row that arrived late or changed. Returns the
+    range rolled up, empty once the rollups are current.
+    """
+    # holds writers off, so no row commits with an id below the ones recorded here
+    lock_inventory()
+
+    now = now or timezone.now()
+    watermark = RollupWatermark.objects.get(id=1)
+
+    last_ids = {
+        "donation_id": Donation.objects.aggregate(id=Max("id"))["id"],
+        "issue_id": Issue.objects.aggregate(id=Max("id"))["id"],
+        "reject_id": Reject.objects.aggregate(id=Max("id"))["id"],
+    }
+
+    if watermark.hour is None:
+        start = _first_row()
+    else:
+        start = _earliest(watermark.hour, _first_new_row(watermark), watermark.changed_from)
+
+    if start is None:
+        return RollupResult(None, None, 0)
+
+    start = _hour(start)
+    end = min(_hour(now), start + timedelta(hours=max_hours))
+
+    if start >= end:
+        return RollupResult(None, None, 0)
+
+    rows = _roll_up_range(start, end)
+
+    watermark.hour = end
+    watermark.changed_from = None
+    for field, value in last_ids.items():
+        # archiving may have emptied a table, the ids are never reused
+        if value is not None:
+            setattr(watermark, field, max(value, getattr(watermark, field)))
+    watermark.save()
+
+    return RollupResult(start, end, rows)
+
+
+@transaction.atomic
+def reset():
+    """
+    Drop every rollup, the next roll_up starts over from the first row.
+    """
+    lock_inventory()
+
+    InventoryRollup.objects.all().delete()
+    RollupWatermark.objects.filter(id=1).update(
+        hour=None, donation_id=0, issue_id=0, reject_id=0, changed_from=None
+    )
+
+
+def rolled_up_until() -> Optional[datetime]:
+    return RollupWatermark.objects.values_list("hour", flat=True).get(id=1)
+
+
+def _periods(since: datetime, until: datetime, resolution: str) -> List[str]:
+    if resolution == DAILY:
+        day, last = since.date(), (until - timedelta(microseconds=1)).date()
+        periods = []
+        while day <= last:
+            periods.append(day.isoformat())
+            day += timedelta(days=1)
+        return periods
+
+    periods = []
+    hour = _hour(since)
+    if hour < since:
+        hour += timedelta(hours=1)
+    while hour < until:
+        periods.append(_key(hour))
+        hour += timedelta(hours=1)
+    return periods
+
+
+def history(since: datetime, until: datetime, blood_types: Sequence[str] = AVAILABLE_TYPES,
+            resolution: str = DAILY) -> List[Tuple]:
+    """
+    Rows of (period, blood_type, *COLUMNS) per hour or UTC day from since until until, cut at
+    what has been rolled up, for every period and blood type including those without a rollup
+    row. A day's stock is the stock at its end, its movements the sum of its hours.
+    """
+    end = rolled_up_until()
+    if end is None:
+        return []
+
+    until = min(until, end)
+    if since >= until:
+        return []
+
+    if resolution == DAILY:
+        # whole days, the stock at the end of the last one
+        since = datetime.combine(since.date(), datetime.min.time(), tzinfo=since.tzinfo)
+
+    sql = (_DAILY if resolution == DAILY else _HOURLY).format(
+        ", ".join(["%s"] * len(blood_types))
+    )
+
+    found: Dict[Tuple[str, str], Tuple] = {}
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [_datetime(since), _datetime(until)] + list(blood_types))
+
+        for row in cursor.fetchall():
+            if resolution == DAILY:
+                period, blood_type, _, *values = row
+            else:
+                period, blood_type, *values = row
+            found[(period, blood_type)] = tuple(values)
+
+    empty = (0,) * len(COLUMNS)
+    return [
+        (period, blood_type) + found.get((period, blood_type), empty)
+        for period in _periods(since, until, resolution)
+        for blood_type in blood_types
+    ]
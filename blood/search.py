@@ -0,0 +1,101 @@
+"""
+Patient search over the blood_patient_search FTS5 index (see migration 0013), which triggers
+keep in step with blood_patient: names, phone numbers and id prefixes, as you type.
+"""
+import re
+from typing import List, Optional
+
+from django.db import connection
+from django.db.models import QuerySet
+from django.db.models.expressions import RawSQL
+
+from blood.models import Patient
+
+MAX_RESULTS = 50
+MAX_TERMS = 5
+
+# Ranking scores every match, fine for a few hundred but not for the tens of thousands a short
+# prefix matches over millions of patients. Larger candidate sets are taken in index order.
+RANKED_CANDIDATES = 200
+
+# id, first name, last name, phone number
+_WEIGHTS = "10.0, 4.0, 4.0, 2.0"
+
+_TERM = re.compile(r"\w+")
+
+
+def match_expression(text: str, prefix: bool = True) -> Optional[str]:
+    """
+    An FTS5 query for every term of text, the last one (as it is being typed) or all of them
+    as prefixes. None if text has no terms.
+    """
+    terms = _TERM.findall(text.lower())[:MAX_TERMS]
+    if not terms:
+        return None
+
+    return " AND ".join(f'"{term}"*' if prefix else f'"{term}"' for term in terms)
+
+
+def _matches(expression: str, limit: int) -> List[str]:
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT patient_id FROM blood_patient_search WHERE blood_patient_search MATCH %s "
+            "LIMIT %s",
+            [expression, RANKED_CANDIDATES + 1]
+        )
+        ids = [row[0] for row in cursor.fetchall()]
+
+        if len(ids) > RANKED_CANDIDATES:
+            return ids[:limit]
+
+        cursor.execute(
+            "SELECT patient_id FROM blood_patient_search WHERE blood_patient_search MATCH %s "
+            f"ORDER BY bm25(blood_patient_search, {_WEIGHTS}) LIMIT %s",
+            [expression, limit]
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def search_ids(text: str, limit: int = 10) -> List[str]:
+    """
+    Ids of the patients best matching text: those matching every term exactly first, then by
+    prefix.
+    """
+    limit = min(limit, MAX_RESULTS)
+    ids: List[str] = []
+
+    for prefix in (False, True):
+        expression = match_expression(text, prefix)
+        if expression is None:
+            break
+
+        for patient_id in _matches(expression, limit):
+            if patient_id not in ids:
+                ids.append(patient_id)
+
+        if len(ids) >= limit:
+            break
+
+    return ids[:limit]
+
+
+def search(text: str, limit: int = 10) -> List[Patient]:
+    ids = search_ids(text, limit)
+    patients = Patient.objects.in_bulk(ids)
+
+    return [patients[patient_id] for patient_id in ids if patient_id in patients]
+
+
+def filter_matching(queryset: QuerySet, text: str) -> Optional[QuerySet]:
+    """
+    The patients of queryset matching every term of text by prefix, in the queryset's own
+    order. None if text has no terms.
+    """
+    expression = match_expression(text)
+    if expression is None:
+        return None
+
+    return queryset.filter(id__in=RawSQL(
+        "SELECT patient_id FROM blood_patient_search WHERE blood_patient_search MATCH %s",
+        [expression]
+    ))
@@ -0,0 +1,204 @@
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from django.db import connection
+from django.utils import timezone
+import numpy as np
+
+from blood.blood_types import AVAILABLE_TYPES, CAN_DONATE, CAN_RECEIVE, MAX_BLOOD_AGE_DAYS, \
+    OPTIMAL_ALLOCATION
+from blood.models import BloodTypeDistribution
+
+TYPE_INDEX = {blood_type: i for i, blood_type in enumerate(AVAILABLE_TYPES)}
+
+# the allocation mode the simulation answers for, the greedy one may fill less
+ALLOCATION = OPTIMAL_ALLOCATION
+
+# Serving the most constrained recipients first, each from the least versatile donors first,
+# leaves the most room for everyone else; for this compatibility table it reaches the maximum
+# flow, so a shortfall here is a shortfall of the optimal allocation too
+_PASSES = [
+    (TYPE_INDEX[recipient], TYPE_INDEX[donor])
+    for recipient in sorted(AVAILABLE_TYPES, key=lambda blood_type: len(CAN_RECEIVE[blood_type]))
+    for donor in sorted(CAN_RECEIVE[recipient],
+                        key=lambda blood_type: (len(CAN_DONATE[blood_type]),
+                                                TYPE_INDEX[blood_type]))
+]
+
+_STOCK_BY_EXPIRY_DAY = """
+SELECT
+    blood_type,
+    CAST(julianday(expires_at) - julianday(%s) AS INTEGER) AS day,
+    SUM(units - held)
+FROM blood_remaining_units
+WHERE units > 0 AND units > held AND expires_at > %s
+GROUP BY blood_type, day
+"""
+
+
+def needs(percentages: np.ndarray, units: np.ndarray) -> np.ndarray:
+    """
+    Units needed per blood type, the way MCI requests split their units: rounded up per type.
+    Broadcasts (..., types) percentages against (...) units.
+    """
+    return np.ceil(np.asarray(units, dtype=float)[..., None] * percentages / 100.0).astype(np.int64)
+
+
+def allocate(stock: np.ndarray, demand: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Serve (..., types) demand from (..., types) donor stock, both broadcast against each other.
+    Returns the shortfall per requested blood type and the stock left over.
+    """
+    stock, demand = np.broadcast_arrays(stock, demand)
+    stock = stock.copy()
+    shortfall = demand.copy()
+
+    for recipient, donor in _PASSES:
+        take = np.minimum(stock[..., donor], shortfall[..., recipient])
+        stock[..., donor] -= take
+        shortfall[..., recipient] -= take
+
+    return shortfall, stock
+
+
+def max_fillable(stock: np.ndarray, percentages: np.ndarray) -> np.ndarray:
+    """
+    The largest request, in units, each (..., types) percentage vector can have filled from the
+    (..., types) stock it is broadcast against.
+    """
+    stock, percentages = np.broadcast_arrays(stock, percentages)
+    total_percent = percentages.sum(axis=-1)
+
+    # every type is rounded up, so a request never needs less than its share of the units
+    upper = np.where(
+        total_percent > 0,
+        np.floor(stock.sum(axis=-1) * 100.0 / np.maximum(total_percent, 1e-9)),
+        0
+    ).astype(np.int64)
+
+    low = np.zeros(upper.shape, dtype=np.int64)
+    high = upper + 1
+
+    while True:
+        open_ = high - low > 1
+        if not open_.any():
+            return low
+
+        middle = (low + high) // 2
+        shortfall, _ = allocate(stock, needs(percentages, middle))
+        fits = shortfall.sum(axis=-1) == 0
+
+        low = np.where(open_ & fits, middle, low)
+        high = np.where(open_ & ~fits, middle, high)
+
+
+class InventorySimulator:
+    """
+    What-if questions against a snapshot of the outstanding inventory, held as a
+    (blood type, expiry day) array so that no units are issued to answer them.
+
+    Day d of the snapshot holds the units expiring between d and d + 1 days after it was
+    taken, the units still usable d days ahead are the ones in day d and later. Requests are
+    filled as the optimal allocation fills them (ALLOCATION).
+    """
+
+    def __init__(self, stock: np.ndarray, taken_at: datetime):
+        self.stock = stock
+        self.taken_at = taken_at
+
+    @classmethod
+    def load(cls, now: Optional[datetime] = None) -> 'InventorySimulator':
+        now = now or timezone.now()
+        stock = np.zeros((len(AVAILABLE_TYPES), MAX_BLOOD_AGE_DAYS + 1), dtype=np.int64)
+        value = connection.ops.adapt_datetimefield_value(now)
+
+        with connection.cursor() as cursor:
+            cursor.execute(_STOCK_BY_EXPIRY_DAY, [value, value])
+
+            for blood_type, day, units in cursor.fetchall():
+                stock[TYPE_INDEX[blood_type], min(day, MAX_BLOOD_AGE_DAYS)] += units
+
+        return cls(stock, now)
+
+    def available(self, days: Iterable[int]) -> np.ndarray:
+        """
+        Units per blood type still usable after each of the given days, shape (days, types).
+        """
+        usable = np.cumsum(self.stock[:, ::-1], axis=1)[:, ::-1]
+        usable = np.concatenate([usable, np.zeros((len(AVAILABLE_TYPES), 1), np.int64)], axis=1)
+        days = np.clip(np.asarray(list(days), dtype=np.int64), 0, usable.shape[1] - 1)
+
+        return usable[:, days].T
+
+    def capacity(self, percentages: np.ndarray, days: Iterable[int] = (0,)) -> np.ndarray:
+        """
+        Largest fillable MCI request for each (scenarios, types) percentage vector on each day,
+        shape (scenarios, days).
+        """
+        return max_fillable(self.available(days)[None, :, :], percentages[:, None, :])
+
+    def shortfall(self, percentages: np.ndarray, units: np.ndarray,
+                  days: Iterable[int] = (0,)) -> np.ndarray:
+        """
+        Units missing per blood type if each scenario's request arrived on each day, shape
+        (scenarios, days, types).
+        """
+        shortfall, _ = allocate(
+            self.available(days)[None, :, :],
+            needs(percentages, units)[:, None, :]
+        )
+
+        return shortfall
+
+    def orders(self, percentages: np.ndarray, units: Sequence[int], day: int = 0) -> np.ndarray:
+        """
+        Shortfall per blood type of a sequence of requests served one after the other on the
+        given day, shape (orders, types).
+        """
+        stock = self.available([day])[0]
+        result = []
+
+        for demand in needs(percentages, np.asarray(units)):
+            shortfall, stock = allocate(stock, demand)
+            result.append(shortfall)
+
+        return np.array(result).reshape(len(result), len(AVAILABLE_TYPES))
+
+
+def percentage_vector(distribution: BloodTypeDistribution) -> np.ndarray:
+    vector = np.zeros(len(AVAILABLE_TYPES))
+
+    for blood_type, percentage in distribution.percentages():
+        vector[TYPE_INDEX[blood_type]] = float(percentage)
+
+    return vector
+
+
+def percentage_matrix(distributions: Iterable[BloodTypeDistribution]) -> np.ndarray:
+    return np.array([percentage_vector(distribution) for distribution in distributions]) \
+        .reshape(-1, len(AVAILABLE_TYPES))
+
+
+def projection(simulator: InventorySimulator, distribution: BloodTypeDistribution, units: int,
+               horizon: int) -> List[Dict]:
+    """
+    Day by day outlook of one distribution: usable stock, the largest fillable request and the
+    shortfall of a request for `units`.
+    """
+    days = list(range(horizon + 1))
+    percentages = percentage_matrix([distribution])
+
+    available = simulator.available(days)
+    capacity = simulator.capacity(percentages, days)[0]
+    shortfall = simulator.shortfall(percentages, np.array([units]), days)[0]
+
+    return [
+        {
+            "day": day,
+            "available": dict(zip(AVAILABLE_TYPES, available[i].tolist())),
+            "capacity": int(capacity[i]),
+            "shortfall": dict(zip(AVAILABLE_TYPES, shortfall[i].tolist())),
+            "missing": int(shortfall[i].sum())
+        }
+        for i, day in enumerate(days)
+    ]
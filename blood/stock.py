@@ -0,0 +1,79 @@
+from datetime import datetime, time, timedelta
+import threading
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from django.db import transaction
+from django.db.models import F, Min, Sum
+from django.utils import timezone
+
+from blood.models import InventoryVersion, RemainingUnits, StockTotal
+
+
+class StockTotals(NamedTuple):
+    key: Tuple[int, int]
+    # rows of {"blood_type", "outstanding"} ordered by blood type, like the old aggregate
+    outstanding: List[Dict]
+    valid_until: Optional[datetime]
+    etag: str
+
+
+def _compute(version: int, epoch: int, now: datetime) -> StockTotals:
+    today = now.date()
+    tomorrow = datetime.combine(today + timedelta(days=1), time.min, tzinfo=now.tzinfo)
+    totals: Dict[str, int] = {}
+
+    # days after today are whole, today's bucket is partly expired so count its rows exactly
+    for blood_type, units in StockTotal.objects \
+            .filter(expires_on__gt=today) \
+            .values("blood_type") \
+            .annotate(total=Sum("units")) \
+            .values_list("blood_type", "total"):
+        totals[blood_type] = totals.get(blood_type, 0) + units
+
+    for blood_type, units in RemainingUnits.objects \
+            .filter(units__gt=0, expires_at__gt=now, expires_at__lt=tomorrow) \
+            .values("blood_type") \
+            .annotate(total=Sum(F("units") - F("held"))) \
+            .values_list("blood_type", "total"):
+        totals[blood_type] = totals.get(blood_type, 0) + units
+
+    # without any change to the inventory, the totals hold until the next donation expires
+    valid_until = RemainingUnits.objects \
+        .filter(units__gt=0, expires_at__gt=now) \
+        .aggregate(next_expiry=Min("expires_at"))["next_expiry"]
+
+    return StockTotals(
+        key=(version, epoch),
+        outstanding=[
+            {"blood_type": blood_type, "outstanding": totals[blood_type]}
+            for blood_type in sorted(totals)
+            if totals[blood_type] > 0
+        ],
+        valid_until=valid_until,
+        etag=f"{version}.{epoch}.{int(valid_until.timestamp()) if valid_until else 0}"
+    )
+
+
+_cached: Optional[StockTotals] = None
+_lock = threading.Lock()
+
+
+def stock_totals() -> StockTotals:
+    """
+    Outstanding units per blood type. Costs one read of the inventory version while nothing
+    changed and no donation expired, the etag changes whenever the totals may have.
+    """
+    global _cached
+
+    with transaction.atomic():
+        version, epoch = InventoryVersion.current()
+        now = timezone.now()
+        cached = _cached
+
+        if cached is not None and cached.key == (version, epoch) and \
+                (cached.valid_until is None or now < cached.valid_until):
+            return cached
+
+        with _lock:
+            _cached = _compute(version, epoch, now)
+            return _cached
@@ -0,0 +1,193 @@
+"""
+Delta sync for offline collection clients: a change feed of patients and deleted patients
+ordered by Patient.sync_version, and batch submission of donations keyed by client generated ids.
+"""
+from typing import Dict, List, Optional, Tuple
+
+from django.db import transaction
+import reversion
+
+from blood import audit
+from blood.blood_types import AVAILABLE_TYPES
+from blood.donation_import import PATIENT_FIELDS, update_patients
+from blood.fill_request import lock_inventory
+from blood.forms import ImportedDonation
+from blood.models import Donation, DonationSubmission, Patient, PatientTombstone
+
+FEED_FIELDS = ["id"] + PATIENT_FIELDS + ["sync_version"]
+
+FEED_PAGE_SIZE = 500
+MAX_FEED_PAGE_SIZE = 5000
+MAX_SUBMISSION = 1000
+
+CREATED = "created"
+DUPLICATE = "duplicate"
+CONFLICT = "conflict"
+INVALID = "invalid"
+
+
+def patient_changes(after: Optional[int], limit: int = FEED_PAGE_SIZE) -> Dict:
+    """
+    Patients created or changed after the cursor, as rows of FEED_FIELDS rather than objects
+    to keep the payload small, and the ids of the patients deleted since, which clients drop
+    before applying the rows. The cursor of the last change resumes the feed; the first page
+    carries the blood types instead of deletions, the client has no patients yet.
+    """
+    patients = Patient.objects.order_by("sync_version")
+    deleted: List[Tuple[str, int]] = []
+    if after is not None:
+        patients = patients.filter(sync_version__gt=after)
+        deleted = list(
+            PatientTombstone.objects
+            .filter(sync_version__gt=after)
+            .order_by("sync_version")
+            .values_list("patient_id", "sync_version")[:limit + 1]
+        )
+
+    rows = [
+        [
+            value.isoformat() if field == "birthday" else value
+            for field, value in zip(FEED_FIELDS, row)
+        ]
+        for row in patients.values_list(*FEED_FIELDS)[:limit + 1]
+    ]
+
+    # both share the version sequence, the page is the first limit changes of either
+    versions = sorted([row[-1] for row in rows] + [version for _, version in deleted])
+    more = len(versions) > limit
+    versions = versions[:limit]
+    if more:
+        rows = [row for row in rows if row[-1] <= versions[-1]]
+        deleted = [(patient, version) for patient, version in deleted if version <= versions[-1]]
+
+    changes = {
+        "fields": FEED_FIELDS,
+        "patients": rows,
+        "deleted": [patient for patient, _ in deleted],
+        "cursor": versions[-1] if versions else after,
+        "more": more
+    }
+
+    if after is None:
+        changes["blood_types"] = AVAILABLE_TYPES
+
+    return changes
+
+
+def _result(client_id, status: str, **extra) -> Dict:
+    return dict({"client_id": client_id, "status": status}, **extra)
+
+
+@transaction.atomic
+def submit_donations(items: List[Dict], user=None) -> List[Dict]:
+    """
+    Collect a batch of donations, answering with the outcome of each in order:
+
+    - created, with the new donation_id
+    - duplicate, the client_id was submitted before, with the donation_id it created
+    - conflict, the donor's blood type on record differs, with the patient as on record. The
+      item is collected once sent again with "confirm_blood_type": true
+    - invalid, with the form errors
+
+    Validation follows the donation form, donor details are updated like Patient.update does.
+    """
+    results: List[Optional[Dict]] = [None] * len(items)
+    valid: List[Tuple[int, str, Dict, bool]] = []
+    form = ImportedDonation()
+
+    for i, item in enumerate(items):
+        client_id = item.get("client_id")
+
+        if not isinstance(client_id, str) or not 0 < len(client_id) <= 64:
+            results[i] = _result(client_id, INVALID, errors={
+                "client_id": ["A client_id of up to 64 characters is required."]
+            })
+        elif not form.validate(item):
+            results[i] = _result(client_id, INVALID, errors={
+                field: list(messages) for field, messages in form.errors.items()
+            })
+        else:
+            valid.append((i, client_id, form.cleaned_data, item.get("confirm_blood_type") is True))
+
+    if not valid:
+        return results
+
+    with reversion.create_revision():
+        if user is not None:
+            reversion.set_user(user)
+        reversion.set_comment("Synced donations")
+
+        # the write lock first, the inserted donations are read back by id
+        lock_inventory()
+
+        submitted = dict(DonationSubmission.objects.filter(
+            client_id__in={client_id for _, client_id, _, _ in valid}
+        ).values_list("client_id", "donation_id"))
+        donors: Dict[str, Patient] = Patient.objects.in_bulk(
+            list({data["id_number"] for _, _, data, _ in valid})
+        )
+
+        created: Dict[str, Patient] = {}
+        changed: Dict[str, Patient] = {}
+        # (result index, client_id, donation)
+        collected: List[Tuple[int, str, Donation]] = []
+        # client ids repeated within the batch are answered once their first use has an id
+        repeated: List[Tuple[int, str]] = []
+
+        for i, client_id, data, confirmed in valid:
+            if client_id in submitted:
+                if submitted[client_id] is None:
+                    repeated.append((i, client_id))
+                else:
+                    results[i] = _result(client_id, DUPLICATE, donation_id=submitted[client_id])
+                continue
+
+            patient = donors.get(data["id_number"])
+
+            if patient is None:
+                patient = donors[data["id_number"]] = created[data["id_number"]] = \
+                    Patient(id=data["id_number"])
+            elif patient.blood_type != data["blood_type"] and not confirmed:
+                # a major change, Patient.update's forms would ask for confirmation
+                results[i] = _result(client_id, CONFLICT, patient=dict(
+                    patient.initial_data,
+                    id=patient.id,
+                    birthday=patient.birthday.isoformat(),
+                    sync_version=patient.sync_version
+                ))
+                continue
+
+            if patient.apply(**{field: data[field] for field in PATIENT_FIELDS}) and \
+                    patient.id not in created:
+                changed[patient.id] = patient
+
+            submitted[client_id] = None
+            collected.append((i, client_id, Donation(donor_id=patient.id, units=data["units"],
+                                                     donation_date=data["donation_date"])))
+
+        Patient.objects.bulk_create(created.values())
+        update_patients(list(changed.values()))
+        Donation.objects.bulk_create([donation for _, _, donation in collected])
+
+        # SQLite doesn't return the ids of bulk inserts, under the write lock the newest rows
+        # are the ones just inserted, in order
+        ids = list(Donation.objects.order_by("-id").values_list("id", flat=True)[
+            :len(collected)
+        ])[::-1] if collected else []
+
+        DonationSubmission.objects.bulk_create([
+            DonationSubmission(client_id=client_id, donation_id=donation_id, user=user)
+            for (_, client_id, _), donation_id in zip(collected, ids)
+        ])
+
+        audit.record_donations(donors, list(created.values()) + list(changed.values()),
+                               len(collected))
+
+    for (i, client_id, _), donation_id in zip(collected, ids):
+        submitted[client_id] = donation_id
+        results[i] = _result(client_id, CREATED, donation_id=donation_id)
+
+    for i, client_id in repeated:
+        results[i] = _result(client_id, DUPLICATE, donation_id=submitted[client_id])
+
+    return results
@@ -0,0 +1,179 @@
+"""
+Synthetic data for benchmarking. Nothing in here touches the database or Django models, so
+rows can be generated in worker processes whatever their start method is.
+"""
+from collections import deque
+from datetime import date, datetime, timedelta
+from random import Random
+from typing import Deque, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import faker
+
+from blood.blood_types import AVAILABLE_TYPES, CAN_RECEIVE, MAX_BLOOD_AGE_DAYS
+
+# Patient ids are a permutation of the 10 digit numbers: unique for a seed, random looking
+_ID_BASE = 1_000_000_000
+_ID_SPACE = 9_000_000_000
+_ID_STEP = 982_451_653  # prime, coprime with the id space
+
+_NAME_POOL = 500
+
+PatientRow = Tuple[str, str, str, date, str, bool, Optional[str]]
+DonationRow = Tuple[str, int, datetime]
+
+
+class DatasetSpec(NamedTuple):
+    seed: int
+    blood_types: Sequence[str]
+    weights: Sequence[float]
+    start: datetime
+    seconds: int
+
+
+def patient_id(seed: int, number: int) -> str:
+    return str(_ID_BASE + (seed * 7_919 + number * _ID_STEP) % _ID_SPACE)
+
+
+_names: Dict[int, Tuple[List[str], List[str]]] = {}
+
+
+def _name_pool(seed: int) -> Tuple[List[str], List[str]]:
+    # Faker is slow per call, draw names from a pool made once per seed and process
+    if seed not in _names:
+        fake = faker.Faker()
+        fake.seed_instance(seed)
+
+        _names[seed] = (
+            [fake.first_name() for _ in range(_NAME_POOL)],
+            [fake.last_name() for _ in range(_NAME_POOL)]
+        )
+
+    return _names[seed]
+
+
+def _phone_number(rnd: Random) -> Optional[str]:
+    if rnd.randint(0, 10) >= 8:
+        return None
+
+    return rnd.choice(("054", "08", "03", "07", "02")) + "-" + \
+        str(rnd.randint(1, 9)) + "".join(rnd.choice("1234567890") for _ in range(7))
+
+
+def generate_chunk(spec: DatasetSpec, chunk: int, first: int,
+                   count: int) -> Tuple[List[PatientRow], List[DonationRow]]:
+    """
+    Patients first..first + count - 1 and a donation of each. The same spec and chunk always
+    give the same rows, however the chunks are spread over processes.
+    """
+    rnd = Random(spec.seed * 1_000_003 + chunk)
+    first_names, last_names = _name_pool(spec.seed)
+    today = spec.start.date() + timedelta(seconds=spec.seconds)
+
+    patients = []
+    donations = []
+
+    for number in range(first, first + count):
+        id_number = patient_id(spec.seed, number)
+
+        patients.append((
+            id_number,
+            rnd.choice(first_names),
+            rnd.choice(last_names),
+            today - timedelta(days=rnd.randint(18 * 365, 80 * 365)),
+            rnd.choices(spec.blood_types, spec.weights)[0],
+            rnd.randint(0, 10) >= 8,
+            _phone_number(rnd)
+        ))
+
+        donations.append((
+            id_number,
+            rnd.randint(1, 3),
+            spec.start + timedelta(seconds=rnd.randrange(max(spec.seconds, 1)))
+        ))
+
+    return patients, donations
+
+
+class _Stock:
+    """
+    Donations of one blood type usable at the simulated time, earliest expiring first.
+    """
+
+    def __init__(self, donations: List[List]):
+        # [donation id, remaining units, donation date], ordered by donation date
+        self.pending = deque(donations)
+        self.usable: Deque[List] = deque()
+
+    def advance(self, now: datetime, max_age: timedelta):
+        while self.pending and self.pending[0][2] <= now:
+            self.usable.append(self.pending.popleft())
+
+        while self.usable and (self.usable[0][1] == 0 or self.usable[0][2] + max_age <= now):
+            self.usable.popleft()
+
+
+class HistorySimulator:
+    """
+    Replays requests over generated donations the way the allocation does it, compatible
+    donations that expire first are issued first, so the issue history and what remains of
+    each donation look like the application produced them.
+    """
+
+    def __init__(self, donations: Sequence[Tuple[int, str, int, datetime]]):
+        by_type: Dict[str, List[List]] = {blood_type: [] for blood_type in AVAILABLE_TYPES}
+
+        for donation_id, blood_type, units, donation_date in sorted(donations,
+                                                                    key=lambda row: row[3]):
+            by_type[blood_type].append([donation_id, units, donation_date])
+
+        self.stock = {blood_type: _Stock(rows) for blood_type, rows in by_type.items()}
+        self.max_age = timedelta(days=MAX_BLOOD_AGE_DAYS)
+
+    def advance(self, now: datetime):
+        for stock in self.stock.values():
+            stock.advance(now, self.max_age)
+
+    def request(self, demand: Dict[str, int]) -> Tuple[List[Tuple[int, str, int]],
+                                                       List[Tuple[str, int]]]:
+        """
+        Issue `demand` (units per requested blood type) at the current time, all or nothing.
+        Returns the issues as (donation id, requested blood type, units), or no issues and the
+        missing units per requested blood type.
+        """
+        taken: List[Tuple[List, str, int]] = []
+        missing = []
+
+        for requested, units in demand.items():
+            donors = [self.stock[donor].usable for donor in CAN_RECEIVE[requested]]
+            positions = [0] * len(donors)
+
+            while units > 0:
+                best = None
+
+                for i, usable in enumerate(donors):
+                    while positions[i] < len(usable) and usable[positions[i]][1] == 0:
+                        positions[i] += 1
+
+                    if positions[i] < len(usable) and \
+                            (best is None or usable[positions[i]][2] <
+                             donors[best][positions[best]][2]):
+                        best = i
+
+                if best is None:
+                    missing.append((requested, units))
+                    break
+
+                donation = donors[best][positions[best]]
+                issued = min(donation[1], units)
+                donation[1] -= issued
+                units -= issued
+                taken.append((donation, requested, issued))
+
+        if missing:
+            for donation, _, issued in taken:
+                donation[1] += issued
+
+            return [], missing
+
+        return [(donation[0], requested, issued) for donation, requested, issued in taken], []
+
@@ -1 +1,1552 @@
-# Create your tests here.
+import base64
+from concurrent.futures import ThreadPoolExecutor
+import csv
+from datetime import date, datetime, timedelta
+import io
+from itertools import product
+import json
+import os
+import pstats
+from random import Random
+import re
+import tempfile
+from typing import Dict, List, Optional, Sequence, Tuple
+from unittest import mock
+
+from django.contrib.auth.models import Permission, User
+from django.contrib.contenttypes.models import ContentType
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.models import F, Sum
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+import numpy as np
+import reversion
+from reversion.models import Version
+
+from blood import forecast, inventory, rollup, search, simulation, stock
+from blood.archive import archive_batch
+from blood.blood_types import AVAILABLE_TYPES, CAN_RECEIVE, OPTIMAL_ALLOCATION
+from blood.dispatcher import AllocationDispatcher
+from blood.donation_import import ROW_FIELDS, RowError, import_donations, import_file
+from blood.fill_request import BatchConflict, REJECTED, _plan_optimal, candidate_query, \
+    fill_mci_batch, fill_or_reject_mci_request, fill_or_reject_single_request, hold_ttl, \
+    live_reservation, release_expired_holds, reserve_single_request
+from blood.inventory import InventoryEngine
+from blood.min_cost_flow import MinCostFlow
+from blood.models import AllocationAudit, BloodRank, BloodTypeDistribution, Donation, \
+    DonationArchive, DonationHistory, InventoryRollup, InventoryVersion, Issue, IssueHistory, \
+    IssueRequest, OutstandingDonations, OutstandingDonationsMCI, Patient, Reject, RejectType, \
+    RemainingUnits, Reservation, RequestProfile, RollupWatermark, SingleRequest, StockTotal, \
+    clear_distribution_cache
+
+# Tables that grow with every donation, a plain SCAN of any of them is a regression
+GUARDED_TABLES = ("blood_remaining_units", "blood_donation", "blood_issue", "blood_patient")
+
+_FULL_SCAN = re.compile(r"\bSCAN (?:TABLE )?(" + "|".join(GUARDED_TABLES) + r")\b(?! USING)")
+
+
+def allocation_queries():
+    for blood_type in AVAILABLE_TYPES:
+        yield f"single {blood_type}", candidate_query(
+            OutstandingDonations, CAN_RECEIVE[blood_type], limit=10
+        )
+
+    yield "mci", candidate_query(
+        OutstandingDonationsMCI, AVAILABLE_TYPES, order_by=("expires_at", "donation_id")
+    )
+
+    yield "outstanding totals", OutstandingDonations.objects \
+        .values('blood_type') \
+        .annotate(outstanding=Sum('units')) \
+        .order_by('blood_type')
+
+
+class QueryPlanTests(TestCase):
+    def test_allocation_queries_use_indexes(self):
+        for name, query in allocation_queries():
+            with self.subTest(name):
+                plan = query.explain()
+                self.assertEqual(_FULL_SCAN.findall(plan), [], plan)
+
+
+def _patient(number: int, blood_type: str) -> Patient:
+    return Patient.objects.create(
+        id=str(1_000_000_000 + number),
+        first_name="First",
+        last_name="Last",
+        birthday=date(1980, 1, 1),
+        blood_type=blood_type,
+        smokes=False
+    )
+
+
+def _stock(donations_per_type: int, units: int) -> List[Patient]:
+    """
+    A donor of every blood type, each with donations_per_type donations of units.
+    """
+    donors = [_patient(number, blood_type) for number, blood_type in enumerate(AVAILABLE_TYPES)]
+
+    for donor in donors:
+        for _ in range(donations_per_type):
+            Donation.objects.create(donor=donor, units=units)
+
+    return donors
+
+
+class _LedgerTransactionTestCase(TransactionTestCase):
+    # the flush at the end of each test removes the rows the migrations insert
+    serialized_rollback = True
+
+    def tearDown(self):
+        # the flush empties the tables in no particular order, the ledger triggers would stamp
+        # rows with the version of an already emptied blood_inventory_version
+        Donation.objects.all().delete()
+
+
+class ConcurrentAllocationTests(_LedgerTransactionTestCase):
+    """
+    Allocations from several connections at once, more than the stock covers, must never issue
+    the same units twice.
+    """
+
+    def setUp(self):
+        clear_distribution_cache()
+        self.patients = _stock(donations_per_type=4, units=3)
+        self.distribution = BloodTypeDistribution.objects.first().leaf
+
+        rnd = Random(0)
+        self.jobs = [
+            (fill_or_reject_single_request, (rnd.choice(self.patients), rnd.randint(1, 3)))
+            for _ in range(48)
+        ] + [
+            (fill_or_reject_mci_request, (self.distribution, rnd.randint(2, 8)))
+            for _ in range(12)
+        ]
+        rnd.shuffle(self.jobs)
+
+    def _run(self, call):
+        def job(allocate_args):
+            try:
+                return call(*allocate_args)
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            return list(executor.map(job, self.jobs))
+
+    def assertLedgerConsistent(self, results):
+        # demand is over the stock, some requests were rejected
+        self.assertTrue(any(isinstance(result, Reject) for result in results))
+        self.assertFalse(RemainingUnits.objects.filter(units__lt=0).exists())
+
+        issued = dict(
+            Issue.objects.values("donation_id").annotate(total=Sum("units"))
+            .values_list("donation_id", "total")
+        )
+        remaining = dict(RemainingUnits.objects.values_list("donation_id", "units"))
+
+        for donation_id, units in Donation.objects.values_list("id", "units"):
+            self.assertLessEqual(issued.get(donation_id, 0), units)
+            self.assertEqual(remaining[donation_id], units - issued.get(donation_id, 0))
+
+    def test_inline(self):
+        results = self._run(lambda allocate, args: allocate(*args))
+
+        self.assertLedgerConsistent(results)
+
+    def test_dispatcher(self):
+        dispatcher = AllocationDispatcher(batch_size=4)
+
+        try:
+            results = self._run(
+                lambda allocate, args: dispatcher.submit(allocate, *args).result()
+            )
+        finally:
+            dispatcher.shutdown()
+
+        self.assertLedgerConsistent(results)
+
+
+def _stock_total(blood_type: Optional[str] = None) -> int:
+    totals = StockTotal.objects.all()
+    if blood_type is not None:
+        totals = totals.filter(blood_type=blood_type)
+
+    return totals.aggregate(total=Sum("units"))["total"] or 0
+
+
+class LedgerTests(TestCase):
+    def setUp(self):
+        self.donor = _patient(0, "O-")
+        self.donation = Donation.objects.create(donor=self.donor, units=5)
+
+    def remaining(self) -> RemainingUnits:
+        return RemainingUnits.objects.get(donation=self.donation)
+
+    def test_donation_insert(self):
+        self.assertEqual(self.remaining().units, 5)
+        self.assertEqual(self.remaining().blood_type, "O-")
+        self.assertEqual(_stock_total("O-"), 5)
+
+    def test_issue_insert_and_delete(self):
+        version = InventoryVersion.current()
+        request = SingleRequest.objects.create(patient=self.donor, units=2)
+        issue = Issue.objects.create(request=request, donation=self.donation,
+                                     request_blood_type="O-", units=2)
+
+        self.assertEqual(self.remaining().units, 3)
+        self.assertEqual(_stock_total("O-"), 3)
+        self.assertNotEqual(InventoryVersion.current(), version)
+
+        issue.delete()
+
+        self.assertEqual(self.remaining().units, 5)
+        self.assertEqual(_stock_total("O-"), 5)
+
+    def test_donor_blood_type_change(self):
+        self.donor.blood_type = "A+"
+        self.donor.save()
+
+        self.assertEqual(self.remaining().blood_type, "A+")
+        self.assertEqual(_stock_total("O-"), 0)
+        self.assertEqual(_stock_total("A+"), 5)
+
+
+def _brute_force(supplies: Sequence[int], demands: Sequence[int],
+                 costs: Sequence[Sequence[Optional[int]]]) -> Tuple[int, int]:
+    """
+    The max flow of a transportation problem and its min cost, trying every integer flow.
+    costs[i][j] is None where supply i can't serve demand j.
+    """
+    pairs = [(i, j) for i in range(len(supplies)) for j in range(len(demands))
+             if costs[i][j] is not None]
+    best = (0, 0)
+
+    for flows in product(*(range(min(supplies[i], demands[j]) + 1) for i, j in pairs)):
+        if any(sum(flow for (i, _), flow in zip(pairs, flows) if i == supply) > units
+               for supply, units in enumerate(supplies)):
+            continue
+        if any(sum(flow for (_, j), flow in zip(pairs, flows) if j == demand) > units
+               for demand, units in enumerate(demands)):
+            continue
+
+        total = sum(flows)
+        cost = sum(flow * costs[i][j] for (i, j), flow in zip(pairs, flows))
+        if total > best[0] or (total == best[0] and cost < best[1]):
+            best = (total, cost)
+
+    return best
+
+
+class MinCostFlowTests(TestCase):
+    def test_optimal_on_small_transportation_problems(self):
+        rnd = Random(1)
+
+        for case in range(40):
+            supplies = [rnd.randint(0, 3) for _ in range(3)]
+            demands = [rnd.randint(0, 3) for _ in range(2)]
+            costs = [[rnd.randint(0, 5) if rnd.random() < 0.7 else None for _ in demands]
+                     for _ in supplies]
+
+            source, sink = 0, 1
+            first_demand = 2 + len(supplies)
+            flow = MinCostFlow(first_demand + len(demands))
+            for i, units in enumerate(supplies):
+                flow.add_edge(source, 2 + i, units, 0)
+            for j, units in enumerate(demands):
+                flow.add_edge(first_demand + j, sink, units, 0)
+            for i, j in product(range(len(supplies)), range(len(demands))):
+                if costs[i][j] is not None:
+                    flow.add_edge(2 + i, first_demand + j, demands[j], costs[i][j])
+
+            with self.subTest(case=case, supplies=supplies, demands=demands, costs=costs):
+                self.assertEqual(flow.solve(source, sink), _brute_force(supplies, demands, costs))
+
+    def test_negative_cost(self):
+        with self.assertRaises(ValueError):
+            MinCostFlow(2).add_edge(0, 1, 1, -1)
+
+
+class IdempotencyTests(TestCase):
+    def setUp(self):
+        clear_distribution_cache()
+        self.patients = {patient.blood_type: patient for patient in _stock(2, 3)}
+        self.distribution = BloodTypeDistribution.objects.first().leaf
+
+    def test_single_request_replay(self):
+        first = fill_or_reject_single_request(self.patients["A+"], 2, "1:key")
+        issued = Issue.objects.count()
+
+        self.assertEqual(fill_or_reject_single_request(self.patients["A+"], 2, "1:key"), first)
+        self.assertEqual(Issue.objects.count(), issued)
+
+    def test_reject_replay(self):
+        first = fill_or_reject_single_request(self.patients["O-"], 100, "1:key")
+
+        self.assertIsInstance(first, Reject)
+        self.assertEqual(fill_or_reject_single_request(self.patients["O-"], 100, "1:key"), first)
+        self.assertEqual(Reject.objects.count(), 1)
+
+    def test_batch_replay(self):
+        orders = [(self.distribution, 2), (self.distribution, 100)]
+        first = fill_mci_batch(orders, idempotency_key="1:batch")
+        issued = Issue.objects.count()
+
+        again = fill_mci_batch(orders, idempotency_key="1:batch")
+
+        self.assertEqual(again, first)
+        self.assertEqual(again[1].status, REJECTED)
+        self.assertEqual(Issue.objects.count(), issued)
+
+    def test_batch_key_reused(self):
+        fill_mci_batch([(self.distribution, 2), (self.distribution, 3)],
+                       idempotency_key="1:batch")
+
+        for orders in ([(self.distribution, 2)],
+                       [(self.distribution, 2), (self.distribution, 4)],
+                       [(self.distribution, 2), (self.distribution, 3), (self.distribution, 1)]):
+            with self.subTest(orders=len(orders)), self.assertRaises(BatchConflict):
+                fill_mci_batch(orders, idempotency_key="1:batch")
+
+
+class ReservationTests(TestCase):
+    def setUp(self):
+        self.patients = {patient.blood_type: patient for patient in _stock(1, 3)}
+        self.user = User.objects.create_user("reserving")
+        self.total = _stock_total()
+
+    def held(self) -> int:
+        return RemainingUnits.objects.aggregate(total=Sum("held"))["total"]
+
+    def test_hold_and_commit(self):
+        patient = self.patients["A+"]
+        reservation = reserve_single_request(patient, 2, self.user)
+        holds = sorted(reservation.hold_set.values_list("donation_id", "request_blood_type",
+                                                        "units"))
+
+        self.assertEqual(self.held(), 2)
+        self.assertEqual(_stock_total(), self.total - 2)
+
+        request = fill_or_reject_single_request(patient, 2, None, reservation.id, self.user)
+
+        self.assertEqual(
+            sorted(request.issue_set.values_list("donation_id", "request_blood_type", "units")),
+            holds
+        )
+        self.assertEqual(self.held(), 0)
+        self.assertEqual(_stock_total(), self.total - 2)
+        self.assertFalse(Reservation.objects.exists())
+
+    def test_expiry(self):
+        reserve_single_request(self.patients["A+"], 2, self.user)
+        expired = timezone.now() + hold_ttl() + timedelta(seconds=1)
+
+        self.assertEqual(release_expired_holds(expired), 1)
+        self.assertEqual(self.held(), 0)
+        self.assertEqual(_stock_total(), self.total)
+        self.assertFalse(Reservation.objects.exists())
+
+    def test_other_user(self):
+        patient = self.patients["A+"]
+        reservation = reserve_single_request(patient, 2, self.user)
+
+        fill_or_reject_single_request(patient, 2, None, reservation.id,
+                                      User.objects.create_user("other"))
+
+        self.assertTrue(Reservation.objects.filter(id=reservation.id).exists())
+        self.assertEqual(self.held(), 2)
+
+    def test_blood_type_changed(self):
+        patient = self.patients["AB+"]
+        reservation = reserve_single_request(patient, 2, self.user)
+
+        patient.blood_type = "O-"
+        patient.save()
+        request = fill_or_reject_single_request(patient, 2, None, reservation.id, self.user)
+
+        self.assertEqual(
+            set(RemainingUnits.objects
+                .filter(donation__issue__request=request)
+                .values_list("blood_type", flat=True)),
+            {"O-"}
+        )
+        self.assertEqual(self.held(), 0)
+
+    def test_confirmation_page(self):
+        patient = self.patients["A+"]
+        self.user.user_permissions.add(Permission.objects.get(codename="can_request_single"))
+        self.client.force_login(self.user)
+
+        def confirm(units: int) -> Reservation:
+            response = self.client.get(f"/single_request/{patient.id}/{units}")
+            self.assertEqual(response.status_code, 200)
+            return response.context["reservation"]
+
+        reservation = confirm(2)
+        version = InventoryVersion.current()
+
+        # reloading shows the same hold without writing
+        self.assertEqual(confirm(2), reservation)
+        self.assertEqual(InventoryVersion.current(), version)
+        self.assertEqual(self.held(), 2)
+
+        # another number of units replaces it
+        other = confirm(1)
+        self.assertNotEqual(other, reservation)
+        self.assertEqual(list(Reservation.objects.all()), [other])
+        self.assertEqual(self.held(), 1)
+
+        self.assertIsNone(live_reservation(User.objects.create_user("other"), patient=patient,
+                                           units=1))
+        self.assertIsNone(live_reservation(None, patient=patient, units=1))
+
+        response = self.client.post(f"/single_request/{patient.id}/1", {
+            "idempotency_key": "confirm-1", "reservation": other.id
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.held(), 0)
+        self.assertEqual(_stock_total(), self.total - 1)
+
+        # the request is filled, a new confirmation holds units again
+        self.assertNotEqual(confirm(1), other)
+        self.assertEqual(self.held(), 1)
+
+
+class ProfilingTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.client.force_login(User.objects.create_superuser("profiler"))
+
+    def get(self, query: str):
+        with override_settings(BLOOD_PROFILE_DIR=self.directory.name):
+            response = self.client.get(f"/audit_export?{query}")
+            b"".join(response.streaming_content)
+
+        return response
+
+    def test_streamed_body_is_profiled(self):
+        self.get("_profile=1")
+
+        profile = RequestProfile.objects.get()
+        functions = {
+            function for _, _, function in
+            pstats.Stats(os.path.join(self.directory.name, profile.profile_file)).stats
+        }
+        # the rows are read and encoded while the response streams
+        self.assertIn("_audit_rows", functions)
+        self.assertIn("_chunked", functions)
+
+    def test_parameter_value(self):
+        for query in ("_profile=0", "no_profile=1", "x=_profile"):
+            with self.subTest(query):
+                self.get(query)
+                self.assertFalse(RequestProfile.objects.exists())
+
+
+class _RolledBack(Exception):
+    pass
+
+
+def _aged_stock(seed: int) -> Dict[str, Patient]:
+    """
+    Donors of every blood type with donations of every age, expired and expiring ones included.
+    """
+    rnd = Random(seed)
+    now = timezone.now()
+    donors = {}
+
+    for number, blood_type in enumerate(AVAILABLE_TYPES):
+        donors[blood_type] = _patient(number, blood_type)
+
+        for age in range(0, 35, 3):
+            Donation.objects.create(
+                donor=donors[blood_type],
+                units=rnd.randint(1, 4),
+                donation_date=now - timedelta(days=age, hours=rnd.randint(0, 23))
+            )
+
+    return donors
+
+
+class InventoryEngineTests(TestCase):
+    def setUp(self):
+        clear_distribution_cache()
+        self.patients = _aged_stock(seed=2)
+        self.engine = InventoryEngine(reconcile_seconds=300)
+
+    def use_engine(self):
+        for patcher in (override_settings(BLOOD_INVENTORY_ENGINE=True),
+                        mock.patch.object(inventory, "_engine", self.engine)):
+            patcher.__enter__()
+            self.addCleanup(patcher.__exit__, None, None, None)
+
+    def test_single_candidates_follow_the_view(self):
+        ranks = dict(BloodRank.objects.values_list("blood_type", "rank"))
+
+        def order(candidates):
+            # the view orders by expiring and rank only
+            return [(expiring, ranks[blood_type]) for _, blood_type, _, expiring in candidates]
+
+        for blood_type in AVAILABLE_TYPES:
+            with self.subTest(blood_type):
+                view = list(candidate_query(OutstandingDonations, CAN_RECEIVE[blood_type]))
+                engine = self.engine.single_candidates(CAN_RECEIVE[blood_type], len(view) + 1)
+
+                self.assertEqual(order(engine), order(view))
+                self.assertEqual(sorted(engine), sorted(view))
+
+    def test_mci_candidates_follow_the_view(self):
+        view = list(candidate_query(OutstandingDonationsMCI, AVAILABLE_TYPES,
+                                    order_by=("expires_at", "donation_id")))
+
+        self.assertEqual(self.engine.mci_candidates(AVAILABLE_TYPES), view)
+
+    def test_rolled_back_allocation_reloads(self):
+        self.use_engine()
+        patient = self.patients["AB+"]
+        fill_or_reject_single_request(patient, 1)
+        before = self.engine.single_candidates(CAN_RECEIVE["AB+"], 1000)
+
+        with mock.patch.object(self.engine, "load", wraps=self.engine.load) as load:
+            with self.assertRaises(_RolledBack), transaction.atomic():
+                fill_or_reject_single_request(patient, 3)
+                load.reset_mock()
+                raise _RolledBack()
+
+            self.assertEqual(self.engine.single_candidates(CAN_RECEIVE["AB+"], 1000), before)
+            load.assert_called_once()
+
+    def test_check_invalidates(self):
+        self.engine.load()
+        donation_id = self.engine.single_candidates(["O-"], 1)[0][0]
+
+        self.assertFalse(self.engine.check([(donation_id, "O-", 100)]))
+
+        with mock.patch.object(self.engine, "load", wraps=self.engine.load) as load:
+            self.engine.sync()
+            load.assert_called_once()
+
+    def test_consume_and_prune(self):
+        candidates = self.engine.mci_candidates(AVAILABLE_TYPES)
+        taken = candidates[:len(candidates) * 3 // 4]
+
+        self.engine.consume([(donation_id, blood_type, units)
+                             for donation_id, blood_type, units, _ in taken])
+        self.engine.sync()
+
+        self.assertEqual(self.engine.mci_candidates(AVAILABLE_TYPES),
+                         candidates[len(taken):])
+        # more than half of the copy was used up, it was compacted
+        self.assertEqual(len(self.engine._units), len(candidates) - len(taken))
+
+    def test_batch_plans_from_the_engine(self):
+        self.use_engine()
+        distribution = BloodTypeDistribution.objects.first().leaf
+
+        with mock.patch.object(self.engine, "mci_candidates",
+                               wraps=self.engine.mci_candidates) as mci_candidates, \
+                mock.patch.object(self.engine, "load", wraps=self.engine.load) as load:
+            outcomes = fill_mci_batch([(distribution, 3), (distribution, 2)])
+            mci_candidates.assert_called_once()
+            load.assert_called_once()
+
+            # the issues were taken from the copy, which still follows the ledger
+            self.assertEqual(
+                self.engine.mci_candidates(AVAILABLE_TYPES),
+                list(candidate_query(OutstandingDonationsMCI, AVAILABLE_TYPES,
+                                     order_by=("expires_at", "donation_id")))
+            )
+            load.assert_called_once()
+
+        self.assertTrue(all(outcome.request is not None for outcome in outcomes))
+
+
+class InventoryEngineSyncTests(_LedgerTransactionTestCase):
+    def test_donation_of_another_connection(self):
+        donor = _patient(0, "O-")
+        engine = InventoryEngine(reconcile_seconds=300)
+        engine.load()
+
+        def donate() -> int:
+            try:
+                return Donation.objects.create(donor=donor, units=2).id
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            donation_id = executor.submit(donate).result()
+
+        with mock.patch.object(engine, "load", wraps=engine.load) as load:
+            candidates = engine.single_candidates(["O-"], 10)
+
+        # read through the version, not a reload
+        load.assert_not_called()
+        self.assertEqual(candidates, [(donation_id, "O-", 2, False)])
+
+
+class RollupTests(TestCase):
+    START = datetime(2026, 3, 1, tzinfo=timezone.utc)
+
+    def setUp(self):
+        self.donor = _patient(0, "O-")
+        self.recipient = _patient(1, "O-")
+        self.first = self.donate(4, minutes=10)
+        self.second = self.donate(2, minutes=3 * 60 + 5)
+        self.issue = self.take(self.first, 1, minutes=90)
+
+    def donate(self, units: int, minutes: int) -> Donation:
+        return Donation.objects.create(donor=self.donor, units=units,
+                                       donation_date=self.START + timedelta(minutes=minutes))
+
+    def take(self, donation: Donation, units: int, minutes: int) -> Issue:
+        request = SingleRequest.objects.create(patient=self.recipient, units=units)
+        IssueRequest.objects.filter(id=request.id) \
+            .update(request_time=self.START + timedelta(minutes=minutes))
+        return Issue.objects.create(request=request, donation=donation, request_blood_type="O-",
+                                    units=units)
+
+    def roll_up(self, hours: int) -> rollup.RollupResult:
+        return rollup.roll_up(now=self.START + timedelta(hours=hours), max_hours=1000)
+
+    def rows(self) -> List[Tuple]:
+        """
+        (hour since START, stock, donated, issued, expired) of every rollup row.
+        """
+        return [
+            ((row.hour - self.START) // timedelta(hours=1), row.stock, row.donated, row.issued,
+             row.expired)
+            for row in InventoryRollup.objects.filter(blood_type="O-").order_by("hour")
+        ]
+
+    def test_stock_carried_over_hours(self):
+        self.assertEqual(self.roll_up(5),
+                         rollup.RollupResult(self.START, self.START + timedelta(hours=5), 5))
+        self.assertEqual(self.rows(), [
+            (0, 4, 4, 0, 0), (1, 3, 0, 1, 0), (2, 3, 0, 0, 0), (3, 5, 2, 0, 0), (4, 5, 0, 0, 0)
+        ])
+
+        # nothing new, nothing rolled up
+        self.assertEqual(self.roll_up(5), rollup.RollupResult(None, None, 0))
+
+    def test_late_rows(self):
+        self.roll_up(5)
+        self.donate(3, minutes=2 * 60 + 20)
+        self.take(self.second, 1, minutes=4 * 60 + 30)
+
+        self.assertEqual(self.roll_up(5).start, self.START + timedelta(hours=2))
+        self.assertEqual(self.rows(), [
+            (0, 4, 4, 0, 0), (1, 3, 0, 1, 0), (2, 6, 3, 0, 0), (3, 8, 2, 0, 0), (4, 7, 0, 1, 0)
+        ])
+
+    def test_changed_rows(self):
+        self.roll_up(5)
+        self.issue.delete()
+
+        self.assertEqual(RollupWatermark.objects.get(id=1).changed_from,
+                         self.START + timedelta(minutes=90))
+        self.assertEqual(self.roll_up(5).start, self.START + timedelta(hours=1))
+        self.assertEqual(self.rows(), [
+            (0, 4, 4, 0, 0), (1, 4, 0, 0, 0), (2, 4, 0, 0, 0), (3, 6, 2, 0, 0), (4, 6, 0, 0, 0)
+        ])
+
+        self.second.units = 1
+        self.second.save()
+
+        self.assertEqual(self.roll_up(5).start, self.START + timedelta(hours=3))
+        self.assertEqual(self.rows()[3:], [(3, 5, 1, 0, 0), (4, 5, 0, 0, 0)])
+        self.assertIsNone(RollupWatermark.objects.get(id=1).changed_from)
+
+    def test_daily(self):
+        self.take(self.second, 1, minutes=23 * 60 + 30)
+        self.roll_up(48)
+
+        # the day's stock is the one at its end, its movements the sum of its hours
+        self.assertEqual(
+            rollup.history(self.START, self.START + timedelta(days=2), ["O-"], rollup.DAILY),
+            [("2026-03-01", "O-", 4, 6, 2, 0, 0), ("2026-03-02", "O-", 4, 0, 0, 0, 0)]
+        )
+        self.assertEqual(
+            rollup.history(self.START + timedelta(hours=22), self.START + timedelta(hours=24),
+                           ["O-"], rollup.HOURLY),
+            [("2026-03-01 22:00:00", "O-", 5, 0, 0, 0, 0),
+             ("2026-03-01 23:00:00", "O-", 4, 0, 1, 0, 0)]
+        )
+
+    def test_archived_rows(self):
+        days = 24 * 31
+        self.roll_up(days)
+        rows = self.rows()
+        watermark = RollupWatermark.objects.values().get(id=1)
+
+        # what was left expired 30 days after each donation, no row follows an empty stock
+        self.assertEqual(rows[24 * 30:],
+                         [(720, 2, 0, 0, 3), (721, 2, 0, 0, 0), (722, 2, 0, 0, 0),
+                          (723, 0, 0, 0, 2)])
+
+        now = self.START + timedelta(hours=days)
+        self.assertEqual(tuple(archive_batch(now, now, batch_size=100)), (2, 1))
+        self.assertFalse(Donation.objects.exists())
+
+        # the ids stay where they were although the live tables are empty, and moving the rows
+        # is no change
+        self.assertEqual(self.roll_up(days), rollup.RollupResult(None, None, 0))
+        self.assertEqual(RollupWatermark.objects.values().get(id=1), watermark)
+        self.assertEqual(self.rows(), rows)
+
+        self.donate(1, minutes=days * 60 + 10)
+
+        self.assertEqual(self.roll_up(days + 1).start, now)
+        self.assertEqual(self.rows(), rows + [(days, 1, 1, 0, 0)])
+
+
+class StockTotalsTests(TestCase):
+    def setUp(self):
+        # the cache is keyed by the inventory version, which every test rolls back
+        patcher = mock.patch.object(stock, "_cached", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.patients = _aged_stock(seed=3)
+        self.user = User.objects.create_user("nurse")
+
+    def assert_ledger_sums(self, now: Optional[datetime] = None) -> str:
+        now = now or timezone.now()
+        ledger = RemainingUnits.objects \
+            .filter(units__gt=0, expires_at__gt=now) \
+            .values("blood_type") \
+            .annotate(total=Sum(F("units") - F("held"))) \
+            .order_by("blood_type") \
+            .values_list("blood_type", "total")
+
+        with mock.patch("blood.stock.timezone.now", return_value=now):
+            totals = stock.stock_totals()
+
+        self.assertEqual(totals.outstanding, [{"blood_type": blood_type, "outstanding": total}
+                                              for blood_type, total in ledger if total > 0])
+        return totals.etag
+
+    def test_follows_the_ledger(self):
+        self.assert_ledger_sums()
+
+        Donation.objects.create(donor=self.patients["B-"], units=3)
+        self.assert_ledger_sums()
+
+        fill_or_reject_single_request(self.patients["AB+"], 7)
+        fill_or_reject_mci_request(BloodTypeDistribution.objects.first().leaf, 9)
+        self.assert_ledger_sums()
+
+        reservation = reserve_single_request(self.patients["A+"], 4, self.user)
+        self.assert_ledger_sums()
+        reservation.delete()
+        self.assert_ledger_sums()
+
+        reserve_single_request(self.patients["O+"], 2, self.user)
+        release_expired_holds(timezone.now() + hold_ttl() + timedelta(seconds=1))
+        self.assert_ledger_sums()
+
+    def test_expiry(self):
+        now = timezone.now()
+        etags = set()
+
+        # donations expire throughout the next days, within today's bucket or after it
+        for hours in range(0, 24 * 12, 5):
+            with self.subTest(hours):
+                etags.add(self.assert_ledger_sums(now + timedelta(hours=hours)))
+
+        self.assertGreater(len(etags), 1)
+
+
+class OutstandingTests(TestCase):
+    def test_numbered_pages_redirect(self):
+        _aged_stock(seed=3)
+
+        for page in (1, 3):
+            with self.subTest(page):
+                self.assertRedirects(self.client.get(f"/outstanding/{page}"), "/outstanding",
+                                     status_code=301)
+
+
+def _drive_row(number: int, blood_type: str, units: int, donation_date: str) -> Dict:
+    return {
+        "id_number": str(1_000_000_000 + number),
+        "first_name": "First",
+        "last_name": "Last",
+        "birthday": "1980-01-01",
+        "blood_type": blood_type,
+        "smokes": False,
+        "phone_number": "",
+        "units": units,
+        "donation_date": donation_date,
+    }
+
+
+@override_settings(BLOOD_AUDIT_MODE="compact")
+class CompactAuditTests(TestCase):
+    def setUp(self):
+        clear_distribution_cache()
+        self.patients = _stock(donations_per_type=2, units=3)
+        self.distribution = BloodTypeDistribution.objects.first().leaf
+
+    def audits(self, owner) -> List[AllocationAudit]:
+        return list(AllocationAudit.objects.filter(
+            owner_type=ContentType.objects.get_for_model(owner.__class__),
+            owner_id=str(owner.pk)
+        ))
+
+    def assertIssuesAudited(self, request):
+        audit, = self.audits(request)
+
+        self.assertEqual(audit.record_type.model, "issue")
+        self.assertEqual(
+            sorted(tuple(record.values()) for record in json.loads(audit.serialized_data)),
+            sorted(Issue.objects.filter(request=request)
+                   .values_list("donation_id", "request_blood_type", "units"))
+        )
+
+    def assertRejectAudited(self, reject):
+        audit, = self.audits(reject)
+
+        self.assertEqual(audit.record_type.model, "rejecttype")
+        self.assertEqual(
+            sorted(tuple(record.values()) for record in json.loads(audit.serialized_data)),
+            sorted(RejectType.objects.filter(reject=reject).values_list("blood_type", "units"))
+        )
+
+    def test_allocations(self):
+        with reversion.create_revision():
+            single = fill_or_reject_single_request(self.patients[0], 4)
+            mci = fill_or_reject_mci_request(self.distribution, 10)
+            reject = fill_or_reject_single_request(self.patients[0], 1000)
+
+        self.assertIsInstance(reject, Reject)
+        self.assertIssuesAudited(single)
+        self.assertIssuesAudited(mci)
+        self.assertRejectAudited(reject)
+        self.assertEqual(AllocationAudit.objects.count(), 3)
+
+        # an audit instead of a version per row
+        self.assertFalse(Version.objects.get_for_model(Issue).exists())
+        self.assertFalse(Version.objects.get_for_model(RejectType).exists())
+
+    def test_batch(self):
+        with reversion.create_revision():
+            outcomes = fill_mci_batch([(self.distribution, 6), (self.distribution, 1000)],
+                                      allow_partial=True)
+
+        self.assertIssuesAudited(outcomes[0].request)
+        self.assertIssuesAudited(outcomes[1].request)
+        self.assertRejectAudited(outcomes[1].reject)
+        self.assertEqual(AllocationAudit.objects.count(), 3)
+
+    def test_donations(self):
+        errors: List[RowError] = []
+        drive = timezone.now() - timedelta(days=1)
+        imported = Donation.objects.filter(donation_date__lte=drive + timedelta(hours=1))
+        rows = [
+            (1, _drive_row(5, "O-", 2, drive.isoformat())),
+            (2, _drive_row(100, "A+", 1, drive.isoformat())),
+            (3, _drive_row(5, "O-", 3, (drive + timedelta(hours=1)).isoformat())),
+        ]
+
+        import_donations(rows, errors.append)
+
+        self.assertEqual(errors, [])
+        for donor in (self.patients[5], Patient.objects.get(id="1000000100")):
+            audit, = self.audits(donor)
+
+            self.assertEqual(audit.record_type.model, "donation")
+            self.assertEqual(
+                [(record["id"], record["units"]) for record in json.loads(audit.serialized_data)],
+                list(imported.filter(donor=donor).order_by("id").values_list("id", "units"))
+            )
+
+        self.assertFalse(Version.objects.get_for_model(Donation).exists())
+
+
+class ArchiveTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(stock, "_cached", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.patients = _aged_stock(seed=4)
+        for blood_type in ("AB+", "A+", "O+"):
+            fill_or_reject_single_request(self.patients[blood_type], 12)
+
+        self.now = timezone.now()
+        self.donations = self.history(DonationHistory.objects, "donor_id", "units", "donation_date",
+                                      "expires_at")
+        self.issues = self.history(IssueHistory.objects, "request_id", "donation_id",
+                                   "request_blood_type", "blood_type", "units")
+        self.outstanding = stock.stock_totals().outstanding
+
+    def history(self, rows, *fields) -> Dict[int, Tuple]:
+        return {row[0]: row[1:] for row in rows.values_list("id", *fields)}
+
+    def archivable(self, issued_before) -> set:
+        return set(RemainingUnits.objects
+                   .filter(units__gt=0, expires_at__lte=self.now)
+                   .values_list("donation_id", flat=True)) | \
+            set(RemainingUnits.objects
+                .filter(units__lte=0, donation_date__lte=issued_before)
+                .values_list("donation_id", flat=True))
+
+    def archive(self, issued_before, **kwargs) -> int:
+        archived = 0
+        while True:
+            batch = archive_batch(self.now, issued_before, batch_size=5, **kwargs)
+            if not batch.donations:
+                return archived
+            archived += batch.donations
+
+    def assertConsistent(self):
+        # nothing was lost, the history reads the same whether archived or not
+        self.assertEqual(self.history(DonationHistory.objects, "donor_id", "units",
+                                      "donation_date", "expires_at"), self.donations)
+        self.assertEqual(self.history(IssueHistory.objects, "request_id", "donation_id",
+                                      "request_blood_type", "blood_type", "units"), self.issues)
+        self.assertEqual(set(DonationHistory.objects.filter(archived=True)
+                             .values_list("id", flat=True)),
+                         set(DonationArchive.objects.values_list("id", flat=True)))
+        self.assertEqual(set(IssueHistory.objects.filter(archived=True)
+                             .values_list("donation_id", flat=True)),
+                         set(DonationArchive.objects.filter(issuearchive__isnull=False)
+                             .values_list("id", flat=True)))
+
+        issued = dict(Issue.objects.values("donation_id").annotate(total=Sum("units"))
+                      .values_list("donation_id", "total"))
+        self.assertEqual(
+            dict(RemainingUnits.objects.values_list("donation_id", "units")),
+            {donation_id: units - issued.get(donation_id, 0)
+             for donation_id, units in Donation.objects.values_list("id", "units")}
+        )
+
+        # what was archived wasn't outstanding
+        with mock.patch("blood.stock.timezone.now", return_value=self.now):
+            self.assertEqual(stock.stock_totals().outstanding, self.outstanding)
+        self.assertEqual(
+            StockTotal.objects.filter(expires_on__gt=self.now.date()).aggregate(
+                total=Sum("units"))["total"],
+            RemainingUnits.objects.filter(expires_at__gte=datetime.combine(
+                self.now.date() + timedelta(days=1), datetime.min.time(), tzinfo=self.now.tzinfo
+            )).aggregate(total=Sum(F("units") - F("held")))["total"]
+        )
+
+    def test_expired_and_issued(self):
+        archivable = self.archivable(self.now)
+        fully_issued = set(RemainingUnits.objects.filter(units__lte=0, expires_at__gt=self.now)
+                           .values_list("donation_id", flat=True))
+        self.assertTrue(fully_issued)
+        self.assertTrue(archivable - fully_issued)
+
+        self.assertEqual(self.archive(self.now), len(archivable))
+        self.assertEqual(set(DonationArchive.objects.values_list("id", flat=True)), archivable)
+        self.assertFalse(Donation.objects.filter(id__in=archivable).exists())
+        self.assertConsistent()
+
+    def test_recently_issued_stay(self):
+        issued_before = self.now - timedelta(days=10)
+        archivable = self.archivable(issued_before)
+
+        self.assertEqual(self.archive(issued_before), len(archivable))
+        self.assertEqual(set(DonationArchive.objects.values_list("id", flat=True)), archivable)
+        self.assertTrue(RemainingUnits.objects.filter(units__lte=0).exists())
+        self.assertConsistent()
+
+    def test_expired_only(self):
+        archivable = self.archivable(self.now - timedelta(days=30))
+        self.archive(self.now, expired_only=True)
+
+        # a fully issued donation that hasn't expired yet stays live
+        self.assertFalse(DonationArchive.objects.filter(expires_at__gt=self.now).exists())
+        self.assertEqual(set(DonationArchive.objects.values_list("id", flat=True)), archivable)
+        self.assertConsistent()
+
+
+class DonationImportTests(TestCase):
+    def setUp(self):
+        self.drive = (timezone.now() - timedelta(days=2)).replace(microsecond=0)
+        self.errors: List[RowError] = []
+
+    def at(self, minutes: int) -> str:
+        return (self.drive + timedelta(minutes=minutes)).isoformat()
+
+    def csv(self, *rows: Dict) -> io.StringIO:
+        text = io.StringIO()
+        writer = csv.DictWriter(text, ROW_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+        text.seek(0)
+        return text
+
+    def ndjson(self, *lines) -> io.StringIO:
+        return io.StringIO("\n".join(
+            line if isinstance(line, str) else json.dumps(line) for line in lines
+        ))
+
+    def assertLedgerConsistent(self):
+        self.assertEqual(
+            dict(RemainingUnits.objects.values_list("donation_id", "units")),
+            dict(Donation.objects.values_list("id", "units"))
+        )
+        self.assertEqual(_stock_total(), Donation.objects.aggregate(total=Sum("units"))["total"])
+
+    def test_csv(self):
+        rows = [
+            _drive_row(0, "O-", 2, self.at(0)),
+            dict(_drive_row(1, "A+", 1, self.at(5)), smokes="yes", phone_number="03-1234567"),
+            dict(_drive_row(0, "O-", 3, self.at(60)), smokes="No", last_name="Later"),
+        ]
+
+        result = import_file(self.csv(*rows), None, "drive.csv", self.errors.append,
+                             chunk_size=2)
+
+        self.assertEqual(self.errors, [])
+        self.assertEqual((result.rows, result.donations, result.patients_created,
+                          result.patients_updated, result.rejected), (3, 3, 2, 1, 0))
+        self.assertEqual(
+            list(Donation.objects.order_by("id").values_list("donor_id", "units", "donation_date")),
+            [("1000000000", 2, self.drive), ("1000000001", 1, self.drive + timedelta(minutes=5)),
+             ("1000000000", 3, self.drive + timedelta(hours=1))]
+        )
+        self.assertEqual(
+            list(Patient.objects.order_by("id")
+                 .values_list("last_name", "smokes", "phone_number")),
+            [("Later", False, ""), ("Last", True, "03-1234567")]
+        )
+        self.assertLedgerConsistent()
+
+    def test_ndjson(self):
+        result = import_file(self.ndjson(
+            dict(_drive_row(0, "B+", 2, self.at(0)), id_number=1000000000),
+            "",
+            "{not json",
+            "[1, 2]",
+            dict(_drive_row(1, "B-", 4, self.at(1)), smokes=True),
+        ), None, "drive.ndjson", self.errors.append)
+
+        self.assertEqual((result.rows, result.donations, result.rejected), (4, 2, 2))
+        self.assertEqual([(error.line, error.field) for error in self.errors],
+                         [(3, "__all__"), (4, "__all__")])
+        self.assertEqual(
+            list(Donation.objects.order_by("id")
+                 .values_list("donor__id", "donor__blood_type", "donor__smokes", "units")),
+            [("1000000000", "B+", False, 2), ("1000000001", "B-", True, 4)]
+        )
+        self.assertLedgerConsistent()
+
+    def test_row_errors(self):
+        result = import_file(self.csv(
+            _drive_row(0, "O-", 2, self.at(0)),
+            dict(_drive_row(1, "O-", 2, self.at(0)), blood_type="X+"),
+            dict(_drive_row(2, "O-", 2, self.at(0)), id_number="123"),
+            _drive_row(3, "O-", 0, self.at(0)),
+            _drive_row(4, "O-", 2, (timezone.now() + timedelta(days=1)).isoformat()),
+            dict(_drive_row(5, "O-", 2, self.at(0)), birthday=""),
+        ), "csv", "drive.txt", self.errors.append)
+
+        self.assertEqual((result.donations, result.rejected), (1, 5))
+        self.assertEqual(
+            [(error.line, error.id_number, error.field) for error in self.errors],
+            [(3, "1000000001", "blood_type"), (4, "123", "id_number"),
+             (5, "1000000003", "units"), (6, "1000000004", "donation_date"),
+             (7, "1000000005", "birthday")]
+        )
+        self.assertEqual(list(Patient.objects.values_list("id", flat=True)), ["1000000000"])
+        self.assertLedgerConsistent()
+
+    def test_duplicates(self):
+        rows = [_drive_row(0, "O-", 2, self.at(0)), _drive_row(0, "O-", 1, self.at(0)),
+                _drive_row(1, "O-", 1, self.at(0))]
+
+        first = import_file(self.csv(*rows), None, "drive.csv", self.errors.append)
+        self.assertEqual((first.donations, first.rejected), (2, 1))
+        self.assertEqual([(error.line, error.message) for error in self.errors],
+                         [(3, "Donation already imported")])
+
+        # the drive imported again, after fixing a row
+        self.errors.clear()
+        second = import_file(self.csv(*rows, _drive_row(2, "O-", 1, self.at(0))), None,
+                             "drive.csv", self.errors.append)
+
+        self.assertEqual((second.donations, second.rejected), (1, 3))
+        self.assertEqual([error.line for error in self.errors], [2, 3, 4])
+        self.assertEqual(Donation.objects.count(), 3)
+        self.assertLedgerConsistent()
+
+    def test_upload(self):
+        upload = SimpleUploadedFile(
+            "drive.ndjson",
+            self.ndjson(_drive_row(0, "AB-", 2, self.at(0)), "{").getvalue().encode()
+        )
+
+        self.client.force_login(User.objects.create_superuser("collector"))
+        response = self.client.post("/donation/import", {"file": upload})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["result"].donations, 1)
+        self.assertEqual([error.line for error in response.context["errors"]], [2])
+        self.assertLedgerConsistent()
+
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+class SyncApiTests(TestCase):
+    def setUp(self):
+        self.collector = User.objects.create_user("collector", password="secret")
+        self.collector.user_permissions.add(Permission.objects.get(codename="can_collect"))
+        User.objects.create_user("visitor", password="secret")
+
+        self.patients = [_patient(number, "O-") for number in range(3)]
+
+    def basic(self, username: str = "collector", password: str = "secret") -> Dict[str, str]:
+        credentials = base64.b64encode(f"{username}:{password}".encode()).decode()
+        return {"HTTP_AUTHORIZATION": f"Basic {credentials}"}
+
+    def changes(self, query: str = "") -> Dict:
+        response = self.client.get(f"/sync/patients?{query}", **self.basic())
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def submit(self, *donations: Dict, client: Optional[Client] = None) -> List[Dict]:
+        response = (client or self.client).post(
+            "/sync/donations", json.dumps({"donations": list(donations)}),
+            content_type="application/json", **self.basic()
+        )
+        self.assertEqual(response.status_code, 200)
+        return response.json()["donations"]
+
+    def test_authentication(self):
+        for path in ("/sync/patients", "/sync/donations"):
+            method = self.client.get if path == "/sync/patients" else self.client.post
+
+            with self.subTest(path):
+                for headers in ({}, self.basic(password="wrong"),
+                                {"HTTP_AUTHORIZATION": "Bearer x"},
+                                {"HTTP_AUTHORIZATION": "Basic %%%"}):
+                    response = method(path, **headers)
+                    # no redirect to the login page, clients can't follow it
+                    self.assertEqual(response.status_code, 401)
+                    self.assertEqual(response["WWW-Authenticate"], 'Basic realm="bloodline"')
+
+                self.assertEqual(method(path, **self.basic("visitor")).status_code, 403)
+
+        # a session has to pass the CSRF check, basic credentials don't
+        client = Client(enforce_csrf_checks=True)
+        client.force_login(self.collector)
+        self.assertEqual(client.post("/sync/donations", "{}", content_type="application/json")
+                         .status_code, 403)
+        self.assertEqual(client.get("/sync/patients").status_code, 200)
+        self.assertEqual(self.submit(client=Client(enforce_csrf_checks=True)), [])
+
+    def test_delta(self):
+        first = self.changes()
+        self.assertEqual([row[0] for row in first["patients"]],
+                         [patient.id for patient in self.patients])
+        self.assertEqual(first["deleted"], [])
+        self.assertEqual(first["blood_types"], list(AVAILABLE_TYPES))
+        self.assertFalse(first["more"])
+
+        self.assertEqual(self.changes(f"after={first['cursor']}"),
+                         {"fields": first["fields"], "patients": [], "deleted": [],
+                          "cursor": first["cursor"], "more": False})
+
+        self.patients[0].phone_number = "03-1234567"
+        self.patients[0].save()
+        added = _patient(3, "A+")
+
+        delta = self.changes(f"after={first['cursor']}")
+        self.assertEqual([row[0] for row in delta["patients"]], [self.patients[0].id, added.id])
+        self.assertEqual(delta["patients"][0][first["fields"].index("phone_number")],
+                         "03-1234567")
+        self.assertGreater(delta["cursor"], first["cursor"])
+        self.assertNotIn("blood_types", delta)
+
+        # a page at a time, resuming from each cursor
+        paged, cursor, more = [], first["cursor"], True
+        while more:
+            page = self.changes(f"after={cursor}&limit=1")
+            paged += [row[0] for row in page["patients"]]
+            cursor, more = page["cursor"], page["more"]
+        self.assertEqual(paged, [self.patients[0].id, added.id])
+        self.assertEqual(cursor, delta["cursor"])
+
+        self.assertEqual(self.client.get("/sync/patients?after=x", **self.basic()).status_code,
+                         400)
+        self.assertEqual(self.client.get("/sync/patients?limit=0", **self.basic()).status_code,
+                         400)
+
+    def test_tombstones(self):
+        cursor = self.changes()["cursor"]
+        deleted = self.patients[1].id
+        self.patients[1].delete()
+        self.patients[2].first_name = "Changed"
+        self.patients[2].save()
+
+        delta = self.changes(f"after={cursor}")
+        self.assertEqual(delta["deleted"], [deleted])
+        self.assertEqual([row[0] for row in delta["patients"]], [self.patients[2].id])
+
+        # a deletion and a change share the sequence, each is on exactly one page
+        first = self.changes(f"after={cursor}&limit=1")
+        second = self.changes(f"after={first['cursor']}&limit=1")
+        self.assertEqual((first["deleted"], first["patients"], first["more"]),
+                         ([deleted], [], True))
+        self.assertEqual((second["deleted"], [row[0] for row in second["patients"]]),
+                         ([], [self.patients[2].id]))
+
+        # a client that synced before the deletion drops the patient once
+        self.assertEqual(self.changes(f"after={delta['cursor']}")["deleted"], [])
+
+    def test_submit(self):
+        item = dict(_drive_row(0, "O-", 2, (timezone.now() - timedelta(hours=1)).isoformat()),
+                    client_id="tablet-1:1")
+
+        created, = self.submit(item)
+        self.assertEqual(created["status"], "created")
+        donation = Donation.objects.get(id=created["donation_id"])
+        self.assertEqual((donation.donor_id, donation.units), (self.patients[0].id, 2))
+        self.assertEqual(RemainingUnits.objects.get(donation=donation).units, 2)
+
+        # sent again, once more within the same batch
+        again, repeated = self.submit(item, item)
+        self.assertEqual(again, dict(created, status="duplicate"))
+        self.assertEqual(repeated, dict(created, status="duplicate"))
+
+        conflict = dict(item, client_id="tablet-1:2", blood_type="A+")
+        result, invalid = self.submit(conflict, dict(item, client_id="", units=0))
+        self.assertEqual(result["status"], "conflict")
+        self.assertEqual(result["patient"]["blood_type"], "O-")
+        self.assertEqual(invalid["status"], "invalid")
+        self.assertEqual(set(invalid["errors"]), {"client_id"})
+
+        confirmed, = self.submit(dict(conflict, confirm_blood_type=True))
+        self.assertEqual(confirmed["status"], "created")
+        self.assertEqual(Patient.objects.get(id=self.patients[0].id).blood_type, "A+")
+        self.assertEqual(Donation.objects.count(), 2)
+
+
+class PatientSearchTests(TestCase):
+    def setUp(self):
+        for patient_id, first_name, last_name, phone_number in [
+            ("1234567890", "Dana", "Levi", "050-1234567"),
+            ("1234500000", "Danny", "Cohen", "052-7654321"),
+            ("9876543210", "Yossi", "Levinson", None),
+            ("5550000000", "Zoë", "Mizrahi", None),
+        ]:
+            Patient.objects.create(id=patient_id, first_name=first_name, last_name=last_name,
+                                   birthday=date(1980, 1, 1), blood_type="O-", smokes=False,
+                                   phone_number=phone_number)
+
+    def test_names(self):
+        # exact matches before prefixes
+        self.assertEqual(search.search_ids("levi"), ["1234567890", "9876543210"])
+        self.assertEqual(set(search.search_ids("dan")), {"1234567890", "1234500000"})
+        self.assertEqual(search.search_ids("dana levi"), ["1234567890"])
+        self.assertEqual(search.search_ids("LEVINS"), ["9876543210"])
+        self.assertEqual(search.search_ids("zoe"), ["5550000000"])
+        self.assertEqual(search.search_ids("noone"), [])
+        self.assertEqual(search.search_ids(" -- "), [])
+
+    def test_phone_numbers(self):
+        for text in ("050-1234567", "0501234567", "0501234", "1234567"):
+            with self.subTest(text):
+                self.assertEqual(search.search_ids(text), ["1234567890"])
+
+        self.assertEqual(search.search_ids("052"), ["1234500000"])
+
+    def test_id_prefixes(self):
+        self.assertEqual(set(search.search_ids("12345")), {"1234567890", "1234500000"})
+        self.assertEqual(search.search_ids("123456"), ["1234567890"])
+        self.assertEqual(search.search_ids("9876543210"), ["9876543210"])
+        self.assertEqual(search.search_ids("12345", limit=1), search.search_ids("12345")[:1])
+
+    def test_index_follows_changes(self):
+        patient = Patient.objects.get(id="1234567890")
+        patient.last_name = "Katz"
+        patient.phone_number = None
+        patient.save()
+
+        self.assertEqual(search.search_ids("levi"), ["9876543210"])
+        self.assertEqual(search.search_ids("katz"), ["1234567890"])
+        self.assertEqual(search.search_ids("0501234"), [])
+
+        Patient.objects.filter(id="1234500000").delete()
+
+        self.assertEqual(search.search_ids("dan"), ["1234567890"])
+        self.assertEqual(search.search_ids("12345"), ["1234567890"])
+
+        _patient(5, "A+")
+        self.assertEqual(search.search_ids("1000000005"), ["1000000005"])
+
+    def test_filter_matching(self):
+        queryset = Patient.objects.order_by("-id")
+
+        self.assertEqual(list(search.filter_matching(queryset, "lev").values_list("id", flat=True)),
+                         ["9876543210", "1234567890"])
+        self.assertIsNone(search.filter_matching(queryset, ""))
+
+    def test_view(self):
+        user = User.objects.create_user("nurse")
+        self.client.force_login(user)
+        self.assertEqual(self.client.get("/patients/search?q=levi").status_code, 302)
+
+        user.user_permissions.add(Permission.objects.get(codename="can_request_single"))
+        response = self.client.get("/patients/search?q=levi&limit=1")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([(patient["id"], patient["last_name"])
+                          for patient in response.json()["patients"]],
+                         [("1234567890", "Levi")])
+        self.assertEqual(self.client.get("/patients/search?q=levi&limit=x").status_code, 400)
+
+
+@override_settings(BLOOD_FORECAST_DAYS=4, BLOOD_FORECAST_RATE_DAYS=2)
+class ForecastTests(TestCase):
+    NOW = datetime(2026, 3, 10, 12, tzinfo=timezone.utc)
+
+    def setUp(self):
+        for name in ("_cached", "_rates"):
+            patcher = mock.patch.object(forecast, name, None)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.donor = _patient(0, "O-")
+        recipient = _patient(1, "O-")
+
+        # expiring today after NOW, tomorrow, in three days, and expired a week ago
+        for units, expires_at in [(4, datetime(2026, 3, 10, 18)), (3, datetime(2026, 3, 11, 6)),
+                                  (5, datetime(2026, 3, 13, 9)), (6, datetime(2026, 3, 3))]:
+            self.donate(self.donor, units, expires_at)
+        self.donate(_patient(2, "A+"), 2, datetime(2026, 3, 12, 10))
+
+        # 8 units over the two days before today, 4 a day. The ones before and today don't count
+        stock_donation = self.donate(self.donor, 20, datetime(2026, 3, 31))
+        for units, request_time in [(5, datetime(2026, 3, 7, 23)), (6, datetime(2026, 3, 8, 1)),
+                                    (2, datetime(2026, 3, 9, 23)), (1, datetime(2026, 3, 10, 8))]:
+            request = SingleRequest.objects.create(patient=recipient, units=units)
+            IssueRequest.objects.filter(id=request.id) \
+                .update(request_time=request_time.replace(tzinfo=timezone.utc))
+            Issue.objects.create(request=request, donation=stock_donation,
+                                 request_blood_type="O-", units=units)
+
+    def donate(self, donor: Patient, units: int, expires_at: datetime) -> Donation:
+        return Donation.objects.create(
+            donor=donor, units=units,
+            donation_date=expires_at.replace(tzinfo=timezone.utc) - timedelta(days=30)
+        )
+
+    def forecast(self, now: datetime = NOW) -> forecast.Forecast:
+        with mock.patch("blood.forecast.timezone.now", return_value=now):
+            return forecast.forecast()
+
+    def test_fixture(self):
+        result = self.forecast()
+        by_type = {row["blood_type"]: row for row in result.blood_types}
+        days = [date(2026, 3, day) for day in (10, 11, 12, 13)]
+
+        self.assertEqual(result.days, days)
+        # O-: 2 units are issued for the rest of today, 4 a day after. Of today's 4 units 2
+        # expire, what expires later is issued first
+        self.assertEqual(by_type["O-"], {"blood_type": "O-", "issued_per_day": 4.0,
+                                         "outstanding": 12, "expiring": [2, 0, 0, 0]})
+        self.assertEqual(by_type["A+"], {"blood_type": "A+", "issued_per_day": 0.0,
+                                         "outstanding": 2, "expiring": [0, 0, 2, 0]})
+        self.assertEqual(by_type["B+"]["outstanding"], 0)
+        self.assertEqual(result.at_risk, [
+            {"blood_type": "O-", "expires_on": days[0], "units": 4, "at_risk": 2},
+            {"blood_type": "A+", "expires_on": days[2], "units": 2, "at_risk": 2},
+        ])
+        # until today's donation expires
+        self.assertEqual(result.valid_until, datetime(2026, 3, 10, 18, tzinfo=timezone.utc))
+
+    def test_project(self):
+        self.assertEqual(forecast.project([4, 3, 0, 5], 4.0, 0.5), [2.0, 0.0, 0.0, 0.0])
+        self.assertEqual(forecast.project([4, 3, 0, 5], 0.0), [4.0, 3.0, 0.0, 5.0])
+        # later units are issued once the earlier ones are gone
+        self.assertEqual(forecast.project([1, 1, 10], 2.5), [0.0, 0.0, 4.5])
+
+    def test_cache(self):
+        first = self.forecast()
+
+        with mock.patch.object(forecast, "_compute", wraps=forecast._compute) as compute:
+            self.assertIs(self.forecast(self.NOW + timedelta(hours=1)), first)
+            compute.assert_not_called()
+
+            # a change to the inventory
+            self.donate(self.donor, 1, datetime(2026, 3, 11, 1))
+            changed = self.forecast(self.NOW + timedelta(hours=1))
+            self.assertNotEqual(changed.etag, first.etag)
+            self.assertEqual(changed.blood_types[AVAILABLE_TYPES.index("O-")]["outstanding"], 13)
+
+            # today's donation expired
+            expired = self.forecast(datetime(2026, 3, 10, 18, 30, tzinfo=timezone.utc))
+            self.assertNotEqual(expired.etag, changed.etag)
+            self.assertEqual(expired.blood_types[AVAILABLE_TYPES.index("O-")]["outstanding"], 9)
+            self.assertEqual(compute.call_count, 2)
+
+        with mock.patch.object(forecast, "issue_rates", wraps=forecast.issue_rates) as rates:
+            self.forecast(datetime(2026, 3, 10, 19, tzinfo=timezone.utc))
+            rates.assert_not_called()
+
+            # the rates are read again the next day
+            self.assertEqual(self.forecast(datetime(2026, 3, 11, 1, tzinfo=timezone.utc)).days[0],
+                             date(2026, 3, 11))
+            rates.assert_called_once()
+
+
+class SimulationTests(TestCase):
+    def optimal_missing(self, stock: Sequence[int], demand: Sequence[int]) -> int:
+        candidates = [(i, blood_type, units, False)
+                      for i, (blood_type, units) in enumerate(zip(AVAILABLE_TYPES, stock))
+                      if units > 0]
+        needs = [(blood_type, units) for blood_type, units in zip(AVAILABLE_TYPES, demand)
+                 if units > 0]
+
+        _, missing = _plan_optimal(needs, candidates)
+        return sum(units for _, units in missing)
+
+    def test_allocate_matches_optimal(self):
+        rnd = Random(5)
+        stock = np.array([[rnd.randint(0, 6) for _ in AVAILABLE_TYPES] for _ in range(60)])
+        demand = np.array([[rnd.randint(0, 5) for _ in AVAILABLE_TYPES] for _ in range(60)])
+
+        # all cases at once, as the simulator runs them
+        shortfall, left = simulation.allocate(stock, demand)
+
+        for case in range(len(stock)):
+            with self.subTest(stock=stock[case].tolist(), demand=demand[case].tolist()):
+                self.assertEqual(int(shortfall[case].sum()),
+                                 self.optimal_missing(stock[case], demand[case]))
+                self.assertEqual(int(stock[case].sum() - left[case].sum()),
+                                 int(demand[case].sum() - shortfall[case].sum()))
+
+    def test_capacity_matches_optimal(self):
+        rnd = Random(6)
+        stock = np.array([[rnd.randint(0, 12) for _ in AVAILABLE_TYPES] for _ in range(30)])
+        percentages = np.array([[rnd.choice([0, 0, 5, 10, 20, 35]) for _ in AVAILABLE_TYPES]
+                                for _ in range(30)], dtype=float)
+
+        capacity = simulation.max_fillable(stock, percentages)
+
+        for case in range(len(stock)):
+            fits = simulation.needs(percentages[case], capacity[case])
+            over = simulation.needs(percentages[case], capacity[case] + 1)
+
+            with self.subTest(stock=stock[case].tolist(), percentages=percentages[case].tolist()):
+                self.assertEqual(self.optimal_missing(stock[case], fits), 0)
+                if percentages[case].any():
+                    self.assertGreater(self.optimal_missing(stock[case], over), 0)
+
+    def test_inventory(self):
+        clear_distribution_cache()
+        _aged_stock(seed=7)
+        distribution = BloodTypeDistribution.objects.first().leaf
+        simulator = simulation.InventorySimulator.load()
+
+        outstanding = dict(OutstandingDonationsMCI.objects.values("blood_type")
+                           .annotate(total=Sum("units")).values_list("blood_type", "total"))
+        self.assertEqual(simulator.available([0])[0].tolist(),
+                         [outstanding.get(blood_type, 0) for blood_type in AVAILABLE_TYPES])
+
+        # the optimal allocation fills the capacity, and not a unit more
+        capacity = int(simulator.capacity(simulation.percentage_matrix([distribution]))[0, 0])
+        for units, filled in ((capacity, True), (capacity + 1, False)):
+            with self.subTest(units=units), transaction.atomic():
+                result = fill_or_reject_mci_request(distribution, units, OPTIMAL_ALLOCATION)
+                self.assertEqual(not isinstance(result, Reject), filled)
+                transaction.set_rollback(True)
+
+    def test_view_names_the_allocation(self):
+        clear_distribution_cache()
+        self.client.force_login(User.objects.create_superuser("planner"))
+        distribution = BloodTypeDistribution.objects.first()
+
+        response = self.client.get(
+            f"/mci_simulation?distribution={distribution.id}&units=10&horizon=2&format=json"
+        )
+
+        self.assertEqual(response.json()["allocation"], OPTIMAL_ALLOCATION)
+        self.assertEqual(len(response.json()["projection"]), 3)
+        self.assertContains(self.client.get("/mci_simulation"), "optimal allocation")
+
+
+def _generate(seed: int):
+    call_command("generate_donations", "60", "--seed", str(seed), "--batch-size", "25",
+                 "--requests", "40", "--until", "2026-10-01", stdout=io.StringIO())
+
+
+def _dataset() -> Dict[str, List[tuple]]:
+    # by content rather than ids, which follow whatever was inserted before
+    return {
+        "patients": sorted(Patient.objects.values_list(
+            "id", "first_name", "last_name", "birthday", "blood_type", "smokes", "phone_number"
+        )),
+        "donations": sorted(Donation.objects.values_list("donor_id", "units", "donation_date",
+                                                         "expires_at")),
+        "issues": sorted(Issue.objects.values_list("request__request_time", "donation__donor_id",
+                                                   "request_blood_type", "units")),
+        "rejects": sorted(RejectType.objects.values_list("reject__time", "blood_type", "units")),
+    }
+
+
+class GenerateDonationsTests(TestCase):
+    def generate(self, seed: int) -> Dict[str, List[tuple]]:
+        with self.assertRaises(_RolledBack), transaction.atomic():
+            _generate(seed)
+            dataset = _dataset()
+            raise _RolledBack()
+
+        return dataset
+
+    def test_same_seed_same_dataset(self):
+        dataset = self.generate(5)
+
+        self.assertEqual(len(dataset["donations"]), 60)
+        self.assertTrue(dataset["issues"])
+        self.assertEqual(self.generate(5), dataset)
+        self.assertNotEqual(self.generate(6)["patients"], dataset["patients"])
+
+
+class DatasetSnapshotTests(_LedgerTransactionTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "snapshot.sqlite3")
+
+    def assertLedgerConsistent(self):
+        issued = dict(
+            Issue.objects.values("donation_id").annotate(total=Sum("units"))
+            .values_list("donation_id", "total")
+        )
+        remaining = dict(RemainingUnits.objects.values_list("donation_id", "units"))
+
+        for donation_id, units in Donation.objects.values_list("id", "units"):
+            self.assertEqual(remaining[donation_id], units - issued.get(donation_id, 0))
+
+        for blood_type in AVAILABLE_TYPES:
+            self.assertEqual(
+                _stock_total(blood_type),
+                RemainingUnits.objects.filter(blood_type=blood_type)
+                .aggregate(total=Sum("units"))["total"] or 0
+            )
+
+    def test_restore(self):
+        _generate(5)
+        dataset = _dataset()
+        _, epoch = InventoryVersion.current()
+        call_command("dataset_snapshot", "export", self.path, stdout=io.StringIO())
+
+        patient = Patient.objects.first()
+        Donation.objects.create(donor=patient, units=3)
+        fill_or_reject_single_request(patient, 2)
+        self.assertNotEqual(_dataset(), dataset)
+
+        call_command("dataset_snapshot", "restore", self.path, stdout=io.StringIO())
+
+        self.assertEqual(_dataset(), dataset)
+        self.assertLedgerConsistent()
+        # caches keyed by the version taken before the restore are told apart by the epoch
+        self.assertGreater(InventoryVersion.current()[1], epoch)
@@ -1,13 +1,36 @@
-from django.contrib.auth.decorators import permission_required
-from django.core.paginator import Paginator
-from django.http.response import HttpResponseRedirect
+import base64
+from csv import writer
+from functools import wraps
+import io
+import json
+from typing import Iterator, List, Optional, Tuple, Union
+import uuid
+import zlib
+
+from django.conf import settings
+from django.contrib.auth import authenticate
+from django.contrib.auth.decorators import permission_required, user_passes_test
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.db.models import F, Q
+from django.http.response import HttpResponse, HttpResponsePermanentRedirect, \
+	HttpResponseRedirect, JsonResponse
+from django.middleware.csrf import CsrfViewMiddleware
 from django.shortcuts import get_object_or_404, render
 from django.urls import reverse
+from django.utils import timezone
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.gzip import gzip_page
+from django.views.decorators.http import require_GET, require_POST
 
-from blood import models
-from blood.fill_request import CanNotFulfill, create_and_fill_mci_request, \
-	create_and_fill_single_request
-from blood.forms import AcceptDonation, IdSearch, MCIRequestForm, SingleRequestForm
+from blood import donation_import, models, rollup, search, simulation, sync
+from blood.blood_types import AVAILABLE_TYPES, GREEDY_ALLOCATION
+from blood.dispatcher import dispatch
+from blood.fill_request import BatchConflict, CanNotFulfill, fill_mci_batch, \
+	fill_or_reject_mci_request, fill_or_reject_single_request, live_reservation, replay, \
+	replay_mci_batch, reserve_mci_request, reserve_single_request
+from blood.forms import AcceptDonation, DonationImportForm, IdSearch, InventoryHistoryForm, \
+	MCIBatchForm, MCIBatchOrderForm, MCIRequestForm, SimulationForm, SingleRequestForm
 
 
 @permission_required("blood.can_collect")
@@ -58,6 +81,35 @@ def donation_id(request, id_number):
 	return render(request, "accept_donation.html", {"form": form, "id_number": id_number})
 
 
+def _can_find_patients(user) -> bool:
+	return user.has_perm("blood.can_collect") or user.has_perm("blood.can_request_single")
+
+
+@require_GET
+@user_passes_test(_can_find_patients)
+def patient_search(request):
+	"""
+	Patients matching ?q= by name, phone number or id prefix, best first, for search as you
+	type.
+	"""
+	try:
+		limit = int(request.GET.get("limit", 10))
+	except ValueError:
+		return JsonResponse({"error": "limit must be an integer"}, status=400)
+
+	return JsonResponse({"patients": [
+		{
+			"id": patient.id,
+			"first_name": patient.first_name,
+			"last_name": patient.last_name,
+			"birthday": patient.birthday,
+			"blood_type": patient.blood_type,
+			"phone_number": patient.phone_number
+		}
+		for patient in search.search(request.GET.get("q", ""), max(limit, 1))
+	]})
+
+
 @permission_required("blood.can_collect")
 def donation_received(request, donation_id):
 	donation = get_object_or_404(models.Donation, id=donation_id)
@@ -65,6 +117,192 @@ def donation_received(request, donation_id):
 	return render(request, "donation_received.html", {"donation": donation})
 
 
+@permission_required("blood.can_collect")
+def donation_import_upload(request):
+	"""
+	Import a blood drive's donations from an uploaded CSV or NDJSON file, listing the rows that
+	were rejected.
+	"""
+	result = None
+	errors = []
+
+	if request.method == "GET":
+		form = DonationImportForm()
+	else:
+		form = DonationImportForm(request.POST, request.FILES)
+
+		if form.is_valid():
+			upload = form.cleaned_data["file"]
+			stream = io.TextIOWrapper(upload.file, encoding="utf-8-sig", newline="")
+
+			try:
+				result = donation_import.import_file(
+					stream,
+					form.cleaned_data["format"],
+					upload.name,
+					errors.append,
+					user=request.user,
+					comment=f"Imported donations from {upload.name}"
+				)
+			except UnicodeDecodeError:
+				form.add_error("file", "The file is not UTF-8 text")
+
+	return render(request, "donation_import.html", {
+		"form": form,
+		"result": result,
+		"errors": errors
+	})
+
+
+def _json_body(request):
+	"""
+	The request's JSON body, which clients may send gzipped (Content-Encoding: gzip). The
+	uncompressed body is held to DATA_UPLOAD_MAX_MEMORY_SIZE like an uncompressed one.
+	"""
+	body = request.body
+
+	if request.META.get("HTTP_CONTENT_ENCODING", "").lower() == "gzip":
+		limit = settings.DATA_UPLOAD_MAX_MEMORY_SIZE
+		decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+		body = decompressor.decompress(body, limit) if limit is not None \
+			else decompressor.decompress(body)
+
+		if decompressor.unconsumed_tail:
+			raise ValueError("body too large")
+
+	return json.loads(body)
+
+
+def _basic_auth(request, authorization: str):
+	scheme, _, credentials = authorization.partition(" ")
+	if scheme.lower() != "basic":
+		return None
+
+	try:
+		username, _, password = base64.b64decode(credentials).decode().partition(":")
+	except (ValueError, UnicodeDecodeError):
+		return None
+
+	user = authenticate(request, username=username, password=password)
+	return user if user is not None and user.is_active else None
+
+
+def api_permission_required(permission: str):
+	"""
+	permission_required for the views offline clients call. They authenticate with HTTP basic
+	credentials, exempt from the CSRF check as no cookie is involved, or with the session,
+	which has to pass it. Answers 401 or 403 in JSON instead of redirecting to the login page.
+	"""
+	def decorator(view):
+		@csrf_exempt
+		@wraps(view)
+		def wrapper(request, *args, **kwargs):
+			authorization = request.META.get("HTTP_AUTHORIZATION")
+
+			if authorization is not None:
+				request.user = _basic_auth(request, authorization) or AnonymousUser()
+			elif request.user.is_authenticated:
+				csrf = CsrfViewMiddleware(lambda _: None)
+				csrf.process_request(request)
+				if csrf.process_view(request, None, (), {}) is not None:
+					return JsonResponse({"error": "CSRF verification failed"}, status=403)
+
+			if not request.user.is_authenticated:
+				response = JsonResponse({"error": "authentication required"}, status=401)
+				response["WWW-Authenticate"] = 'Basic realm="bloodline"'
+				return response
+
+			if not request.user.has_perm(permission):
+				return JsonResponse({"error": f"{permission} permission required"}, status=403)
+
+			return view(request, *args, **kwargs)
+
+		return wrapper
+
+	return decorator
+
+
+@require_GET
+@gzip_page
+@api_permission_required("blood.can_collect")
+def sync_patients(request):
+	"""
+	Patients created or changed since ?after=<cursor> (all of them without one), up to ?limit,
+	and the ids of the patients deleted since. Clients drop the deleted patients, apply the
+	rows, keep the returned cursor and ask again while "more" is true.
+	"""
+	try:
+		after = int(request.GET["after"]) if "after" in request.GET else None
+		limit = min(int(request.GET.get("limit", sync.FEED_PAGE_SIZE)), sync.MAX_FEED_PAGE_SIZE)
+	except ValueError:
+		return JsonResponse({"error": "after and limit must be integers"}, status=400)
+
+	if limit < 1:
+		return JsonResponse({"error": "limit must be positive"}, status=400)
+
+	return JsonResponse(sync.patient_changes(after, limit))
+
+
+@require_POST
+@gzip_page
+@api_permission_required("blood.can_collect")
+def sync_donations(request):
+	"""
+	Collect a JSON batch of donations, {"donations": [{"client_id": ..., "id_number": ...,
+	the donation form's fields, "donation_date": ...}, ...]}, answering with the outcome of each
+	(see blood.sync.submit_donations). Sending a batch again is safe.
+	"""
+	try:
+		donations = _json_body(request)["donations"]
+	except (ValueError, KeyError, TypeError, zlib.error):
+		return JsonResponse({"error": "expected a JSON object with a donations list"}, status=400)
+
+	if not isinstance(donations, list) or not all(isinstance(item, dict) for item in donations):
+		return JsonResponse({"error": "donations must be a list of objects"}, status=400)
+
+	if len(donations) > sync.MAX_SUBMISSION:
+		return JsonResponse(
+			{"error": f"at most {sync.MAX_SUBMISSION} donations per batch"},
+			status=400
+		)
+
+	return JsonResponse({"donations": sync.submit_donations(donations, user=request.user)})
+
+
+IDEMPOTENCY_KEY_LENGTH = 64
+
+
+def _idempotency_key(request, key) -> Optional[str]:
+	"""
+	The key a client sent with an allocation, in the request or the Idempotency-Key header,
+	scoped to the user so keys of different users can't collide. None without a valid key.
+	"""
+	key = key or request.META.get("HTTP_IDEMPOTENCY_KEY")
+
+	if not isinstance(key, str) or not 0 < len(key) <= IDEMPOTENCY_KEY_LENGTH:
+		return None
+
+	return f"{request.user.pk}:{key}"
+
+
+def _reservation_id(value) -> Optional[int]:
+	try:
+		return int(value) if value else None
+	except ValueError:
+		return None
+
+
+def _result_redirect(result: Union[models.IssueRequest, models.Reject]):
+	if isinstance(result, models.Reject):
+		return HttpResponseRedirect(reverse(show_reject, kwargs={"reject_id": result.id}))
+
+	if isinstance(result, models.SingleRequest):
+		return HttpResponseRedirect(
+			reverse(single_request_complete, kwargs={"request_id": result.id}))
+
+	return HttpResponseRedirect(reverse(mci_request_complete, kwargs={"request_id": result.id}))
+
+
 @permission_required("blood.can_request_single")
 def single_request_start(request):
 	if request.method == "GET":
@@ -119,20 +357,45 @@ def single_request_confirm(request, id_number, units):
 	patient = get_object_or_404(models.Patient, id=id_number)
 
 	if request.method == "GET":
-		return render(request, "single_request_confirm.html", {"patient": patient, "units": units})
+		# hold the units while the request is confirmed, the commit then issues them as they are.
+		# Reloading the page shows the same hold, only a new one goes through the writer
+		reservation = live_reservation(request.user, patient=patient, units=units)
+		missing_units = []
+
+		if reservation is None:
+			try:
+				reservation = dispatch(
+					reserve_single_request,
+					patient,
+					units,
+					request.user,
+					user=request.user
+				)
+			except CanNotFulfill as cnf:
+				missing_units = cnf.missing_units
+
+		return render(request, "single_request_confirm.html", {
+			"patient": patient,
+			"units": units,
+			"idempotency_key": uuid.uuid4().hex,
+			"reservation": reservation,
+			"missing_units": missing_units
+		})
 	else:
-		try:
-			single_request = create_and_fill_single_request(patient, units)
-		except CanNotFulfill as cnf:
-			reject = cnf.save_reject(models.SingleRequest)
+		key = _idempotency_key(request, request.POST.get("idempotency_key"))
 
-			return HttpResponseRedirect(reverse(
-				show_reject,
-				kwargs={"reject_id": reject.id}
-			))
+		# a resubmitted form is answered without waiting for the writer
+		single_request = replay(key) or dispatch(
+			fill_or_reject_single_request,
+			patient,
+			units,
+			key,
+			_reservation_id(request.POST.get("reservation")),
+			request.user,
+			user=request.user
+		)
 
-		return HttpResponseRedirect(
-			reverse(single_request_complete, kwargs={"request_id": single_request.id}))
+		return _result_redirect(single_request)
 
 
 @permission_required("blood.can_request_single")
@@ -144,29 +407,130 @@ def single_request_complete(request, request_id):
 @permission_required("blood.can_request_mci")
 def mci_request_start(request):
 	if request.method == "GET":
-		form = MCIRequestForm()
+		form = MCIRequestForm(initial={"idempotency_key": uuid.uuid4().hex})
 	else:
 		form = MCIRequestForm(request.POST)
 
 		if form.is_valid():
 			data = form.cleaned_data
+			key = _idempotency_key(request, data["idempotency_key"])
+
+			mci_request = replay(key) or dispatch(
+				fill_or_reject_mci_request,
+				data["distribution"],
+				data["units"],
+				data["allocation"],
+				key,
+				data["reservation"],
+				request.user,
+				user=request.user
+			)
 
-			try:
-				mci_request = create_and_fill_mci_request(data["distribution"].leaf, data["units"])
-			except CanNotFulfill as cnf:
-				reject = cnf.save_reject(models.MCIRequest)
+			return _result_redirect(mci_request)
 
-				return HttpResponseRedirect(reverse(
-					show_reject,
-					kwargs={"reject_id": reject.id}
-				))
+	return render(request, "mci_request.html", {"form": form})
 
-			return HttpResponseRedirect(reverse(
-				mci_request_complete,
-				kwargs={"request_id": mci_request.id}
-			))
 
-	return render(request, "mci_request.html", {"form": form})
+@require_POST
+@permission_required("blood.can_request_mci")
+def mci_request_reserve(request):
+	"""
+	Hold the units of an MCI request (the MCI request form's fields) for BLOOD_HOLD_SECONDS,
+	answering with the reservation to post along with the form. Planning happens here, posting
+	the form with the reservation only issues the held units.
+	"""
+	form = MCIRequestForm(request.POST)
+	if not form.is_valid():
+		return JsonResponse({"errors": form.errors}, status=400)
+
+	data = form.cleaned_data
+
+	try:
+		reservation = dispatch(
+			reserve_mci_request,
+			data["distribution"],
+			data["units"],
+			data["allocation"],
+			request.user,
+			user=request.user
+		)
+	except CanNotFulfill as cnf:
+		return JsonResponse({"missing_units": dict(cnf.missing_units)}, status=409)
+
+	held = {}
+	for blood_type, units in reservation.hold_set.values_list("request_blood_type", "units"):
+		held[blood_type] = held.get(blood_type, 0) + units
+
+	return JsonResponse({
+		"reservation": reservation.id,
+		"expires_at": reservation.expires_at.isoformat(),
+		"held_units": held
+	})
+
+
+@require_POST
+@permission_required("blood.can_request_mci")
+def mci_request_batch(request):
+	"""
+	Allocate a JSON batch of MCI orders, {"orders": [{"distribution": id, "units": n}, ...]}
+	with optional "allocation" and "allow_partial", answering with the outcome of each order.
+	A batch sent again with the same "idempotency_key" (or Idempotency-Key header) is answered
+	with the outcomes of the first, a different batch with it with 422.
+	"""
+	try:
+		payload = json.loads(request.body)
+		orders = payload["orders"]
+	except (ValueError, KeyError, TypeError):
+		return JsonResponse({"error": "expected a JSON object with an orders list"}, status=400)
+
+	if not isinstance(orders, list) or not all(isinstance(order, dict) for order in orders):
+		return JsonResponse({"error": "orders must be a list of objects"}, status=400)
+
+	sent_key = payload.get("idempotency_key") or request.META.get("HTTP_IDEMPOTENCY_KEY")
+	key = _idempotency_key(request, sent_key)
+	if sent_key is not None and key is None:
+		return JsonResponse(
+			{"error": f"idempotency_key must be up to {IDEMPOTENCY_KEY_LENGTH} characters"},
+			status=400
+		)
+
+	options = MCIBatchForm(payload)
+	order_forms = [MCIBatchOrderForm(order) for order in orders]
+
+	errors = {}
+	if not options.is_valid():
+		errors["options"] = options.errors
+	for i, form in enumerate(order_forms):
+		if not form.is_valid():
+			errors[i] = form.errors
+
+	if errors:
+		return JsonResponse({"errors": errors}, status=400)
+
+	batch = (
+		[(form.cleaned_data["distribution"], form.cleaned_data["units"]) for form in order_forms],
+		options.cleaned_data["allocation"] or GREEDY_ALLOCATION,
+		options.cleaned_data["allow_partial"]
+	)
+
+	try:
+		outcomes = replay_mci_batch(key, *batch) or \
+			dispatch(fill_mci_batch, *batch, key, user=request.user)
+	except BatchConflict:
+		return JsonResponse(
+			{"error": "idempotency_key was sent with a different batch"},
+			status=422
+		)
+
+	return JsonResponse({"orders": [
+		{
+			"status": outcome.status,
+			"request_id": outcome.request.id if outcome.request else None,
+			"reject_id": outcome.reject.id if outcome.reject else None,
+			"missing_units": dict(outcome.missing_units)
+		}
+		for outcome in outcomes
+	]})
 
 
 @permission_required("blood.can_request_mci")
@@ -175,6 +539,59 @@ def mci_request_complete(request, request_id: int):
 	return render(request, "mci_request_complete.html", {"mci_request": mci_request})
 
 
+@permission_required("blood.can_request_mci")
+def mci_simulation(request):
+	"""
+	Capacity of every distribution today and tomorrow, and a day by day projection of one
+	request, all from a single read of the inventory, as the optimal allocation would fill
+	them. Nothing is issued.
+	"""
+	simulator = simulation.InventorySimulator.load()
+
+	distributions = [
+		distribution.leaf for distribution in models.BloodTypeDistribution.objects.all()
+	]
+	capacity = simulator.capacity(simulation.percentage_matrix(distributions), days=(0, 1))
+
+	context = {
+		"blood_types": AVAILABLE_TYPES,
+		"allocation": simulation.ALLOCATION,
+		"capacity": [
+			(distribution, int(today), int(tomorrow))
+			for distribution, (today, tomorrow) in zip(distributions, capacity)
+		],
+		"projection": None
+	}
+
+	if "distribution" in request.GET:
+		form = SimulationForm(request.GET)
+
+		if form.is_valid():
+			data = form.cleaned_data
+			projection = simulation.projection(
+				simulator,
+				data["distribution"],
+				data["units"],
+				data["horizon"]
+			)
+
+			if request.GET.get("format") == "json":
+				return JsonResponse({"allocation": simulation.ALLOCATION, "projection": projection})
+
+			context["projection"] = [
+				dict(
+					day,
+					shortfall=[day["shortfall"][blood_type] for blood_type in AVAILABLE_TYPES]
+				)
+				for day in projection
+			]
+	else:
+		form = SimulationForm()
+
+	context["form"] = form
+	return render(request, "mci_simulation.html", context)
+
+
 @permission_required("blood.can_request_mci")
 def show_reject(request, reject_id: int):
 	reject = get_object_or_404(models.Reject, id=reject_id)
@@ -182,20 +599,189 @@ def show_reject(request, reject_id: int):
 	return render(request, "cant_fill.html", {"reject": reject})
 
 
-def show_outstanding(request, page: int):
-	outstanding = models.OutstandingDonations.objects.all().prefetch_related(
-		"donation",
-		"donation__donor"
-	)
+OUTSTANDING_PAGE_SIZE = 30
+OUTSTANDING_COUNT_SECONDS = 60
+
+Cursor = Tuple[bool, int, int]
 
-	pages = Paginator(outstanding, 30)
-	current_page = pages.page(page)
+
+def _parse_cursor(value: Optional[str]) -> Optional[Cursor]:
+	try:
+		expiring, rank, donation_id = value.split(".")
+		return expiring == "1", int(rank), int(donation_id)
+	except (AttributeError, ValueError):
+		return None
+
+
+def _format_cursor(row) -> str:
+	return f"{int(row.expiring)}.{row.rank}.{row.donation_id}"
+
+
+def _outstanding_tier(now, expiring: bool):
+	"""
+	The outstanding ledger rows of one priority tier, filtered like the outstanding views.
+	"""
+	tier = Q(high_priority_at__lte=now) if expiring else Q(high_priority_at__gt=now)
+
+	return models.RemainingUnits.objects \
+		.filter(tier, units__gt=0, expires_at__gt=now) \
+		.filter(units__gt=F("held")) \
+		.select_related("donation__donor") \
+		.only(
+			"blood_type", "rank", "donation_date",
+			"donation__donor",
+			"donation__donor__first_name", "donation__donor__last_name",
+			"donation__donor__birthday", "donation__donor__smokes",
+			"donation__donor__phone_number"
+		)
+
+
+def _outstanding_segments(now, cursor: Optional[Cursor], forward: bool) -> Iterator[tuple]:
+	"""
+	(expiring, rows) segments following (or preceding) the cursor in the (expiring, rank,
+	donation_id) order. Each segment is read in order from the blood_remaining_rank index,
+	starting at the cursor, and skips the rows of the other tier it passes.
+	"""
+	tiers = [False, True] if forward else [True, False]
+	order = ("rank", "donation_id") if forward else ("-rank", "-donation_id")
+
+	if cursor is not None:
+		expiring, rank, donation_id = cursor
+		tier = _outstanding_tier(now, expiring)
+		id_beyond = "donation_id__gt" if forward else "donation_id__lt"
+		rank_beyond = "rank__gt" if forward else "rank__lt"
+
+		# two index ranges, SQLite only starts a range at the rank of an OR or a row value
+		yield expiring, tier.filter(rank=rank, **{id_beyond: donation_id}).order_by(*order)
+		yield expiring, tier.filter(**{rank_beyond: rank}).order_by(*order)
+
+		tiers = tiers[tiers.index(expiring) + 1:]
+
+	for expiring in tiers:
+		yield expiring, _outstanding_tier(now, expiring).order_by(*order)
+
+
+def _outstanding_page(now, cursor: Optional[Cursor], forward: bool, size: int) -> List:
+	rows = []
+
+	for expiring, segment in _outstanding_segments(now, cursor, forward):
+		for row in segment[0:size - len(rows)]:
+			row.expiring = expiring
+			rows.append(row)
+
+		if len(rows) == size:
+			break
+
+	return rows
+
+
+def _outstanding_count(now) -> int:
+	# counting the outstanding rows is the one part that grows with the stock, it only changes
+	# with the inventory version or as donations expire
+	key = "blood:outstanding_count:%d:%d" % models.InventoryVersion.current()
+	count = cache.get(key)
+
+	if count is None:
+		count = models.RemainingUnits.objects \
+			.filter(units__gt=0, expires_at__gt=now) \
+			.filter(units__gt=F("held")) \
+			.count()
+		cache.set(key, count, OUTSTANDING_COUNT_SECONDS)
+
+	return count
+
+
+def show_outstanding(request):
+	"""
+	The outstanding donations in the order of the blood_outstanding_donations view, paged by
+	cursor. A page reads the ledger behind the view from the cursor on, wherever the page is,
+	as it has the rank the order needs.
+	"""
+	now = timezone.now()
+	after = _parse_cursor(request.GET.get("after"))
+	before = _parse_cursor(request.GET.get("before")) if after is None else None
+
+	if before is not None:
+		rows = _outstanding_page(now, before, False, OUTSTANDING_PAGE_SIZE + 1)
+		has_previous = len(rows) > OUTSTANDING_PAGE_SIZE
+		rows = rows[0:OUTSTANDING_PAGE_SIZE][::-1]
+		has_next = True
+	else:
+		rows = _outstanding_page(now, after, True, OUTSTANDING_PAGE_SIZE + 1)
+		has_next = len(rows) > OUTSTANDING_PAGE_SIZE
+		rows = rows[0:OUTSTANDING_PAGE_SIZE]
+		has_previous = after is not None
 
 	return render(
 		request,
 		"outstanding.html",
 		{
-			"pages": pages,
-			"current_page": current_page
+			"current_page": rows,
+			"total": _outstanding_count(now),
+			"previous_cursor": _format_cursor(rows[0]) if rows and has_previous else None,
+			"next_cursor": _format_cursor(rows[-1]) if rows and has_next else None
+		}
+	)
+
+
+def show_outstanding_page(request, page):
+	"""
+	The numbered pages before cursor paging, kept for bookmarks: every one of them lands on the
+	first page, as a number no longer says where a page starts.
+	"""
+	return HttpResponsePermanentRedirect(reverse("outstanding"))
+
+
+def inventory_history(request):
+	"""
+	The inventory per blood type over time, from the hourly rollups alone: as a table, or
+	exported with ?format=tsv or ?format=json.
+	"""
+	export = request.GET.get("format")
+	form = InventoryHistoryForm(request.GET)
+
+	if not form.is_valid():
+		if export in ("tsv", "json"):
+			return JsonResponse({"errors": form.errors}, status=400)
+
+		return render(request, "inventory_history.html", {"form": form, "rows": None})
+
+	data = form.cleaned_data
+	rows = rollup.history(data["since"], data["until"], data["blood_type"], data["resolution"])
+	rolled_up_until = rollup.rolled_up_until()
+
+	if export == "json":
+		return JsonResponse({
+			"resolution": data["resolution"],
+			"since": data["since"],
+			"until": data["until"],
+			"rolled_up_until": rolled_up_until,
+			"columns": ["period", "blood_type"] + rollup.COLUMNS,
+			"rows": rows
+		})
+
+	if export == "tsv":
+		b = io.StringIO()
+
+		w = writer(b, delimiter="\t")
+		w.writerow(["period", "blood_type"] + rollup.COLUMNS)
+		w.writerows(rows)
+
+		b.seek(0, io.SEEK_SET)
+
+		return HttpResponse(
+			b,
+			content_type="text/tab-separated-values",
+			headers={"Content-Disposition": 'attachment; filename="inventory_history.tsv"'},
+		)
+
+	return render(
+		request,
+		"inventory_history.html",
+		{
+			"form": form,
+			"rows": rows,
+			"columns": rollup.COLUMNS,
+			"rolled_up_until": rolled_up_until
 		}
 	)
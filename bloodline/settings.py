@@ -44,11 +44,13 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'blood.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'blood.profiling.ProfilingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'reversion.middleware.RevisionMiddleware'
@@ -58,7 +60,8 @@ ROOT_URLCONF = 'bloodline.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # Django's backend, timing renders for the request metrics
+        'BACKEND': 'blood.metrics.TimedDjangoTemplates',
         'DIRS': [BASE_DIR / 'templates'],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -82,6 +85,11 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # a file rather than the shared in-memory database, which fails concurrent writers
+        # instead of making them wait for the lock, for the concurrent allocation tests
+        'TEST': {
+            'NAME': BASE_DIR / 'test_db.sqlite3',
+        },
     }
 }
 
@@ -134,4 +142,35 @@ LOGOUT_REDIRECT_URL = "/"
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Plan allocations from an in-process copy of the inventory (blood/inventory.py) instead of
+# querying the outstanding views, and reload that copy from scratch at least this often
+BLOOD_INVENTORY_ENGINE = False
+BLOOD_INVENTORY_RECONCILE_SECONDS = 300
+
+# Run allocations on a single writer thread per process (blood/dispatcher.py), batching up to
+# this many queued requests per transaction
+BLOOD_ALLOCATION_DISPATCHER = False
+BLOOD_ALLOCATION_BATCH_SIZE = 32
+
+# Units held for a request on its confirmation page (blood.models.Reservation) are released
+# after this long unless the request is committed, by the next allocation or release_holds
+BLOOD_HOLD_SECONDS = 300
+
+# The homepage forecasts the units expected to expire unused over this many days, issuing units
+# at the average rate of the last BLOOD_FORECAST_RATE_DAYS days (blood/forecast.py)
+BLOOD_FORECAST_DAYS = 7
+BLOOD_FORECAST_RATE_DAYS = 14
+
+# "versions" keeps a serialized version of every issue and reject type an allocation creates,
+# "compact" records them as one json audit row per request or reject, attached to its revision
+BLOOD_AUDIT_MODE = "versions"
+
+# Addresses allowed to scrape /metrics, superusers can always read it
+BLOOD_METRICS_ALLOWED_IPS = ["127.0.0.1", "::1"]
+
+# Requests superusers profile with ?_profile=1 or an X-Bloodline-Profile header are saved here,
+# the newest BLOOD_PROFILE_KEEP are kept
+BLOOD_PROFILE_DIR = BASE_DIR / "profiles"
+BLOOD_PROFILE_KEEP = 50
+
 from .settings_local import *
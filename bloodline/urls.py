@@ -18,20 +18,27 @@ from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import include, path
 
-from blood.views import donation_id, donation_received, donation_start, mci_request_complete, \
-    mci_request_start, show_outstanding, show_reject, single_request_complete, \
-    single_request_confirm, single_request_details, single_request_start
-from homepage.views import export_audit_trail, export_stats, homepage
+from blood.views import donation_id, donation_import_upload, donation_received, donation_start, \
+    inventory_history, mci_request_batch, mci_request_complete, mci_request_reserve, \
+    mci_request_start, mci_simulation, patient_search, show_outstanding, show_outstanding_page, \
+    show_reject, single_request_complete, single_request_confirm, single_request_details, \
+    single_request_start, sync_donations, sync_patients
+from homepage.views import export_audit_trail, export_stats, homepage, metrics
 
 urlpatterns = [
                   path('admin/', admin.site.urls),
                   path('', homepage, name="homepage"),
                   path('audit_export', export_audit_trail, name="audit_export"),
                   path('stats_export', export_stats, name="stats_export"),
+                  path('metrics', metrics, name="metrics"),
                   path('donation/', donation_start, name="donation_start"),
+                  path('donation/import', donation_import_upload, name="donation_import"),
                   path('donation/<id_number>', donation_id, name="donation_id"),
                   path('donation/received/<donation_id>', donation_received,
                        name="donation_received"),
+                  path('patients/search', patient_search, name="patient_search"),
+                  path('sync/patients', sync_patients, name="sync_patients"),
+                  path('sync/donations', sync_donations, name="sync_donations"),
                   path('single_request/', single_request_start, name="single_request_start"),
                   path('single_request/<id_number>', single_request_details, name="single_request"),
                   path('single_request/<id_number>/<int:units>', single_request_confirm,
@@ -39,10 +46,14 @@ urlpatterns = [
                   path('single_request/<request_id>/complete', single_request_complete,
                        name="single_request_complete"),
                   path('mci_request/', mci_request_start, name="mci_request"),
+                  path('mci_request/batch', mci_request_batch, name="mci_request_batch"),
+                  path('mci_request/reserve', mci_request_reserve, name="mci_request_reserve"),
+                  path('mci_simulation', mci_simulation, name="mci_simulation"),
                   path('mci_request/<request_id>/complete', mci_request_complete,
                        name="mci_request_complete"),
                   path('reject/<int:reject_id>', show_reject, name="show_reject"),
-                  path('outstanding', show_outstanding, {"page": 1}, name="outstanding"),
-                  path('outstanding/<int:page>', show_outstanding, name="outstanding"),
+                  path('outstanding', show_outstanding, name="outstanding"),
+                  path('outstanding/<int:page>', show_outstanding_page),
+                  path('inventory/history', inventory_history, name="inventory_history"),
                   path('accounts/', include('django.contrib.auth.urls')),
               ] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
@@ -10,7 +10,15 @@ https://docs.djangoproject.com/en/3.1/howto/deployment/wsgi/
 import os
 
 from django.core.wsgi import get_wsgi_application
+from django.db import connections
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bloodline.settings')
 
 application = get_wsgi_application()
+
+from blood.inventory import get_engine  # noqa: E402 pylint: disable=wrong-import-position
+
+if get_engine() is not None:
+    # Load the inventory snapshot before serving, and don't share the connection across forks
+    get_engine().load()
+    connections.close_all()
@@ -0,0 +1,12 @@
+from django import forms
+
+
+class AuditExportForm(forms.Form):
+    since = forms.DateTimeField(required=False)
+    until = forms.DateTimeField(required=False, help_text="Exclusive")
+    model = forms.RegexField(regex="^([a-z_]+\\.)?[a-z_]+$", required=False,
+                             help_text="Model name, optionally prefixed by its app label")
+    user = forms.CharField(required=False, help_text="Username")
+    after = forms.IntegerField(required=False, min_value=0,
+                               help_text="Resume after this version_id")
+    gzip = forms.BooleanField(required=False)
@@ -1 +1,239 @@
-# Create your tests here.
+from csv import DictReader
+from datetime import date, datetime, timedelta
+import gzip
+import io
+import json
+from typing import Dict, List
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.utils import timezone
+import reversion
+from reversion.models import Revision, Version
+
+from blood import forecast, metrics, stock
+from blood.fill_request import fill_or_reject_single_request
+from blood.models import Donation, Issue, Patient, Reject, RejectType
+
+
+def _patient(number: int, blood_type: str) -> Patient:
+    return Patient.objects.create(
+        id=str(1_000_000_000 + number),
+        first_name="First",
+        last_name="Last",
+        birthday=date(1980, 1, 1),
+        blood_type=blood_type,
+        smokes=False
+    )
+
+
+class AuditExportTests(TestCase):
+    START = datetime(2026, 3, 1, tzinfo=timezone.utc)
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser("auditor")
+        self.nurse = User.objects.create_user("nurse")
+        self.client.force_login(self.admin)
+
+        # a revision a day, the second one by the nurse
+        for day, user in enumerate([self.admin, self.nurse, self.admin]):
+            with reversion.create_revision():
+                reversion.set_user(user)
+                Donation.objects.create(donor=_patient(day, "O-"), units=day + 1)
+
+            Revision.objects.filter(id=Revision.objects.latest("id").id) \
+                .update(date_created=self.START + timedelta(days=day))
+
+    def export(self, query: str = "") -> List[Dict[str, str]]:
+        response = self.client.get(f"/audit_export?{query}")
+        self.assertEqual(response.status_code, 200)
+
+        body = b"".join(response.streaming_content)
+        if "gzip=1" in query:
+            self.assertEqual(response["Content-Type"], "application/gzip")
+            body = gzip.decompress(body)
+
+        return list(DictReader(io.StringIO(body.decode()), delimiter="\t"))
+
+    def version_ids(self, rows: List[Dict[str, str]]) -> List[int]:
+        return [int(row["version_id"]) for row in rows]
+
+    def test_all_versions_in_order(self):
+        self.assertEqual(self.version_ids(self.export()),
+                         list(Version.objects.order_by("id").values_list("id", flat=True)))
+
+    def test_filters(self):
+        def expected(**filters) -> List[int]:
+            return list(Version.objects.filter(**filters).order_by("id")
+                        .values_list("id", flat=True))
+
+        second_day = self.START + timedelta(days=1)
+
+        for query, filters in [
+            ("since=2026-03-02", {"revision__date_created__gte": second_day}),
+            ("until=2026-03-02", {"revision__date_created__lt": second_day}),
+            ("model=blood.donation", {"content_type__model": "donation"}),
+            ("model=patient", {"content_type__model": "patient"}),
+            ("user=nurse", {"revision__user": self.nurse}),
+            ("since=2026-03-02&user=auditor",
+             {"revision__date_created__gte": second_day, "revision__user": self.admin}),
+        ]:
+            with self.subTest(query):
+                ids = expected(**filters)
+                self.assertTrue(ids)
+                self.assertEqual(self.version_ids(self.export(query)), ids)
+
+        rows = self.export("model=donation")
+        self.assertEqual({row["content_type"] for row in rows}, {"donation"})
+        self.assertEqual({row["object_repr"] for row in rows}, {"O- 1 units", "O- 2 units",
+                                                                 "O- 3 units"})
+
+    def test_gzip(self):
+        self.assertEqual(self.export("gzip=1"), self.export())
+        self.assertEqual(self.export("model=patient&gzip=1"), self.export("model=patient"))
+
+    def test_resume_after(self):
+        rows = self.export()
+
+        for cut in range(len(rows) + 1):
+            with self.subTest(cut):
+                after = rows[cut - 1]["version_id"] if cut else "0"
+                self.assertEqual(rows[:cut] + self.export(f"after={after}"), rows)
+
+        # versions written meanwhile follow without a gap
+        with reversion.create_revision():
+            Donation.objects.create(donor=Patient.objects.first(), units=4)
+
+        resumed = self.export(f"after={rows[-1]['version_id']}")
+        self.assertEqual(rows + resumed, self.export())
+        self.assertEqual(len(resumed), 1)
+
+    def test_invalid_filters(self):
+        for query in ("after=-1", "since=yesterday", "model=blood.Donation;"):
+            with self.subTest(query):
+                self.assertEqual(self.client.get(f"/audit_export?{query}").status_code, 400)
+
+    def test_superusers_only(self):
+        self.client.force_login(self.nurse)
+        self.assertEqual(self.client.get("/audit_export").status_code, 404)
+
+
+@override_settings(BLOOD_AUDIT_MODE="compact")
+class CompactAuditExportTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser("auditor"))
+        patient = _patient(0, "O-")
+
+        with reversion.create_revision():
+            for units in (3, 2):
+                Donation.objects.create(donor=patient, units=units)
+
+        with reversion.create_revision():
+            self.request = fill_or_reject_single_request(patient, 4)
+            self.reject = fill_or_reject_single_request(patient, 10)
+
+        self.assertIsInstance(self.reject, Reject)
+
+    def export(self, query: str) -> List[Dict[str, str]]:
+        response = self.client.get(f"/audit_export?{query}")
+        return list(DictReader(io.StringIO(b"".join(response.streaming_content).decode()),
+                               delimiter="\t"))
+
+    def test_model_filter(self):
+        issues, = self.export("model=issue")
+        self.assertEqual((issues["content_type"], issues["object_id"], issues["format"]),
+                         ("issue", str(self.request.id), "json"))
+        self.assertEqual(
+            sorted((issue["donation"], issue["units"]) for issue in
+                   json.loads(issues["serialized_data"])),
+            sorted(Issue.objects.filter(request=self.request).values_list("donation_id", "units"))
+        )
+
+        reject_types, = self.export("model=blood.rejecttype")
+        self.assertEqual((reject_types["content_type"], reject_types["object_id"]),
+                         ("rejecttype", str(self.reject.id)))
+        self.assertEqual(
+            [(missing["blood_type"], missing["units"]) for missing in
+             json.loads(reject_types["serialized_data"])],
+            list(RejectType.objects.filter(reject=self.reject).values_list("blood_type", "units"))
+        )
+
+        # the owners' own versions, without the audits hanging off them
+        request, = self.export("model=singlerequest")
+        self.assertEqual((request["content_type"], request["object_id"]),
+                         ("singlerequest", str(self.request.id)))
+
+    def test_audits_follow_their_version(self):
+        rows = self.export("")
+        kinds = [(row["content_type"], row["object_id"]) for row in rows]
+
+        self.assertLess(kinds.index(("singlerequest", str(self.request.id))),
+                        kinds.index(("issue", str(self.request.id))))
+        self.assertLess(kinds.index(("reject", str(self.reject.id))),
+                        kinds.index(("rejecttype", str(self.reject.id))))
+        self.assertEqual(len(rows), Version.objects.count() + 2)
+
+
+class EtagTests(TestCase):
+    def setUp(self):
+        # both caches are keyed by the inventory version, which every test rolls back
+        for module in (stock, forecast):
+            patcher = mock.patch.object(module, "_cached", None)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.patient = _patient(0, "O-")
+        Donation.objects.create(donor=self.patient, units=5)
+
+    def test_not_modified(self):
+        for path in ("/", "/stats_export"):
+            with self.subTest(path):
+                etag = self.client.get(path)["ETag"]
+
+                self.assertEqual(self.client.get(path, HTTP_IF_NONE_MATCH=etag).status_code,
+                                 304)
+                self.assertEqual(self.client.get(path, HTTP_IF_NONE_MATCH='"other"')
+                                 .status_code, 200)
+
+    def test_changes_after_allocation(self):
+        etags = {path: self.client.get(path)["ETag"] for path in ("/", "/stats_export")}
+
+        fill_or_reject_single_request(self.patient, 2)
+
+        for path, etag in etags.items():
+            with self.subTest(path):
+                response = self.client.get(path, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, 200)
+                self.assertNotEqual(response["ETag"], etag)
+
+        self.assertIn(b"O-\t3", self.client.get("/stats_export").content)
+
+    def test_superusers_always_served(self):
+        self.client.force_login(User.objects.create_superuser("auditor"))
+        self.assertFalse(self.client.get("/").has_header("ETag"))
+
+
+class MetricsTests(TestCase):
+    def request_count(self, view: str) -> int:
+        prefix = f'bloodline_request_duration_seconds_count{{view="{view}",method="GET"}} '
+        lines = [line for line in metrics.render().splitlines() if line.startswith(prefix)]
+        return int(lines[0][len(prefix):]) if lines else 0
+
+    def test_view_counted(self):
+        count = self.request_count("homepage")
+        self.client.get("/")
+        self.assertEqual(self.request_count("homepage"), count + 1)
+
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(f'view="homepage",method="GET"}} {count + 1}\n', response.content.decode())
+
+    def test_allowed_clients_only(self):
+        self.assertEqual(self.client.get("/metrics", REMOTE_ADDR="10.0.0.1").status_code, 403)
+
+        self.client.force_login(User.objects.create_user("nurse"))
+        self.assertEqual(self.client.get("/metrics", REMOTE_ADDR="10.0.0.1").status_code, 403)
+
+        self.client.force_login(User.objects.create_superuser("auditor"))
+        self.assertEqual(self.client.get("/metrics", REMOTE_ADDR="10.0.0.1").status_code, 200)
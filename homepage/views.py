@@ -1,44 +1,58 @@
 from csv import writer
 import io
 from io import StringIO
-
-from django.db.models import Sum
-from django.http import Http404, HttpResponse
+from typing import Iterable, Iterator, Optional, Set
+import zlib
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Exists, OuterRef, Q
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, \
+    StreamingHttpResponse
 from django.shortcuts import render
+from django.views.decorators.http import condition
 from reversion.models import Version
 
-from blood.models import OutstandingDonations
+from blood import metrics as blood_metrics
+from blood.audit import with_allocation_audits
+from blood.forecast import forecast
+from blood.models import AllocationAudit
+from blood.stock import stock_totals
+from homepage.forms import AuditExportForm
+
+AUDIT_EXPORT_CHUNK_SIZE = 2000
+
+
+def _homepage_etag(request):
+    # the audit trail superusers see changes without the stock changing
+    if request.user.is_authenticated and request.user.is_superuser:
+        return None
+
+    return f"{stock_totals().etag}.{forecast().etag}.{request.user.id or 0}"
 
 
+@condition(etag_func=_homepage_etag)
 def homepage(request):
     audit_trail = []
 
     if request.user.is_authenticated and request.user.is_superuser:
         audit_trail = Version.objects.select_related().order_by("-revision__date_created")[0:10]
 
-    outstanding = OutstandingDonations.objects \
-        .values('blood_type') \
-        .annotate(outstanding=Sum('units')) \
-        .order_by('blood_type')
-
     return render(request, "homepage.html", {
-        "outstanding": outstanding,
+        "outstanding": stock_totals().outstanding,
+        "forecast": forecast(),
         "audit_trail": audit_trail
     })
 
 
+@condition(etag_func=lambda request: stock_totals().etag)
 def export_stats(request):
     b = StringIO()
 
     w = writer(b, delimiter='\t')
     w.writerow(["blood_type", "outstanding_count"])
 
-    outstanding = OutstandingDonations.objects \
-        .values('blood_type') \
-        .annotate(outstanding=Sum('units')) \
-        .order_by('blood_type')
-
-    for blood_type in outstanding:
+    for blood_type in stock_totals().outstanding:
         w.writerow([
             blood_type['blood_type'],
             blood_type['outstanding']
@@ -53,18 +67,21 @@ def export_stats(request):
     )
 
 
-def export_audit_trail(request):
-    if request.user.is_anonymous or not request.user.is_superuser:
-        raise Http404("Only superuser allowed to export")
+class _Echo:
+    def write(self, value):
+        return value
 
-    b = StringIO()
 
-    w = writer(b, delimiter='\t')
-    w.writerow(["object_id", "format", "serialized_data", "object_repr", "content_type",
-                "date_created", "comment", "user_id", "user_first_name",
-                "user_last_name", "user_email"])
+def _audit_rows(versions, record_types: Optional[Set[int]] = None):
+    w = writer(_Echo(), delimiter='\t')
+
+    yield w.writerow(["object_id", "format", "serialized_data", "object_repr", "content_type",
+                      "date_created", "comment", "user_id", "user_first_name",
+                      "user_last_name", "user_email", "version_id"])
 
-    for record in Version.objects.select_related():
+    records = versions.iterator(chunk_size=AUDIT_EXPORT_CHUNK_SIZE)
+
+    for record, audits in with_allocation_audits(records, AUDIT_EXPORT_CHUNK_SIZE):
         if record.revision.user:
             user_fields = [
                 record.revision.user_id,
@@ -75,19 +92,127 @@ def export_audit_trail(request):
         else:
             user_fields = ["", "", "", ""]
 
-        w.writerow([
-                       record.object_id,
-                       record.format,
-                       record.serialized_data,
-                       record.object_repr,
-                       record.content_type.model,
-                       record.revision.date_created.isoformat(),
-                       record.revision.comment,
-                   ] + user_fields)
-    b.seek(0, io.SEEK_SET)
+        revision_fields = [record.revision.date_created.isoformat(), record.revision.comment]
 
-    return HttpResponse(
-        b,
-        content_type='text/csv',
-        headers={'Content-Disposition': 'attachment; filename="audit_trail.csv"'},
+        if record_types is None or record.content_type_id in record_types:
+            yield w.writerow([
+                                 record.object_id,
+                                 record.format,
+                                 record.serialized_data,
+                                 record.object_repr,
+                                 record.content_type.model,
+                             ] + revision_fields + user_fields + [record.id])
+
+        # compact allocation audits: the rows the allocation created, as one json list
+        for allocation_audit in audits:
+            if record_types is not None and allocation_audit.record_type_id not in record_types:
+                continue
+
+            yield w.writerow([
+                                 allocation_audit.owner_id,
+                                 "json",
+                                 allocation_audit.serialized_data,
+                                 record.object_repr,
+                                 allocation_audit.record_type.model,
+                             ] + revision_fields + user_fields + [record.id])
+
+
+def _chunked(rows: Iterable[str]) -> Iterator[bytes]:
+    # one write per row is too chatty for the socket, send about 64KB at a time
+    chunk = []
+    size = 0
+
+    for row in rows:
+        chunk.append(row)
+        size += len(row)
+
+        if size >= 65536:
+            yield "".join(chunk).encode()
+            chunk = []
+            size = 0
+
+    if chunk:
+        yield "".join(chunk).encode()
+
+
+def _gzipped(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(wbits=31)
+
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+
+    yield compressor.flush()
+
+
+def export_audit_trail(request):
+    """
+    Streams the audit trail as TSV in version order, memory stays flat whatever the size.
+
+    Accepts since/until, model, user, gzip, and after=<version_id> to resume an interrupted
+    export from the version_id of its last row.
+    """
+    if request.user.is_anonymous or not request.user.is_superuser:
+        raise Http404("Only superuser allowed to export")
+
+    form = AuditExportForm(request.GET)
+    if not form.is_valid():
+        return HttpResponseBadRequest(form.errors.as_text(), content_type="text/plain")
+
+    filters = form.cleaned_data
+    versions = Version.objects.select_related("content_type", "revision", "revision__user") \
+        .order_by("id")
+    record_types = None
+
+    if filters["since"]:
+        versions = versions.filter(revision__date_created__gte=filters["since"])
+    if filters["until"]:
+        versions = versions.filter(revision__date_created__lt=filters["until"])
+    if filters["model"]:
+        app_label, _, model = filters["model"].rpartition(".")
+        content_types = ContentType.objects.filter(model=model)
+        if app_label:
+            content_types = content_types.filter(app_label=app_label)
+        record_types = set(content_types.values_list("id", flat=True))
+
+        # compact audits of the model hang off the versions of the requests and rejects owning
+        # them, those versions are read for their audits
+        owns_records = AllocationAudit.objects.filter(
+            revision_id=OuterRef("revision_id"),
+            owner_type_id=OuterRef("content_type_id"),
+            owner_id=OuterRef("object_id"),
+            record_type_id__in=record_types
+        )
+        versions = versions.filter(Exists(owns_records) | Q(content_type_id__in=record_types))
+    if filters["user"]:
+        versions = versions.filter(revision__user__username=filters["user"])
+    if filters["after"] is not None:
+        versions = versions.filter(id__gt=filters["after"])
+
+    content = _chunked(_audit_rows(versions, record_types))
+    filename = "audit_trail.csv"
+    content_type = "text/csv"
+
+    if filters["gzip"]:
+        content = _gzipped(content)
+        filename += ".gz"
+        content_type = "application/gzip"
+
+    return StreamingHttpResponse(
+        content,
+        content_type=content_type,
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'},
     )
+
+
+def metrics(request):
+    """
+    Request and allocation metrics of this process in the Prometheus text format, for local
+    scrapers and superusers.
+    """
+    if request.META.get("REMOTE_ADDR") not in settings.BLOOD_METRICS_ALLOWED_IPS and \
+            not (request.user.is_authenticated and request.user.is_superuser):
+        return HttpResponseForbidden("Metrics are only served locally")
+
+    return HttpResponse(blood_metrics.render(), content_type="text/plain; version=0.0.4")